@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+
+# Clients MemoryAdmission tracks before dropping full buckets
+MEMORY_MAX_BUCKETS = 10000
+
+# KEYS: bucket hash
+# ARGV: now, tokens/sec, burst
+TAKE_SCRIPT = """
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens')) or burst
+local last = tonumber(redis.call('hget', KEYS[1], 'ts')) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+# KEYS: admitted jobs zset, client's jobs zset, owners hash
+# ARGV: now, expires at, task id, client, max queued, max per client
+ADMIT_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1])
+for _, id in ipairs(expired) do redis.call('hdel', KEYS[3], id) end
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[1])
+local queued = redis.call('zcard', KEYS[1])
+if tonumber(ARGV[5]) > 0 and queued >= tonumber(ARGV[5]) then
+    return {'queue', queued}
+end
+local active = redis.call('zcard', KEYS[2])
+if tonumber(ARGV[6]) > 0 and active >= tonumber(ARGV[6]) then
+    return {'client', active}
+end
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[3])
+redis.call('zadd', KEYS[2], ARGV[2], ARGV[3])
+redis.call('hset', KEYS[3], ARGV[3], ARGV[4])
+redis.call('expireat', KEYS[2], math.ceil(tonumber(ARGV[2])))
+return {'ok', active}
+"""
+
+# KEYS: admitted jobs zset, owners hash
+# ARGV: task id, client key prefix
+RELEASE_SCRIPT = """
+local client = redis.call('hget', KEYS[2], ARGV[1])
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+if client then
+    redis.call('zrem', ARGV[2] .. client, ARGV[1])
+end
+return client and 1 or 0
+"""
+
+
+# A request turned away at the edge. reason is 'rate' (token bucket empty),
+# 'client' (too many jobs of this client in flight) or 'queue' (too many jobs
+# in flight overall); retry_after is in seconds.
+class AdmissionRejected(Exception):
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Admission control in front of the job queue.
+#
+# Every request takes a token from its client's bucket (rate per second,
+# bursts of up to `burst`). A request that enqueues a job is then admitted
+# only while fewer than max_queued jobs are queued or running overall and
+# fewer than max_per_client of them belong to the client; 0 disables a
+# limit. Admitted jobs are released when they finish, or forgotten after
+# job_ttl seconds should a worker die without reporting.
+#
+# admit() returns how many jobs the client already has in flight, which the
+# caller turns into a lower message priority: a client with many jobs
+# waiting queues behind one with few (fair share).
+class Admission:
+    def __init__(self, rate, burst, max_per_client, max_queued, job_ttl, retry_after):
+        self.rate = rate
+        self.burst = burst
+        self.max_per_client = max_per_client
+        self.max_queued = max_queued
+        self.job_ttl = job_ttl
+        self.retry_after = retry_after
+
+    def take_token(self, client):
+        if not self.rate:
+            return
+        wait = self._take(client, time.time())
+        if wait > 0:
+            raise AdmissionRejected('Too many requests, slow down', 'rate', max(1, math.ceil(wait)))
+
+    def admit(self, client, task_id):
+        now = time.time()
+        outcome, count = self._admit(client, task_id, now, now + self.job_ttl)
+        if outcome == 'queue':
+            raise AdmissionRejected('The server is busy, try again later', 'queue', self.retry_after)
+        if outcome == 'client':
+            raise AdmissionRejected(f'You already have {count} downloads in progress', 'client', self.retry_after)
+        return count
+
+    def release(self, task_id):
+        self._release(task_id)
+
+
+# Shared by every web process through Redis. Each decision is one script, so
+# concurrent requests of one client can't both take the last slot.
+#
+#   admission:bucket:<client>   hash  tokens, time of the last refill
+#   admission:jobs              zset  admitted task ids by expiry
+#   admission:client:<client>   zset  the client's admitted task ids by expiry
+#   admission:owners            hash  task id -> client
+class RedisAdmission(Admission):
+    def __init__(self, redis_client, rate, burst, max_per_client, max_queued, job_ttl, retry_after,
+                 prefix='admission'):
+        super().__init__(rate, burst, max_per_client, max_queued, job_ttl, retry_after)
+        self.redis = redis_client
+        self.prefix = prefix
+        self._take_script = redis_client.register_script(TAKE_SCRIPT)
+        self._admit_script = redis_client.register_script(ADMIT_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    def _take(self, client, now):
+        return float(self._take_script(keys=[f'{self.prefix}:bucket:{client}'], args=[now, self.rate, self.burst]))
+
+    def _admit(self, client, task_id, now, expires):
+        outcome, count = self._admit_script(
+            keys=[f'{self.prefix}:jobs', f'{self.prefix}:client:{client}', f'{self.prefix}:owners'],
+            args=[now, expires, task_id, client, self.max_queued, self.max_per_client])
+        return outcome.decode() if isinstance(outcome, bytes) else outcome, int(count)
+
+    def _release(self, task_id):
+        self._release_script(keys=[f'{self.prefix}:jobs', f'{self.prefix}:owners'],
+                             args=[task_id, f'{self.prefix}:client:'])
+
+    def queued(self):
+        return self.redis.zcount(f'{self.prefix}:jobs', time.time(), '+inf')
+
+
+# The same policy kept in process memory, for a single web process without
+# Redis (development) or for trying the limits out
+class MemoryAdmission(Admission):
+    def __init__(self, rate, burst, max_per_client, max_queued, job_ttl, retry_after):
+        super().__init__(rate, burst, max_per_client, max_queued, job_ttl, retry_after)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.jobs = {}  # task id -> (client, expires at)
+
+    def _take(self, client, now):
+        with self.lock:
+            tokens, last = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + max(0, now - last) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > MEMORY_MAX_BUCKETS:
+                # Buckets refilled to the brim are the same as no bucket
+                self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                                if bucket[0] + (now - bucket[1]) * self.rate < self.burst}
+            return wait
+
+    def _admit(self, client, task_id, now, expires):
+        with self.lock:
+            self.jobs = {id: job for id, job in self.jobs.items() if job[1] > now}
+            if self.max_queued and len(self.jobs) >= self.max_queued:
+                return 'queue', len(self.jobs)
+            active = sum(1 for owner, _ in self.jobs.values() if owner == client)
+            if self.max_per_client and active >= self.max_per_client:
+                return 'client', active
+            self.jobs[task_id] = (client, expires)
+            return 'ok', active
+
+    def _release(self, task_id):
+        with self.lock:
+            self.jobs.pop(task_id, None)
+
+    def queued(self):
+        now = time.time()
+        with self.lock:
+            return sum(1 for _, expires in self.jobs.values() if expires > now)
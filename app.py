@@ -1,13 +1,46 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, Response, g, redirect, request, jsonify, send_from_directory
 from celery import Celery
-import subprocess
+from kombu import Queue
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from celery.utils.time import get_exponential_backoff_interval
+import redis
+import json
 import os
 import uuid
 import logging
+import mimetypes
 import shutil
+import subprocess
+import tempfile
+import time
+from urllib.parse import quote
+from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from admission import AdmissionRejected, MemoryAdmission, RedisAdmission
+from batches import BatchStore, stream_zip
+from download_cache import DownloadCache, extract_video_id
+from scheduler import FragmentScheduler, is_throttled, upstream_host
+from single_flight import SingleFlight
+from static_assets import build_assets
+from storage import StorageFull, StorageManager
+from task_store import TaskStore
+from tools import ToolProbe
+from tracing import end_trace, install_log_record_factory, start_trace, trace_id
+from formats import (FormatUnavailable, estimate_size, formats_by_id, local_streams, raw_selector, select_formats,
+                     select_stream_format)
+from info_cache import CachedExtractionError, InfoCache
+from metrics import Metrics, PhaseTimer
+from range_download import RangeDownloader, RangesUnsupported, fetched_bytes, output_path, rangeable
+from postprocess import FFmpegError, fetch_thumbnail, metadata_for, run_postprocess, thumbnail_url
+from ytdlp_runner import (STREAM_ARGS, ProgressThrottle, YtdlpError, describe_progress, is_transient,
+                          extract_info_cli, extract_playlist_cli, run_ytdlp_with_info)
+import ytdlp_engine
+
+# Configure logging. Every line carries the trace id of the request or task
+# it belongs to, the same id in the web process and the worker.
+install_log_record_factory()
+logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:[%(trace_id)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_url_path='/static')
@@ -18,22 +51,231 @@ app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
 celery.conf.update(app.config)
 
+celery.conf.update(
+    CELERYD_LOG_FORMAT='[%(asctime)s: %(levelname)s/%(processName)s] [%(trace_id)s] %(message)s',
+    CELERYD_TASK_LOG_FORMAT='[%(asctime)s: %(levelname)s/%(processName)s] [%(trace_id)s] '
+                            '%(task_name)s[%(task_id)s]: %(message)s',
+)
+
+# Shared Redis connection for state that has to be visible to every process
+redis_client = redis.Redis.from_url(app.config['CELERY_BROKER_URL'])
+
+# Counters and histograms from every process, served by /metrics
+metrics = Metrics(redis_client)
+
 # Create downloads folder
 OUTDIR = os.path.join(os.path.dirname(__file__), 'downloads')
 if not os.path.exists(OUTDIR):
     os.makedirs(OUTDIR)
 
-# Store task status
-TASKS = {}
+# Downloads are served by Flask by default: Werkzeug answers Range (206) and
+# ETag/Last-Modified conditional requests, and WSGI servers that provide
+# wsgi.file_wrapper (gunicorn, uWSGI) send the body with sendfile().
+# DOWNLOAD_OFFLOAD hands the transfer to a fronting proxy instead:
+#   'x-sendfile'  Apache mod_xsendfile / lighttpd
+#   'x-accel'     nginx, with an internal location mapped onto OUTDIR:
+#                 location /protected-downloads/ { internal; alias /path/to/downloads/; }
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD', '')
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-downloads/')
+app.config['USE_X_SENDFILE'] = app.config['DOWNLOAD_OFFLOAD'] == 'x-sendfile'
+app.config['DOWNLOAD_MAX_AGE'] = int(os.environ.get('DOWNLOAD_MAX_AGE', 60 * 60))
+
+# /api/stream pipes yt-dlp's output straight to the client, and by default
+# keeps a copy in OUTDIR so the next request is a cache hit
+app.config['STREAM_TEE'] = os.environ.get('STREAM_TEE', '1') == '1'
+app.config['STREAM_CHUNK_SIZE'] = 64 * 1024
+
+# Finished downloads are indexed so repeat requests skip yt-dlp entirely
+app.config['DOWNLOAD_CACHE_MAX_BYTES'] = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 20 * 1024 ** 3))
+download_cache = DownloadCache(redis_client, OUTDIR, app.config['DOWNLOAD_CACHE_MAX_BYTES'])
+
+# Identical requests arriving while a download is running attach to it
+app.config['SINGLE_FLIGHT_TTL'] = int(os.environ.get('SINGLE_FLIGHT_TTL', 2 * 60 * 60))
+single_flight = SingleFlight(redis_client, app.config['SINGLE_FLIGHT_TTL'])
+
+# DOWNLOAD_CACHE_MAX_BYTES is also the disk quota of OUTDIR. Jobs reserve their
+# estimated output size (STORAGE_UNKNOWN_SIZE when metadata has none) and wait
+# STORAGE_RETRY_DELAY seconds, up to STORAGE_MAX_WAITS times, while it does not
+# fit. Sweeps after finished jobs expire files not served for STORAGE_MAX_IDLE
+# seconds and keep usage under STORAGE_LOW_WATERMARK of the quota.
+app.config['STORAGE_LOW_WATERMARK'] = float(os.environ.get('STORAGE_LOW_WATERMARK', 0.8))
+app.config['STORAGE_MAX_IDLE'] = int(os.environ.get('STORAGE_MAX_IDLE', 7 * 24 * 60 * 60)) or None
+app.config['STORAGE_MIN_FREE_BYTES'] = int(os.environ.get('STORAGE_MIN_FREE_BYTES', 1024 ** 3))
+app.config['STORAGE_SWEEP_INTERVAL'] = int(os.environ.get('STORAGE_SWEEP_INTERVAL', 5 * 60))
+app.config['STORAGE_UNKNOWN_SIZE'] = int(os.environ.get('STORAGE_UNKNOWN_SIZE', 512 * 1024 ** 2))
+app.config['STORAGE_RETRY_DELAY'] = int(os.environ.get('STORAGE_RETRY_DELAY', 60))
+app.config['STORAGE_MAX_WAITS'] = int(os.environ.get('STORAGE_MAX_WAITS', 30))
+# Files a job reads from or a response is sending are pinned, sweeps and
+# evictions skip them until they are unpinned or STORAGE_PIN_TTL seconds pass
+app.config['STORAGE_PIN_TTL'] = int(os.environ.get('STORAGE_PIN_TTL', app.config['SINGLE_FLIGHT_TTL']))
+storage = StorageManager(
+    redis_client, download_cache,
+    quota_bytes=app.config['DOWNLOAD_CACHE_MAX_BYTES'],
+    reservation_ttl=app.config['SINGLE_FLIGHT_TTL'],
+    low_watermark=app.config['STORAGE_LOW_WATERMARK'],
+    max_idle=app.config['STORAGE_MAX_IDLE'],
+    min_free_bytes=app.config['STORAGE_MIN_FREE_BYTES'],
+    sweep_interval=app.config['STORAGE_SWEEP_INTERVAL'],
+)
+
+# Extracted metadata is shared between /api/formats and download_task. Format
+# URLs expire upstream, so entries only live INFO_CACHE_TTL seconds; failed
+# extractions are remembered for INFO_CACHE_NEGATIVE_TTL seconds.
+app.config['INFO_CACHE_TTL'] = int(os.environ.get('INFO_CACHE_TTL', 30 * 60))
+app.config['INFO_CACHE_NEGATIVE_TTL'] = int(os.environ.get('INFO_CACHE_NEGATIVE_TTL', 5 * 60))
+app.config['INFO_CACHE_MAX_ENTRIES'] = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 10000))
+info_cache = InfoCache(redis_client, app.config['INFO_CACHE_TTL'], app.config['INFO_CACHE_NEGATIVE_TTL'],
+                       app.config['INFO_CACHE_MAX_ENTRIES'])
+
+# Playlist/channel batches fan out at most BATCH_CONCURRENCY children at a
+# time (clients may ask for up to BATCH_MAX_CONCURRENCY). Children go to their
+# own queue, so per worker parallelism is that worker's --concurrency, e.g.
+#   celery -A app.celery worker -Q batch --concurrency 4 --prefetch-multiplier 1
+# See JOB_QUEUES below for the worker settings.
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 4))
+app.config['BATCH_MAX_CONCURRENCY'] = int(os.environ.get('BATCH_MAX_CONCURRENCY', 16))
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+app.config['BATCH_TTL'] = int(os.environ.get('BATCH_TTL', 24 * 60 * 60))
+app.config['BATCH_QUEUE'] = 'batch'
+
+# Single downloads are routed by job class so a long merge never sits in front
+# of a short audio grab. Each class has its own queue, a message priority
+# (0 is served first) and the worker settings meant for it:
+#   python app.py worker audio     # = celery -A app.celery worker -Q audio -c 8 --prefetch-multiplier 4 -n audio@%h
+#   python app.py worker large     # = celery -A app.celery worker -Q large -c 2 --prefetch-multiplier 1 -n large@%h
+# A worker consuming several queues (or started without -Q) drains them in the
+# order given, audio first.
+#
+# Muxing and tagging run after the transfer on the 'postprocess' queue, so
+# disk-bound ffmpeg passes get their own pool (it must see the same downloads
+# directory) and never hold a download slot:
+#   python app.py worker postprocess
+app.config['POSTPROCESS_QUEUE'] = 'postprocess'
+app.config['JOB_QUEUES'] = {
+    'audio': {'priority': 0, 'concurrency': int(os.environ.get('AUDIO_CONCURRENCY', 8)), 'prefetch': 4},
+    'small': {'priority': 3, 'concurrency': int(os.environ.get('SMALL_CONCURRENCY', 4)), 'prefetch': 2},
+    'large': {'priority': 6, 'concurrency': int(os.environ.get('LARGE_CONCURRENCY', 2)), 'prefetch': 1},
+    app.config['BATCH_QUEUE']: {'priority': 9, 'concurrency': app.config['BATCH_CONCURRENCY'], 'prefetch': 1},
+    # Jobs that already hold their files finish first
+    app.config['POSTPROCESS_QUEUE']: {'priority': 0, 'concurrency': int(os.environ.get('POSTPROCESS_CONCURRENCY', 2)),
+                                      'prefetch': 1},
+}
+# Video estimated at or below SMALL_JOB_MAX_BYTES goes to 'small'. Without
+# cached metadata the request waits for no extraction and goes by resolution.
+app.config['SMALL_JOB_MAX_BYTES'] = int(os.environ.get('SMALL_JOB_MAX_BYTES', 200 * 1024 ** 2))
+app.config['SMALL_JOB_MAX_HEIGHT'] = int(os.environ.get('SMALL_JOB_MAX_HEIGHT', 480))
+celery.conf.update(
+    CELERY_DEFAULT_QUEUE='celery',
+    CELERY_QUEUES=[Queue(name) for name in app.config['JOB_QUEUES']] + [Queue('celery')],
+    BROKER_TRANSPORT_OPTIONS={'queue_order_strategy': 'priority', 'priority_steps': list(range(10))},
+)
+batch_store = BatchStore(redis_client, app.config['BATCH_TTL'])
+
+# Admission control at /api/download, /api/batch and /api/stream, see
+# admission.Admission. A client is the peer address, or behind
+# ADMISSION_TRUSTED_HOPS proxies that append to ADMISSION_CLIENT_HEADER (e.g.
+# X-Forwarded-For) the address the outermost one saw; entries left of it are
+# whatever the client sent. A client may send ADMISSION_RATE
+# requests/sec in bursts of ADMISSION_BURST and have ADMISSION_MAX_PER_CLIENT
+# downloads queued or running; no download is admitted while
+# ADMISSION_MAX_QUEUED are. Turned away requests get a 429 with Retry-After.
+# Each download a client already has in flight moves its next one a priority
+# step back, up to FAIR_SHARE_MAX_PENALTY steps. ADMISSION_BACKEND 'memory'
+# keeps the state in the web process, only for setups that run jobs there
+# too (development, eager mode).
+app.config['ADMISSION_BACKEND'] = os.environ.get('ADMISSION_BACKEND', 'redis')
+app.config['ADMISSION_CLIENT_HEADER'] = os.environ.get('ADMISSION_CLIENT_HEADER', '')
+app.config['ADMISSION_TRUSTED_HOPS'] = int(os.environ.get('ADMISSION_TRUSTED_HOPS', 1))
+app.config['ADMISSION_RATE'] = float(os.environ.get('ADMISSION_RATE', 1.0))
+app.config['ADMISSION_BURST'] = int(os.environ.get('ADMISSION_BURST', 10))
+app.config['ADMISSION_MAX_PER_CLIENT'] = int(os.environ.get('ADMISSION_MAX_PER_CLIENT', 5))
+app.config['ADMISSION_MAX_QUEUED'] = int(os.environ.get('ADMISSION_MAX_QUEUED', 500))
+app.config['ADMISSION_JOB_TTL'] = int(os.environ.get('ADMISSION_JOB_TTL', 6 * 60 * 60))
+app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get('ADMISSION_RETRY_AFTER', 30))
+app.config['FAIR_SHARE_MAX_PENALTY'] = int(os.environ.get('FAIR_SHARE_MAX_PENALTY', 3))
+admission_limits = dict(
+    rate=app.config['ADMISSION_RATE'],
+    burst=app.config['ADMISSION_BURST'],
+    max_per_client=app.config['ADMISSION_MAX_PER_CLIENT'],
+    max_queued=app.config['ADMISSION_MAX_QUEUED'],
+    job_ttl=app.config['ADMISSION_JOB_TTL'],
+    retry_after=app.config['ADMISSION_RETRY_AFTER'],
+)
+if app.config['ADMISSION_BACKEND'] == 'memory':
+    admission = MemoryAdmission(**admission_limits)
+else:
+    admission = RedisAdmission(redis_client, **admission_limits)
+
+# Seconds between keep-alive comments on idle task event streams
+app.config['EVENT_STREAM_KEEPALIVE'] = 15
+# Most task ids accepted by one batch status call
+app.config['MAX_BATCH_STATUS'] = 100
+
+# Minimum seconds between progress updates pushed to the result backend
+app.config['PROGRESS_INTERVAL'] = float(os.environ.get('PROGRESS_INTERVAL', 1.0))
+
+# Fragment/connection budgets shared by every job on a worker and against an
+# upstream host. Per-job concurrency starts at SCHED_INITIAL_WINDOW and adapts
+# between 1 and SCHED_MAX_WINDOW; bandwidth caps are bytes/sec, 0 for none.
+app.config['SCHED_WORKER_FRAGMENTS'] = int(os.environ.get('SCHED_WORKER_FRAGMENTS', 16))
+app.config['SCHED_HOST_FRAGMENTS'] = int(os.environ.get('SCHED_HOST_FRAGMENTS', 32))
+app.config['SCHED_INITIAL_WINDOW'] = int(os.environ.get('SCHED_INITIAL_WINDOW', 4))
+app.config['SCHED_MAX_WINDOW'] = int(os.environ.get('SCHED_MAX_WINDOW', 16))
+app.config['HOST_BANDWIDTH_CAP'] = int(os.environ.get('HOST_BANDWIDTH_CAP', 0))
+app.config['WORKER_BANDWIDTH_CAP'] = int(os.environ.get('WORKER_BANDWIDTH_CAP', 0))
+scheduler = FragmentScheduler(
+    redis_client,
+    worker_budget=app.config['SCHED_WORKER_FRAGMENTS'],
+    host_budget=app.config['SCHED_HOST_FRAGMENTS'],
+    initial_window=app.config['SCHED_INITIAL_WINDOW'],
+    max_window=app.config['SCHED_MAX_WINDOW'],
+    host_bandwidth=app.config['HOST_BANDWIDTH_CAP'],
+    worker_bandwidth=app.config['WORKER_BANDWIDTH_CAP'],
+    grant_ttl=app.config['SINGLE_FLIGHT_TTL'],
+)
+
+# Single-file formats served over plain HTTP of at least RANGE_MIN_BYTES are
+# fetched as RANGE_CHUNK_SIZE byte ranges over the grant's connections, each
+# range retried RANGE_CHUNK_RETRIES times before the whole attempt fails
+app.config['RANGE_DOWNLOAD'] = os.environ.get('RANGE_DOWNLOAD', '1') == '1'
+app.config['RANGE_CHUNK_SIZE'] = int(os.environ.get('RANGE_CHUNK_SIZE', 8 * 1024 * 1024))
+app.config['RANGE_CHUNK_RETRIES'] = int(os.environ.get('RANGE_CHUNK_RETRIES', 3))
+app.config['RANGE_MIN_BYTES'] = int(os.environ.get('RANGE_MIN_BYTES', 16 * 1024 * 1024))
+
+# Transient yt-dlp failures are retried up to DOWNLOAD_MAX_RETRIES times,
+# resuming from the partial files, after a full-jitter exponential backoff of
+# at most RETRY_BACKOFF_MAX seconds. Storage waits don't count against it.
+app.config['DOWNLOAD_MAX_RETRIES'] = int(os.environ.get('DOWNLOAD_MAX_RETRIES', 5))
+app.config['RETRY_BACKOFF_BASE'] = int(os.environ.get('RETRY_BACKOFF_BASE', 5))
+app.config['RETRY_BACKOFF_MAX'] = int(os.environ.get('RETRY_BACKOFF_MAX', 300))
+
+# Per-task metadata lives in Redis for TASK_STATE_TTL seconds (as long as
+# Celery keeps results by default), so any web process can answer for any task
+app.config['TASK_STATE_TTL'] = int(os.environ.get('TASK_STATE_TTL', 24 * 60 * 60))
+task_store = TaskStore(redis_client, app.config['TASK_STATE_TTL'],
+                       alias_prefix=f'{single_flight.prefix}:alias:',
+                       result_prefix=celery.backend.task_keyprefix.decode())
+
+# External tools are discovered once per process (web and worker) and cached,
+# TOOL_PROBE_TTL > 0 re-checks them periodically
+app.config['YTDLP_BIN'] = os.environ.get('YTDLP_BIN', 'yt-dlp')
+app.config['FFMPEG_BIN'] = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+app.config['TOOL_PROBE_TTL'] = float(os.environ.get('TOOL_PROBE_TTL', 0)) or None
+tool_probe = ToolProbe({
+    'ffmpeg': (app.config['FFMPEG_BIN'], ['-version']),
+    'yt-dlp': (app.config['YTDLP_BIN'], ['--version']),
+}, ttl=app.config['TOOL_PROBE_TTL'])
+tool_probe.get()
+
+# 'inprocess' keeps a warm yt_dlp.YoutubeDL in each worker, 'subprocess' runs
+# the yt-dlp CLI per job
+app.config['DOWNLOAD_ENGINE'] = os.environ.get(
+    'DOWNLOAD_ENGINE', 'inprocess' if ytdlp_engine.AVAILABLE else 'subprocess')
+engine = ytdlp_engine.YtdlpEngine() if app.config['DOWNLOAD_ENGINE'] == 'inprocess' else None
 
 # Check if FFmpeg is installed
 def check_ffmpeg():
-    try:
-        subprocess.check_output(['ffmpeg', '-version'], stderr=subprocess.STDOUT)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        logger.error("FFmpeg is not installed or not in PATH")
-        return False
+    return tool_probe.available('ffmpeg')
 
 # Your HTML (same as before, with minor JS tweaks for better status messages)
 HTML = '''
@@ -422,9 +664,14 @@ HTML = '''
                     
                     const data = await response.json();
                     
-                    if (data.success) {
+                    if (data.success && data.cached) {
+                        loader.style.display = 'none';
+                        downloadBtn.disabled = false;
+                        showSuccess(data.message);
+                        downloadLink.innerHTML = `<a href="${data.download_url}" download>Click here to download the file</a>`;
+                    } else if (data.success) {
                         taskId = data.task_id;
-                        pollTaskStatus(taskId);
+                        watchTaskStatus(taskId);
                     } else {
                         showError(data.message);
                         loader.style.display = 'none';
@@ -437,6 +684,51 @@ HTML = '''
                 }
             });
             
+            // Apply a status update, returns true once the task is finished
+            function handleStatus(data) {
+                loaderText.textContent = data.status_message || 'Processing download...';
+                
+                if (data.status === 'SUCCESS') {
+                    loader.style.display = 'none';
+                    downloadBtn.disabled = false;
+                    if (data.success) {
+                        showSuccess(data.message);
+                        downloadLink.innerHTML = `<a href="${data.download_url}" download>Click here to download the file</a>`;
+                    } else {
+                        showError(data.message);
+                    }
+                    return true;
+                } else if (data.status === 'FAILURE' || data.status === 'REVOKED') {
+                    loader.style.display = 'none';
+                    downloadBtn.disabled = false;
+                    showError(data.message);
+                    return true;
+                }
+                return false;
+            }
+            
+            // Follow task status over Server-Sent Events, polling if that's unavailable
+            function watchTaskStatus(taskId) {
+                if (!window.EventSource) {
+                    pollTaskStatus(taskId);
+                    return;
+                }
+                const source = new EventSource(`/api/task_events/${taskId}`);
+                let finished = false;
+                source.onmessage = function(event) {
+                    if (handleStatus(JSON.parse(event.data))) {
+                        finished = true;
+                        source.close();
+                    }
+                };
+                source.onerror = function() {
+                    source.close();
+                    if (!finished) {
+                        pollTaskStatus(taskId);
+                    }
+                };
+            }
+            
             // Poll task status
             async function pollTaskStatus(taskId) {
                 const interval = setInterval(async () => {
@@ -444,23 +736,8 @@ HTML = '''
                         const response = await fetch(`/api/task_status/${taskId}`);
                         const data = await response.json();
                         
-                        loaderText.textContent = data.status_message || 'Processing download...';
-                        
-                        if (data.status === 'SUCCESS') {
-                            clearInterval(interval);
-                            loader.style.display = 'none';
-                            downloadBtn.disabled = false;
-                            if (data.success) {
-                                showSuccess(data.message);
-                                downloadLink.innerHTML = `<a href="${data.download_url}" download>Click here to download the file</a>`;
-                            } else {
-                                showError(data.message);
-                            }
-                        } else if (data.status === 'FAILURE') {
+                        if (handleStatus(data)) {
                             clearInterval(interval);
-                            loader.style.display = 'none';
-                            downloadBtn.disabled = false;
-                            showError(data.message);
                         }
                     } catch (error) {
                         clearInterval(interval);
@@ -495,90 +772,796 @@ HTML = '''
 </html>
 '''
 
+# The page has no template variables, so it is built once here: its CSS and
+# JS go to fingerprinted files under ASSET_PREFIX and everything is
+# compressed up front. Browsers revalidate the page on each visit (a 304 when
+# unchanged) and keep the fingerprinted files for ASSET_MAX_AGE seconds.
+app.config['ASSET_MAX_AGE'] = int(os.environ.get('ASSET_MAX_AGE', 365 * 24 * 60 * 60))
+ASSET_PREFIX = '/assets/'
+index_page, page_assets = build_assets(HTML, ASSET_PREFIX)
+
+# Each request gets a trace id (or continues the caller's X-Request-ID), which
+# its log lines and any task it enqueues carry
+@app.before_request
+def begin_request_trace():
+    g.trace_token = start_trace(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def add_trace_header(response):
+    response.headers['X-Trace-Id'] = trace_id()
+    return response
+
+@app.teardown_request
+def end_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
+
+# A prebuilt asset in the encoding the client prefers, or a 304
+def asset_response(asset, cache_control):
+    status, headers, body = asset.respond(request.headers.get('Accept-Encoding'),
+                                          request.headers.get('If-None-Match'), cache_control)
+    return Response(body, status=status, headers=headers)
+
+def asset_cache_control():
+    return f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+
 @app.route('/', methods=['GET'])
 def index():
-    return render_template_string(HTML)
+    return asset_response(index_page, 'no-cache')
+
+@app.route(f'{ASSET_PREFIX}<name>')
+def serve_asset(name):
+    asset = page_assets.get(name)
+    if asset is None:
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+    return asset_response(asset, asset_cache_control())
+
+# yt-dlp format selector describing a request, part of the cache key. The
+# actual format ids are resolved by formats.select_formats.
+def build_format_selector(download_type, quality):
+    if download_type == 'audio':
+        return 'bestaudio[ext=m4a]'
+    # Prioritize pre-merged MP4 if available, else merge with FFmpeg
+    if quality == 'best':
+        return 'bestvideo[vcodec^=avc1][height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best[vcodec^=avc1]'
+    return f'bestvideo[vcodec^=avc1][height<={quality}][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4][height<={quality}]/best[vcodec^=avc1][height<={quality}]'
+
+# Cache key for a request, None when the video id can't be read from the URL
+def cache_key_for(url, download_type, quality):
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    return DownloadCache.make_key(video_id, download_type, quality, build_format_selector(download_type, quality))
+
+# Cache lookups must never take the service down with them
+def cache_lookup(key):
+    if not key:
+        return None
+    try:
+        entry = download_cache.get(key)
+    except redis.RedisError as e:
+        logger.warning(f"Download cache lookup failed: {e}")
+        return None
+    metrics.inc('ytdl_cache_requests_total', cache='download', result='hit' if entry else 'miss')
+    return entry
 
+# Identical jobs share a flight key; speed only changes how, not what, is downloaded
+def flight_key_for(url, download_type, quality):
+    return cache_key_for(url, download_type, quality) or f'{url}|{download_type}|{quality or ""}'
+
+def release_flight(url, download_type, quality, task_id):
+    try:
+        single_flight.release(flight_key_for(url, download_type, quality), task_id)
+    except redis.RedisError as e:
+        logger.warning(f"Could not release in-flight lease for {task_id}: {e}")
+
+# Every finished file is indexed, even when no lookup can hit it, so its
+# bytes count against the quota and it can be evicted
+def cache_store(key, filename, format_selector):
+    try:
+        download_cache.put(key or DownloadCache.file_key(filename), filename, format_selector)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not add {filename} to download cache: {e}")
+
+# Name of the file yt-dlp reported for this job, relative to OUTDIR
+def output_filename(reported_path):
+    if not reported_path:
+        raise FileNotFoundError('No file downloaded')
+    filepath = os.path.realpath(reported_path)
+    if os.path.dirname(filepath) != os.path.realpath(OUTDIR) or not os.path.exists(filepath):
+        raise FileNotFoundError(f'Unexpected output file: {reported_path}')
+    return os.path.basename(filepath)
+
+TERMINAL_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+# Client facing status for a task state and its info/result
+def status_payload(state, info, pending_message='Waiting...'):
+    if state == 'PENDING':
+        return {'status': state, 'status_message': pending_message}
+    if state == 'SUCCESS':
+        response = {'status': state, 'success': info['success'], 'message': info['message']}
+        if info['success']:
+            response['download_url'] = info['download_url']
+        return response
+    if state in TERMINAL_STATES:
+        message = info.get('message', 'Task failed') if isinstance(info, dict) else (str(info) or 'Task failed')
+        return {'status': state, 'success': False, 'message': message}
+    if state == 'RETRY':
+        return {'status': state, 'status_message': 'Retrying shortly...'}
+    # PROGRESS, or STARTED which carries no meta of its own
+    info = info if isinstance(info, dict) else {}
+    response = {'status': state, 'status_message': info.get('status_message', 'Processing...')}
+    if info.get('progress'):
+        response['progress'] = info['progress']
+    return response
+
+def task_events_channel(task_id):
+    return f'task-events:{task_id}'
+
+# Pushes a status change to anyone streaming /api/task_events for the task
+def publish_status(task_id, payload):
+    try:
+        redis_client.publish(task_events_channel(task_id), json.dumps(payload))
+    except redis.RedisError as e:
+        logger.warning(f"Could not publish status for {task_id}: {e}")
+
+def set_progress(task, meta, task_id=None):
+    task_id = task_id or task.request.id
+    task.update_state(task_id=task_id, state='PROGRESS', meta=meta)
+    publish_status(task_id, status_payload('PROGRESS', meta))
+
+# Metadata for a URL from the configured engine
+def extract_info(url):
+    if engine is not None:
+        return engine.extract_info(url)
+    return extract_info_cli(app.config['YTDLP_BIN'], url)
+
+# Flat listing of a playlist or channel from the configured engine
+def extract_playlist(url):
+    if engine is not None:
+        return engine.extract_playlist(url)
+    return extract_playlist_cli(app.config['YTDLP_BIN'], url)
+
+# Metadata for a URL, extracted at most once per INFO_CACHE_TTL across all processes
+def cached_extract_info(url):
+    key = extract_video_id(url) or url
+    extracted = []
+
+    def extract():
+        extracted.append(True)
+        return extract_info(url)
+
+    try:
+        info = info_cache.get_or_extract(key, extract, failures=YtdlpError,
+                                         permanent=lambda e: not is_transient(e.output))
+    except redis.RedisError as e:
+        logger.warning(f"Info cache unavailable, extracting directly: {e}")
+        return extract_info(url)
+    metrics.inc('ytdl_cache_requests_total', cache='info', result='miss' if extracted else 'hit')
+    return info
+
+# Runs one yt-dlp job from an extracted info dict with the configured engine
+# and returns the output path
+def run_download(args, on_progress=None, info=None):
+    if engine is not None:
+        return engine.download(args, on_progress, info=info)
+    return run_ytdlp_with_info([app.config['YTDLP_BIN']] + STREAM_ARGS + args, info, on_progress)
+
+# Pushes structured yt-dlp progress into the task state, throttled. The id
+# is taken up front, progress can come from threads without the task context.
+def progress_reporter(task, label):
+    task_id = task.request.id
+    def report(progress):
+        set_progress(task, {
+            'status_message': describe_progress(label, progress),
+            'progress': progress,
+        }, task_id)
+    return ProgressThrottle(report, app.config['PROGRESS_INTERVAL'])
+
+# Runs a download under a fragment grant from the scheduler and feeds the
+# outcome (bytes, time, throttling) back into the upstream host's window
+def scheduled_download(task, speed, format_selector, output_template, on_progress, info):
+    grant = scheduler.acquire(upstream_host(info, format_selector), task.request.hostname or 'local', speed)
+    output = None
+    throttled = False
+    # What an earlier attempt left on disk was not fetched under this grant
+    resumed = bytes_on_disk(output_template, info, format_selector)
+    try:
+        output = range_download(grant, format_selector, output_template, on_progress, info)
+        if output is None:
+            output = run_download(grant.ytdlp_args() + ['-f', format_selector, '-o', output_template],
+                                  on_progress, info=info)
+        return output
+    except YtdlpError as e:
+        throttled = is_throttled(e.output)
+        raise
+    finally:
+        fetched = bytes_on_disk(output_template, info, format_selector) - resumed
+        scheduler.release(grant, max(0, fetched), throttled)
+
+# A progressive (one plain HTTP file) format gets the grant's connections as
+# parallel byte ranges, which yt-dlp only does for fragmented formats.
+# Returns None when the format is left to yt-dlp.
+def range_download(grant, format_selector, output_template, on_progress, info):
+    formats = formats_by_id(info)
+    fmt = formats.get(format_selector)
+    if not app.config['RANGE_DOWNLOAD'] or grant.fragments < 2 or not fmt or not rangeable(fmt):
+        return None
+    size = fmt.get('filesize')
+    if (size or fmt.get('filesize_approx') or 0) < app.config['RANGE_MIN_BYTES']:
+        return None
+    path = output_path(output_template, info, fmt)
+    if os.path.exists(path):
+        return path
+    downloader = RangeDownloader(grant.fragments, app.config['RANGE_CHUNK_SIZE'], app.config['RANGE_CHUNK_RETRIES'],
+                                 rate_limit=grant.rate_limit)
+    try:
+        return downloader.download(fmt['url'], path, headers=fmt.get('http_headers'), size=size,
+                                   on_progress=on_progress)
+    except RangesUnsupported as e:
+        logger.debug(f"{e}, downloading with yt-dlp")
+        return None
+
+# Reserves disk space for a job's output, see StorageManager
+def reserve_storage(task_id, info, format_selector):
+    size = estimate_size(info, format_selector) or app.config['STORAGE_UNKNOWN_SIZE']
+    if '+' in format_selector:
+        size *= 2  # the separate streams and the merged file are on disk together for a while
+    try:
+        storage.reserve(task_id, size)
+    except redis.RedisError as e:
+        logger.warning(f"Storage bookkeeping unavailable, not reserving for {task_id}: {e}")
+
+def release_storage(task_id):
+    try:
+        storage.release(task_id)
+    except redis.RedisError as e:
+        logger.warning(f"Could not release storage reservation of {task_id}: {e}")
+
+# Finished downloads of the same video, candidates for building an output
+# without going to the network
+def local_entries(video_id):
+    try:
+        return download_cache.entries_for(video_id)
+    except redis.RedisError as e:
+        logger.warning(f"Download cache unavailable, not looking for local sources: {e}")
+        return []
+
+# Metadata kept with the finished files of the video at url, when those files
+# alone can produce the job's output (linked, or remuxed by postprocess_task),
+# so it can be built without extracting again. None otherwise.
+def local_info(url, download_type, quality):
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    try:
+        info = download_cache.info_for(video_id)
+    except redis.RedisError as e:
+        logger.warning(f"Download cache unavailable, extracting {url}: {e}")
+        return None
+    if info is None:
+        return None
+    try:
+        format_selector, _ = select_formats(info, download_type, quality)
+    except FormatUnavailable:
+        return None
+    entries = local_entries(video_id)
+    if any(entry.get('selector') == format_selector for entry in entries):
+        return info
+    # A pre-muxed video is downloaded as the final file, there is nothing to remux
+    if download_type == 'video' and '+' not in format_selector:
+        return None
+    local = local_streams(info, format_selector, entries)
+    return info if all(format_id in local for format_id in format_selector.split('+')) else None
+
+def remember_info(info):
+    try:
+        download_cache.put_info(info['id'], info)
+    except redis.RedisError as e:
+        logger.warning(f"Could not keep metadata of {info['id']}: {e}")
+
+# Keeps a file a job reads from at the young end of the LRU until it is done
+def touch_local(filename):
+    try:
+        download_cache.touch_file(filename)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record access to {filename}: {e}")
+
+# Keeps files from being evicted while holder (a task id, or one per
+# response) is using them
+def pin_files(holder, filenames):
+    try:
+        download_cache.pin(holder, filenames, app.config['STORAGE_PIN_TTL'])
+    except redis.RedisError as e:
+        logger.warning(f"Could not pin {filenames}: {e}")
+
+def unpin_files(holder, filenames):
+    try:
+        download_cache.unpin(holder, filenames)
+    except redis.RedisError as e:
+        logger.warning(f"Could not unpin {filenames}: {e}")
+
+# Part of an output name that keeps different qualities of the same video
+# from overwriting each other
+def output_tag(download_type, quality):
+    return 'audio' if download_type == 'audio' else (quality if quality == 'best' else f'{quality}p')
+
+# <title>-<id>-<tag> for a job, from the name of any file of the same video
+def job_base(path, video_id, tag):
+    name = os.path.basename(path)
+    return os.path.join(OUTDIR, name[:name.rindex(f'-{video_id}-') + len(video_id) + 2] + tag)
+
+# Gives a finished file the name of another request that resolved to the
+# same formats. A hard link costs no space (the cache still counts it twice),
+# filesystems without them get a copy.
+def link_output(filename, video_id, tag):
+    source = os.path.join(OUTDIR, filename)
+    target = job_base(source, video_id, tag) + os.path.splitext(filename)[1]
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return target
+    temp = job_base(source, video_id, tag) + '.temp' + os.path.splitext(filename)[1]
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, target)
+    return target
+
+# Where a format of a job lands, and the files yt-dlp or RangeDownloader keep
+# next to it until it is complete: .part, .ytdl resume state, .rpart with its
+# chunk list, and one .part-FragN per fragment of a fragmented format. HLS
+# formats don't list their fragments, the .ytdl file says how far it got.
+def format_files(template, info, format_id):
+    formats = formats_by_id(info)
+    fmt = formats.get(format_id) or {'format_id': format_id}
+    path = output_path(template, info, fmt)
+    count = len(fmt.get('fragments') or [])
+    try:
+        with open(f'{path}.ytdl') as f:
+            state = json.load(f)['downloader']['current_fragment']['index']
+        count = max(count, state + app.config['SCHED_MAX_WINDOW'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    partials = [path + suffix for suffix in ('.part', '.ytdl', '.rpart', '.rpart.chunks')]
+    for index in range(count + 1):
+        partials += [f'{path}.part-Frag{index}', f'{path}.part-Frag{index}.part']
+    return path, partials
+
+# Bytes of a format a transfer got so far, finished or not: the file itself,
+# else its .part (or fragments) or the chunks RangeDownloader wrote
+def bytes_on_disk(template, info, format_id):
+    path, partials = format_files(template, info, format_id)
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    total = fetched_bytes(path)
+    for partial in partials:
+        if (partial.endswith('.part') or '.part-Frag' in partial) and os.path.exists(partial):
+            total += os.path.getsize(partial)
+    return total
+
+# Removes the files a job recorded as its own. Named one by one, so the cost
+# doesn't grow with the number of files in OUTDIR.
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove partial file {path}: {e}")
+
+# Per-phase timings, throughput and size of a finished transfer
+def record_job_metrics(download_type, timer, outputs):
+    durations = timer.finish()
+    for phase, seconds in durations.items():
+        metrics.observe('ytdl_phase_duration_seconds', seconds, phase=phase)
+    size = sum(os.path.getsize(output) for output in outputs if output and os.path.exists(output))
+    if size:
+        metrics.observe('ytdl_output_bytes', size, type=download_type)
+        if durations.get('download'):
+            metrics.observe('ytdl_transfer_bytes_per_second', size / durations['download'], type=download_type)
+
+# Time a task waited in its queue, retries excluded
+def observe_queue_latency(task):
+    enqueued_at = task_header(task, 'enqueued_at')
+    if enqueued_at and not task.request.retries:
+        metrics.observe('ytdl_queue_latency_seconds', max(0, time.time() - enqueued_at),
+                        queue=(task.request.delivery_info or {}).get('routing_key') or 'unknown')
+
+# Schedules another attempt of a download that failed transiently, after a
+# full-jitter exponential backoff. attempt counts earlier transient retries only.
+def retry_transient(task, url, error, output, attempt):
+    metrics.inc('ytdl_retries_total', reason='transient')
+    countdown = get_exponential_backoff_interval(app.config['RETRY_BACKOFF_BASE'], attempt,
+                                                 app.config['RETRY_BACKOFF_MAX'], full_jitter=True)
+    logger.warning(f"Transient failure for {url}, retry {attempt + 1} in {countdown}s: {output}")
+    # Expired format URLs and negatively cached network errors must not outlive the attempt
+    try:
+        info_cache.invalidate(extract_video_id(url) or url)
+    except redis.RedisError as redis_error:
+        logger.warning(f"Could not invalidate info cache for {url}: {redis_error}")
+    publish_status(task.request.id, {'status': 'RETRY', 'status_message': f'Connection problem, retrying in {countdown}s...'})
+    return task.retry(exc=error, countdown=countdown, max_retries=retry_budget(), headers={'trace_id': trace_id()})
+
+# Celery's cap on self.request.retries. download_task enforces the separate
+# budgets of storage waits and transient retries itself.
+def retry_budget():
+    return app.config['DOWNLOAD_MAX_RETRIES'] + app.config['STORAGE_MAX_WAITS']
+
+# storage_waits counts the retries spent waiting for disk space, the rest of
+# self.request.retries were transient failures
 @celery.task(bind=True)
-def download_task(self, url, download_type, quality, speed):
+def download_task(self, url, download_type, quality, speed, storage_waits=0):
     logger.debug(f"Starting download task: {url}, type={download_type}, quality={quality}, speed={speed}")
+    observe_queue_latency(self)
     
     if not check_ffmpeg():
         return {'success': False, 'message': 'FFmpeg is not installed. Please install FFmpeg and add it to PATH.'}
     
-    speed_flag = ''
-    if speed == 'fast':
-        speed_flag = '--concurrent-fragments 2'
-    elif speed == 'max':
-        speed_flag = '--concurrent-fragments 3'  # Reduced for stability
-    
-    cmd_base = ['yt-dlp', '--no-part', '--no-continue'] + (speed_flag.split() if speed_flag else [])
-    output_template = os.path.join(OUTDIR, '%(title)s-%(id)s.%(ext)s')
+    # Both engines report the final path once the file is in place, so we never have to look for it.
+    # Fragment concurrency and rate limits come from the scheduler, speed only sets how much it asks for.
+    # Partial files are kept so a retry resumes where the last attempt stopped.
+    tag = output_tag(download_type, quality)
+    output_template = os.path.join(OUTDIR, f'%(title)s-%(id)s-{tag}.%(ext)s')
+    # Streams that still need muxing or tagging are downloaded untouched, one
+    # format at a time, and finished by postprocess_task in a single ffmpeg pass
+    # instead of one yt-dlp post-processor (and one full rewrite) after another
+    stream_template = os.path.join(OUTDIR, f'%(title)s-%(id)s-{tag}.f%(format_id)s.%(ext)s')
+    cache_key = cache_key_for(url, download_type, quality)
+    info = None
+    retrying = False
+    handoff = None
+    fetched = []  # (template, format id) of every transfer, cleaned up if the job fails
+    pinned = []  # finished files of other downloads this job reads from
 
     try:
+        if download_type == 'video' and not quality:
+            raise ValueError('Quality is required for video')
+
+        # One extraction, one format decision, one transfer
+        set_progress(self, {'status_message': 'Fetching video info...'})
+        info = local_info(url, download_type, quality)
+        if info is None:
+            started = time.monotonic()
+            info = cached_extract_info(url)
+            metrics.observe('ytdl_phase_duration_seconds', time.monotonic() - started, phase='extract')
+        format_selector, used_fallback = select_formats(info, download_type, quality)
+        if used_fallback:
+            metrics.inc('ytdl_format_fallbacks_total')
+        reserve_storage(self.request.id, info, format_selector)
+
         if download_type == 'audio':
-            self.update_state(state='PROGRESS', meta={'status_message': 'Downloading audio...'})
-            cmd = cmd_base + [
-                '-f', 'bestaudio[ext=m4a]',
-                '--embed-thumbnail', '--add-metadata',
-                '-o', output_template, url
-            ]
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            label = 'Downloading audio...'
             message = 'Audio download completed successfully!'
-        elif download_type == 'video':
-            if not quality:
-                raise ValueError('Quality is required for video')
-            
-            self.update_state(state='PROGRESS', meta={'status_message': f'Downloading {quality}p video...'})
+        else:
             # Prioritize pre-merged MP4 if available, else merge with FFmpeg
-            if quality == 'best':
-                cmd = cmd_base + [
-                    '-f', 'bestvideo[vcodec^=avc1][height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best[vcodec^=avc1]',
-                    '--merge-output-format', 'mp4',
-                    '-o', output_template, url
-                ]
+            label = f'Downloading {quality}p video...'
+            if used_fallback:
+                message = 'Fallback video download completed! (H.264 compatible)'
             else:
-                cmd = cmd_base + [
-                    '-f', f'bestvideo[vcodec^=avc1][height<={quality}][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4][height<={quality}]/best[vcodec^=avc1][height<={quality}]',
-                    '--merge-output-format', 'mp4',
-                    '-o', output_template, url
-                ]
-            try:
-                output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
                 message = 'Video download completed successfully! (H.264 compatible)'
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"Primary video download failed: {e.output.decode()}")
-                self.update_state(state='PROGRESS', meta={'status_message': 'Trying fallback method...'})
-                if quality == 'best':
-                    fallback_cmd = cmd_base + [
-                        '-f', 'bv*[vcodec^=avc1][ext=mp4]+ba[ext=m4a]/b[vcodec^=avc1]',
-                        '--merge-output-format', 'mp4',
-                        '-o', output_template, url
-                    ]
-                else:
-                    fallback_cmd = cmd_base + [
-                        '-f', f'bv*[vcodec^=avc1][height<={quality}][ext=mp4]+ba[ext=m4a]/b[vcodec^=avc1][height<={quality}]',
-                        '--merge-output-format', 'mp4',
-                        '-o', output_template, url
-                    ]
-                output = subprocess.check_output(fallback_cmd, stderr=subprocess.STDOUT)
-                message = 'Fallback video download completed! (H.264 compatible)'
-        
-        # Find the downloaded file
-        files = sorted(os.listdir(OUTDIR), key=lambda f: os.path.getmtime(os.path.join(OUTDIR, f)), reverse=True)
-        filename = files[0] if files else None
-        if not filename:
-            raise FileNotFoundError('No file downloaded')
-        
-        logger.debug(f"Download completed: {filename}")
-        return {'success': True, 'message': message, 'download_url': f'/downloads/{filename}'}
+        set_progress(self, {'status_message': label})
+        on_progress = timer = PhaseTimer(progress_reporter(self, label))
+
+        # Other downloads of this video may already hold what this one needs
+        entries = local_entries(info['id'])
+        same = next((entry for entry in entries if entry.get('selector') == format_selector), None)
+        if same:
+            # Another request resolved to the very same formats
+            pinned.append(same['filename'])
+            pin_files(self.request.id, pinned)
+            filename = os.path.basename(link_output(same['filename'], info['id'], tag))
+            metrics.inc('ytdl_local_derivations_total', how='link')
+            logger.debug(f"Reused {same['filename']} as {filename}")
+            cache_store(cache_key, filename, format_selector)
+            return {'success': True, 'message': message, 'download_url': f'/downloads/{filename}', 'filename': filename}
+
+        if download_type == 'video' and '+' not in format_selector:
+            # Pre-muxed, the file is final as downloaded
+            fetched.append((output_template, format_selector))
+            output = scheduled_download(self, speed, format_selector, output_template, on_progress, info)
+            remember_info(info)
+            record_job_metrics(download_type, timer, [output])
+            filename = output_filename(output)
+            logger.debug(f"Download completed: {filename}")
+            cache_store(cache_key, filename, format_selector)
+            return {'success': True, 'message': message, 'download_url': f'/downloads/{filename}', 'filename': filename}
+
+        # Formats found in a finished file are taken from it by the ffmpeg
+        # pass (e.g. the m4a track of a merged video), only the rest is fetched
+        local = local_streams(info, format_selector, entries)
+        pinned.extend(sorted(set(filename for filename, _ in local.values())))
+        pin_files(self.request.id, pinned)
+        streams, maps, downloaded = [], [], []
+        for format_id in format_selector.split('+'):
+            if format_id in local:
+                filename, stream = local[format_id]
+                touch_local(filename)
+                streams.append(os.path.join(OUTDIR, filename))
+                maps.append(stream)
+                continue
+            fetched.append((stream_template, format_id))
+            path = scheduled_download(self, speed, format_id, stream_template, on_progress, info)
+            streams.append(os.path.join(OUTDIR, output_filename(path)))
+            maps.append(None)
+            downloaded.append(streams[-1])
+        if downloaded:
+            record_job_metrics(download_type, timer, downloaded)
+        if local:
+            metrics.inc('ytdl_local_derivations_total', how='partial' if downloaded else 'remux')
+            logger.debug(f"Taking {sorted(local)} from files on disk: {sorted(set(f for f, _ in local.values()))}")
+        remember_info(info)
+        base = job_base(streams[0], info['id'], tag)
+        if download_type == 'audio':
+            handoff = {
+                'output': f'{base}.m4a',
+                'metadata': metadata_for(info),
+                'thumbnail': fetch_thumbnail(thumbnail_url(info), f'{base}.thumb'),
+            }
+        else:
+            handoff = {'output': f'{base}.mp4', 'metadata': {}, 'thumbnail': None}
+        # What postprocess_task deletes once it is done: the fetched streams
+        # (never the local sources, other downloads own them), the thumbnail
+        # and the unfinished output of a pass that died
+        cleanup = downloaded + [handoff['thumbnail'], '.temp'.join(os.path.splitext(handoff['output']))]
+        handoff.update(streams=streams, maps=maps, video_streams=0 if download_type == 'audio' else 1,
+                       cache_key=cache_key, format_selector=format_selector, message=message,
+                       cleanup=[path for path in cleanup if path], pinned=pinned)
+        logger.debug(f"Handing over to post-processing: {streams}")
     
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Download failed: {e.output.decode()}")
-        return {'success': False, 'message': f'Download failed: {e.output.decode()}'}
+    except YtdlpError as e:
+        transient = is_transient(e.output)
+        metrics.inc('ytdl_failures_total', reason='transient' if transient else 'download')
+        if transient and self.request.retries - storage_waits < app.config['DOWNLOAD_MAX_RETRIES']:
+            retrying = True
+            raise retry_transient(self, url, e, e.output, self.request.retries - storage_waits)
+        logger.error(f"Download failed: {e.output}")
+        return {'success': False, 'message': f'Download failed: {e.output}'}
+    except CachedExtractionError as e:
+        metrics.inc('ytdl_failures_total', reason='extraction')
+        if is_transient(str(e)) and self.request.retries - storage_waits < app.config['DOWNLOAD_MAX_RETRIES']:
+            retrying = True
+            raise retry_transient(self, url, e, str(e), self.request.retries - storage_waits)
+        logger.error(f"Extraction recently failed for {url}: {e}")
+        return {'success': False, 'message': f'Download failed: {e}'}
+    except FormatUnavailable as e:
+        metrics.inc('ytdl_failures_total', reason='format')
+        logger.error(f"No usable format for {url}: {e}")
+        return {'success': False, 'message': f'Download failed: {e}'}
+    except StorageFull as e:
+        metrics.inc('ytdl_failures_total', reason='storage')
+        if not e.permanent and storage_waits < app.config['STORAGE_MAX_WAITS']:
+            retrying = True
+            metrics.inc('ytdl_retries_total', reason='storage')
+            logger.warning(f"No room for {url} yet, waiting: {e}")
+            publish_status(self.request.id, {'status': 'RETRY', 'status_message': 'Waiting for storage space...'})
+            raise self.retry(exc=e, countdown=app.config['STORAGE_RETRY_DELAY'], max_retries=retry_budget(),
+                             kwargs=dict(self.request.kwargs or {}, storage_waits=storage_waits + 1),
+                             headers={'trace_id': trace_id()})
+        logger.error(f"No storage for {url}: {e}")
+        return {'success': False, 'message': f'Download failed: {e}'}
     except Exception as e:
+        metrics.inc('ytdl_failures_total', reason='unexpected')
         logger.error(f"Unexpected error: {str(e)}")
         return {'success': False, 'message': f'Unexpected error: {str(e)}'}
+    finally:
+        # postprocess_task takes over the reservation, the lease, the pins and the files
+        if handoff is None:
+            release_storage(self.request.id)
+            unpin_files(self.request.id, pinned)
+        # A retry keeps the lease (same task id) and the partial files
+        if not retrying and handoff is None:
+            release_flight(url, download_type, quality, self.request.id)
+            for template, format_id in fetched:
+                path, partials = format_files(template, info, format_id)
+                # A finished stream is useless without the rest, a pre-muxed file never exists unfinished
+                remove_files(partials + [path] if template == stream_template else partials)
+
+    # The post-processing task inherits this task's id, so clients keep
+    # following the same task until the final file is ready
+    queue = app.config['POSTPROCESS_QUEUE']
+    return self.replace(postprocess_task.si(url, download_type, quality, handoff).set(
+        queue=queue, priority=app.config['JOB_QUEUES'][queue]['priority'], headers=task_headers()))
+
+# Finishes a job download_task handed over: merge, tags and thumbnail in one
+# stream-copy ffmpeg pass, then the file is published like any other download
+@celery.task(bind=True)
+def postprocess_task(self, url, download_type, quality, job):
+    observe_queue_latency(self)
+    phase = 'merge' if len(job['streams']) > 1 else 'embed'
+    set_progress(self, {'status_message': describe_progress('', {'phase': phase}), 'progress': {'phase': phase}})
+    started = time.monotonic()
+    try:
+        output = run_postprocess(app.config['FFMPEG_BIN'], job['streams'], job['output'], job['metadata'],
+                                 job['thumbnail'], job['video_streams'], job.get('maps'))
+        metrics.observe('ytdl_phase_duration_seconds', time.monotonic() - started, phase='postprocess')
+        filename = output_filename(output)
+        logger.debug(f"Download completed: {filename}")
+        cache_store(job['cache_key'], filename, job['format_selector'])
+        return {'success': True, 'message': job['message'], 'download_url': f'/downloads/{filename}', 'filename': filename}
+    except FFmpegError as e:
+        metrics.inc('ytdl_failures_total', reason='postprocess')
+        logger.error(f"Post-processing failed: {e.output}")
+        return {'success': False, 'message': f'Post-processing failed: {e.output}'}
+    except Exception as e:
+        metrics.inc('ytdl_failures_total', reason='unexpected')
+        logger.error(f"Unexpected error: {str(e)}")
+        return {'success': False, 'message': f'Unexpected error: {str(e)}'}
+    finally:
+        release_storage(self.request.id)
+        release_flight(url, download_type, quality, self.request.id)
+        unpin_files(self.request.id, job.get('pinned', ()))
+        # The streams, thumbnail and any unfinished output, never the final file
+        remove_files(job.get('cleanup', ()))
+
+# Build the warm yt-dlp instance before the first job reaches a worker process
+@worker_process_init.connect
+def warm_engine(**kwargs):
+    if engine is not None:
+        engine.warm()
+
+# Tasks continue the trace of the request that enqueued them. Keyed by task
+# name too: a task replaced by another (download_task handing over to
+# postprocess_task) shares its id, and the replacement may start before the
+# replaced one's postrun.
+_task_traces = {}
+
+@task_prerun.connect
+def start_task_trace(sender=None, task_id=None, task=None, **kwargs):
+    _task_traces[task_id, sender.name] = start_trace(task_header(task, 'trace_id'))
+
+@task_postrun.connect
+def end_task_trace(sender=None, task_id=None, **kwargs):
+    token = _task_traces.pop((task_id, sender.name), None)
+    if token is not None:
+        end_trace(token)
+
+# Headers every enqueued task carries: the trace to continue and when it was
+# queued, for the queue latency histogram
+def task_headers():
+    return {'trace_id': trace_id(), 'enqueued_at': time.time()}
+
+# Workers expose custom headers on the request itself, eager runs under request.headers
+def task_header(task, name):
+    return task.request.get(name) or (task.request.headers or {}).get(name)
+
+# The final state is only known once the task has returned
+@task_postrun.connect
+def publish_final_status(sender=None, task_id=None, args=None, retval=None, state=None, **kwargs):
+    if sender.name not in (download_task.name, postprocess_task.name):
+        return
+    # Eviction happens here, off the request path, once the worker is done with the job
+    try:
+        storage.maybe_sweep()
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Storage sweep failed: {e}")
+    if state in TERMINAL_STATES:
+        release_admission(task_id)
+        publish_status(task_id, status_payload(state, retval))
+        result = retval if isinstance(retval, dict) else {'success': False, 'message': str(retval)}
+        metrics.inc('ytdl_jobs_total', type=args[1] if args else 'unknown',
+                    outcome='success' if result.get('success') else 'failure')
+        for batch_id, index in batch_store.pop_waiters(task_id):
+            if not batch_store.finish_item(batch_id, index, result):
+                fill_batch(batch_id)
+
+# Checks a download request, returns an error response or None
+def validate_download_request(data):
+    if not data.get('url'):
+        return jsonify({'success': False, 'message': 'URL is required'}), 400
+    if data.get('type') not in ['video', 'audio']:
+        return jsonify({'success': False, 'message': 'Invalid download type'}), 400
+    if data.get('type') == 'video' and not data.get('quality'):
+        return jsonify({'success': False, 'message': 'Quality is required for video'}), 400
+    quality = data.get('quality')
+    if quality and quality != 'best' and not str(quality).isdigit():
+        return jsonify({'success': False, 'message': 'Invalid quality'}), 400
+    return None
+
+# Picks the job class, and so the queue, of a single download. Size comes
+# from metadata already in the info cache (e.g. from /api/formats).
+def classify_job(url, download_type, quality):
+    if download_type == 'audio':
+        return 'audio'
+    try:
+        info = info_cache.get(extract_video_id(url) or url)
+        if info:
+            size = estimate_size(info, select_formats(info, download_type, quality)[0])
+            if size is not None:
+                return 'small' if size <= app.config['SMALL_JOB_MAX_BYTES'] else 'large'
+    except (CachedExtractionError, FormatUnavailable):
+        return 'small'  # fails fast once it runs
+    except redis.RedisError as e:
+        logger.warning(f"Info cache unavailable, routing without metadata: {e}")
+    if quality != 'best' and int(quality) <= app.config['SMALL_JOB_MAX_HEIGHT']:
+        return 'small'
+    return 'large'
+
+# Who a request counts against for admission control
+def request_client():
+    header = app.config['ADMISSION_CLIENT_HEADER']
+    return client_id(request.headers.get(header) if header else None, request.remote_addr)
+
+# Proxies append, so only the last ADMISSION_TRUSTED_HOPS entries can be
+# trusted. A header with fewer entries did not come through all of them.
+def client_id(forwarded, remote_addr):
+    entries = [entry.strip() for entry in (forwarded or '').split(',') if entry.strip()]
+    hops = app.config['ADMISSION_TRUSTED_HOPS']
+    if hops > 0 and len(entries) >= hops:
+        return entries[-hops]
+    return remote_addr or 'unknown'
+
+# Admission state lives in Redis; when it is unreachable requests are let
+# through rather than failing the API
+def take_admission_token(client):
+    try:
+        admission.take_token(client)
+    except redis.RedisError as e:
+        logger.warning(f"Admission control unavailable, not rate limiting {client}: {e}")
+
+# Admits a job and returns how many priority steps back it goes (fair share)
+def admit_job(client, task_id):
+    try:
+        return min(admission.admit(client, task_id), app.config['FAIR_SHARE_MAX_PENALTY'])
+    except redis.RedisError as e:
+        logger.warning(f"Admission control unavailable, admitting {task_id}: {e}")
+        return 0
+
+def release_admission(task_id):
+    try:
+        admission.release(task_id)
+    except redis.RedisError as e:
+        logger.warning(f"Could not release admission of {task_id}: {e}")
+
+# Enqueues a download unless an identical one is cached or already running.
+# Returns (task id, id of the task doing the work, cache entry). A client's
+# job is enqueued only if admission control lets it in, otherwise
+# AdmissionRejected is raised.
+def submit_download(url, download_type, quality, speed, task_id=None, queue=None, client=None):
+    # Serve straight from the cache when an identical download already exists
+    cached = cache_lookup(cache_key_for(url, download_type, quality))
+    if cached:
+        logger.debug(f"Download cache hit: {cached['filename']}")
+        return None, None, cached
+
+    # Every caller gets its own task id, but only the first one for an
+    # identical job actually enqueues it. Admission comes first: a leader
+    # turned away after joining would leave its followers waiting on a task
+    # that is never enqueued.
+    task_id = task_id or str(uuid.uuid4())
+    penalty = admit_job(client, task_id) if client is not None else 0
+    flight_key = flight_key_for(url, download_type, quality)
+    leader_id = single_flight.join(flight_key, task_id)
+    if leader_id != task_id:
+        # Following a running job costs nothing, the slot goes back
+        if client is not None:
+            release_admission(task_id)
+        return task_id, leader_id, None
+    # Anything failing before the job is enqueued must give the lease back,
+    # or every identical request would wait on a task that never runs
+    try:
+        queue = queue or classify_job(url, download_type, quality)
+        priority = min(9, app.config['JOB_QUEUES'][queue]['priority'] + penalty)
+        download_task.apply_async(args=[url, download_type, quality, speed], task_id=task_id, queue=queue,
+                                  priority=priority, headers=task_headers())
+    except Exception as e:
+        single_flight.release(flight_key, task_id)
+        if client is not None:
+            release_admission(task_id)
+        fail_unqueued(task_id, f'Could not start download: {e}')
+        raise
+    return task_id, leader_id, None
+
+# Gives followers that joined a job which then could not be enqueued the
+# final status they are waiting for
+def fail_unqueued(task_id, message):
+    result = {'success': False, 'message': message}
+    try:
+        download_task.backend.store_result(task_id, result, 'SUCCESS')
+        publish_status(task_id, status_payload('SUCCESS', result))
+    except redis.RedisError as e:
+        logger.warning(f"Could not record that {task_id} was never enqueued: {e}")
 
 @app.route('/api/download', methods=['POST'])
 def api_download():
@@ -586,44 +1569,477 @@ def api_download():
         return jsonify({'success': False, 'message': 'FFmpeg is not installed. Please install FFmpeg and add it to PATH.'}), 500
     
     data = request.json
-    url = data.get('url')
-    download_type = data.get('type')
-    quality = data.get('quality')
-    speed = data.get('speed')
+    error = validate_download_request(data)
+    if error:
+        return error
 
-    if not url:
-        return jsonify({'success': False, 'message': 'URL is required'}), 400
-    if download_type not in ['video', 'audio']:
-        return jsonify({'success': False, 'message': 'Invalid download type'}), 400
-    if download_type == 'video' and not quality:
-        return jsonify({'success': False, 'message': 'Quality is required for video'}), 400
+    client = request_client()
+    try:
+        return jsonify(start_download(data, client))
+    except AdmissionRejected as e:
+        return admission_error(e, client)
 
-    task = download_task.apply_async(args=[url, download_type, quality, speed])
-    TASKS[task.id] = {'status': 'PENDING', 'message': 'Starting download...'}
-    
-    return jsonify({'success': True, 'task_id': task.id})
+# Counts a request admission control turned away and returns the JSON body
+# and headers of its 429, for the Flask and the ASGI app alike
+def admission_rejection(e, client):
+    metrics.inc('ytdl_admission_rejections_total', reason=e.reason)
+    logger.info(f"Turned away {client}: {e}")
+    return {'success': False, 'message': str(e)}, [('Retry-After', str(e.retry_after))]
+
+def admission_error(e, client):
+    payload, headers = admission_rejection(e, client)
+    return jsonify(payload), 429, headers
+
+# Submits a validated /api/download request and returns its JSON payload.
+# Raises AdmissionRejected when the client has to come back later.
+def start_download(data, client):
+    take_admission_token(client)
+    task_id, _, cached = submit_download(data['url'], data['type'], data.get('quality'), data.get('speed'),
+                                         client=client)
+    if cached:
+        return {
+            'success': True,
+            'cached': True,
+            'message': 'Download ready (served from cache)',
+            'download_url': f"/downloads/{cached['filename']}",
+        }
+    task_store.create(task_id, message='Starting download...', url=data['url'], type=data['type'],
+                      quality=data.get('quality'))
+    return {'success': True, 'task_id': task_id}
+
+# Starts one batch item, returns its result if it finished right away. Each
+# item is a job of the client that submitted the batch; AdmissionRejected is
+# raised when that client is at its limit.
+def start_batch_item(batch_id, meta, index, item):
+    task_id = str(uuid.uuid4())
+    task_store.create(task_id, message='Starting download...', url=item['url'], type=meta['type'],
+                      quality=meta.get('quality'), batch=batch_id)
+    # Registered before enqueueing so a fast task can't finish unnoticed
+    batch_store.update_item(batch_id, index, dict(item, task_id=task_id, status='RUNNING'))
+    batch_store.add_waiter(task_id, batch_id, index)
+    try:
+        task_id, leader_id, cached = submit_download(item['url'], meta['type'], meta.get('quality') or None,
+                                                     meta.get('speed') or None, task_id=task_id,
+                                                     queue=app.config['BATCH_QUEUE'], client=meta.get('client'))
+    except AdmissionRejected:
+        batch_store.pop_waiters(task_id)
+        raise
+    except Exception as e:
+        logger.error(f"Could not start batch {batch_id} item {index}: {e}")
+        return {'success': False, 'message': f'Could not start download: {e}'}
+    if cached:
+        return {'success': True, 'download_url': f"/downloads/{cached['filename']}", 'filename': cached['filename']}
+    if leader_id != task_id:
+        batch_store.add_waiter(leader_id, batch_id, index)
+        # The leader may have finished before we registered
+        leader = download_task.AsyncResult(leader_id)
+        if leader.state in TERMINAL_STATES:
+            return leader.result if isinstance(leader.result, dict) else {'success': False, 'message': str(leader.result)}
+    return None
+
+# Starts pending items until the batch's concurrency limit is reached
+def fill_batch(batch_id):
+    meta = batch_store.meta(batch_id)
+    if not meta or meta['state'] != 'RUNNING':
+        return
+    while True:
+        taken = batch_store.take(batch_id, int(meta['concurrency']))
+        if not taken:
+            return
+        for position, (index, item) in enumerate(taken):
+            try:
+                result = start_batch_item(batch_id, meta, index, item)
+            except AdmissionRejected as e:
+                # The client has too much in flight: the rest waits its turn
+                logger.info(f"Deferring batch {batch_id} from item {index}: {e}")
+                metrics.inc('ytdl_admission_rejections_total', reason=e.reason)
+                batch_store.defer(batch_id, taken[position:])
+                fill_batch_task.apply_async(args=[batch_id], countdown=e.retry_after,
+                                            queue=app.config['BATCH_QUEUE'], headers=task_headers())
+                return
+            if result is not None:
+                batch_store.finish_item(batch_id, index, result)
+
+# Picks a deferred batch up again
+@celery.task
+def fill_batch_task(batch_id):
+    fill_batch(batch_id)
+
+# Reads the playlist into batch items. The expansion is a job of the client
+# until it ends either way; its items are admitted on their own.
+@celery.task
+def expand_batch_task(batch_id, url):
+    try:
+        playlist = extract_playlist(url)
+        entries = [
+            {'url': entry.get('webpage_url') or entry.get('url'), 'title': entry.get('title')}
+            for entry in playlist.get('entries') or [playlist]
+            if entry and (entry.get('webpage_url') or entry.get('url'))
+        ][:app.config['BATCH_MAX_ITEMS']]
+        logger.debug(f"Batch {batch_id} expanded to {len(entries)} items")
+        batch_store.set_entries(batch_id, entries)
+    except YtdlpError as e:
+        logger.error(f"Could not expand batch {batch_id}: {e.output}")
+        batch_store.fail(batch_id, f'Could not read playlist: {e.output}')
+        return
+    except Exception as e:
+        logger.error(f"Could not expand batch {batch_id}: {e}")
+        batch_store.fail(batch_id, f'Could not read playlist: {e}')
+        return
+    finally:
+        release_admission(batch_id)
+    fill_batch(batch_id)
+
+# Downloads every video of a playlist or channel as one job
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    if not check_ffmpeg():
+        return jsonify({'success': False, 'message': 'FFmpeg is not installed. Please install FFmpeg and add it to PATH.'}), 500
+
+    data = request.json
+    error = validate_download_request(data)
+    if error:
+        return error
+    try:
+        concurrency = int(data.get('concurrency') or app.config['BATCH_CONCURRENCY'])
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid concurrency'}), 400
+    concurrency = max(1, min(concurrency, app.config['BATCH_MAX_CONCURRENCY']))
+    # A batch takes one token and is a job of this client while its playlist
+    # is read. Its items are paced by the batch's concurrency and admitted one
+    # by one as jobs of this client too.
+    client = request_client()
+    batch_id = str(uuid.uuid4())
+    try:
+        take_admission_token(client)
+        admit_job(client, batch_id)
+    except AdmissionRejected as e:
+        return admission_error(e, client)
+
+    batch_store.create(batch_id, {
+        'url': data['url'],
+        'type': data['type'],
+        'quality': data.get('quality') or '',
+        'speed': data.get('speed') or '',
+        'concurrency': concurrency,
+        'client': client,
+    })
+    try:
+        expand_batch_task.apply_async(args=[batch_id, data['url']], queue=app.config['BATCH_QUEUE'],
+                                      headers=task_headers())
+    except Exception as e:
+        release_admission(batch_id)
+        batch_store.fail(batch_id, f'Could not start batch: {e}')
+        logger.error(f"Could not start batch {batch_id}: {e}")
+        return jsonify({'success': False, 'message': f'Could not start batch: {e}'}), 500
+    return jsonify({'success': True, 'batch_id': batch_id})
+
+@app.route('/api/batch/<batch_id>')
+def batch_status(batch_id):
+    status = batch_store.status(batch_id)
+    if status is None:
+        return jsonify({'success': False, 'message': 'Batch not found'}), 404
+    return jsonify(status)
+
+# Zip of every finished item, streamed while it is being built
+@app.route('/api/batch/<batch_id>/archive')
+def batch_archive(batch_id):
+    status = batch_store.status(batch_id)
+    if status is None:
+        return jsonify({'success': False, 'message': 'Batch not found'}), 404
+    if status['status'] != 'SUCCESS':
+        return jsonify({'success': False, 'message': 'Batch is still running'}), 409
+    # A playlist can list the same video twice, archive it once
+    filenames = dict.fromkeys(item['filename'] for item in status['items']
+                              if item['status'] == 'SUCCESS' and item.get('filename'))
+    files = [(name, os.path.join(OUTDIR, name)) for name in filenames if os.path.exists(os.path.join(OUTDIR, name))]
+    return Response(stream_zip(files), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="batch-{batch_id}.zip"',
+    })
+
+# Status payload from a TaskStore lookup, no further Redis calls
+def task_status_payload(record, leader_id, raw_result):
+    # Every task handed out has a record until it expires, so without one (and
+    # without a result) nothing will ever be published for it. It is reported
+    # failed, which also ends an event stream instead of leaving it open.
+    if not record and raw_result is None:
+        return {'status': 'FAILURE', 'success': False, 'message': 'Unknown or expired task'}
+    if raw_result is None:
+        state, info = 'PENDING', None
+    else:
+        meta = download_task.backend.decode_result(raw_result)
+        state, info = meta['status'], meta['result']
+    return status_payload(state, info, record.get('message', 'Waiting...'))
+
+def get_task_status(task_id):
+    return task_status_payload(*task_store.lookup(task_id))
 
 @app.route('/api/task_status/<task_id>')
 def task_status(task_id):
-    task = download_task.AsyncResult(task_id)
-    if task.state == 'PENDING':
-        response = {'status': task.state, 'status_message': TASKS.get(task_id, {}).get('message', 'Waiting...')}
-    elif task.state == 'PROGRESS':
-        response = {'status': task.state, 'status_message': task.info.get('status_message', 'Processing...')}
-    elif task.state == 'SUCCESS':
-        response = {'status': task.state, 'success': task.result['success'], 'message': task.result['message']}
-        if task.result['success']:
-            response['download_url'] = task.result['download_url']
-    else:  # FAILURE
-        response = {'status': task.state, 'success': False, 'message': task.result.get('message', 'Task failed')}
-    return jsonify(response)
+    return jsonify(get_task_status(task_id))
+
+# Status of many tasks in one call, for API clients tracking several jobs
+@app.route('/api/task_status', methods=['POST'])
+def batch_task_status():
+    task_ids = (request.json or {}).get('task_ids')
+    if not isinstance(task_ids, list) or not task_ids:
+        return jsonify({'success': False, 'message': 'task_ids must be a non-empty list'}), 400
+    if len(task_ids) > app.config['MAX_BATCH_STATUS']:
+        return jsonify({'success': False, 'message': f"At most {app.config['MAX_BATCH_STATUS']} task ids per call"}), 400
+    task_ids = list(dict.fromkeys(task_ids))
+    lookups = task_store.lookup_many(task_ids)
+    return jsonify({'tasks': {task_id: task_status_payload(*lookup) for task_id, lookup in zip(task_ids, lookups)}})
+
+# Server-Sent Events stream of status changes, replaces polling task_status
+@app.route('/api/task_events/<task_id>')
+def task_events(task_id):
+    leader_id = single_flight.resolve(task_id)
+
+    def stream():
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            # Subscribe before reading the current state so no update is lost in between
+            pubsub.subscribe(task_events_channel(leader_id))
+            payload = get_task_status(task_id)
+            yield f'data: {json.dumps(payload)}\n\n'
+            while payload['status'] not in TERMINAL_STATES:
+                message = pubsub.get_message(timeout=app.config['EVENT_STREAM_KEEPALIVE'])
+                if message is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                payload = json.loads(message['data'])
+                yield f'data: {json.dumps(payload)}\n\n'
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+# Lists the formats available for a video without downloading anything
+@app.route('/api/formats', methods=['GET', 'POST'])
+def api_formats():
+    url = (request.json or {}).get('url') if request.method == 'POST' else request.args.get('url')
+    if not url:
+        return jsonify({'success': False, 'message': 'URL is required'}), 400
+    try:
+        info = cached_extract_info(url)
+    except (YtdlpError, CachedExtractionError) as e:
+        return jsonify({'success': False, 'message': f'Failed to fetch formats: {e}'}), 502
+
+    formats = [{
+        'format_id': f.get('format_id'),
+        'height': f.get('height'),
+        'ext': f.get('ext'),
+        'vcodec': f.get('vcodec'),
+        'acodec': f.get('acodec'),
+        'filesize': f.get('filesize') or f.get('filesize_approx'),
+        'quality': f.get('format_note'),
+    } for f in info.get('formats') or [] if f.get('vcodec') != 'none' or f.get('acodec') != 'none']
+    return jsonify({
+        'success': True,
+        'title': info.get('title'),
+        'channel': info.get('channel') or info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'formats': formats,
+    })
+
+# Streams a download to the client while yt-dlp is still fetching it, so the
+# first bytes arrive in seconds instead of after the whole job. Only single
+# file formats can be piped (m4a audio, pre-muxed video), and streaming always
+# uses the yt-dlp CLI since the in-process engine can't write to a pipe.
+@app.route('/api/stream')
+def api_stream():
+    # Flask answers HEAD without reading the body, which would start (and
+    # strand) a yt-dlp process for nothing
+    if request.method == 'HEAD':
+        return jsonify({'success': False, 'message': 'Method not allowed'}), 405, {'Allow': 'GET'}
+    data = {'url': request.args.get('url'), 'type': request.args.get('type'), 'quality': request.args.get('quality')}
+    error = validate_download_request(data)
+    if error:
+        return error
+    # Each stream runs yt-dlp in the web process
+    client = request_client()
+    try:
+        take_admission_token(client)
+    except AdmissionRejected as e:
+        return admission_error(e, client)
+    url, download_type, quality = data['url'], data['type'], data['quality']
+
+    # A finished regular download is better than a stream, it has metadata embedded
+    cached = cache_lookup(cache_key_for(url, download_type, quality))
+    if cached:
+        return redirect(f"/downloads/{quote(cached['filename'])}")
+
+    try:
+        info = cached_extract_info(url)
+        format_id = select_stream_format(info, download_type, quality)
+    except (YtdlpError, CachedExtractionError) as e:
+        return jsonify({'success': False, 'message': f'Failed to fetch video info: {e}'}), 502
+    except FormatUnavailable as e:
+        return jsonify({'success': False, 'message': f'{e}, use /api/download instead'}), 409
+    fmt = formats_by_id(info).get(format_id, {})
+
+    video_id = extract_video_id(url)
+    stream_key = DownloadCache.make_key(video_id, download_type, quality, raw_selector(format_id)) if video_id else None
+    cached = cache_lookup(stream_key)
+    if cached:
+        return redirect(f"/downloads/{quote(cached['filename'])}")
+
+    tag = output_tag(download_type, quality)
+    filename = output_path(f'%(title)s-%(id)s-{tag}-stream.%(ext)s', info, dict(fmt, ext=fmt.get('ext') or 'mp4'))
+
+    info_fd, info_path = tempfile.mkstemp(suffix='.info.json')
+    with os.fdopen(info_fd, 'w') as f:
+        json.dump(info, f)
+    cmd = [app.config['YTDLP_BIN'], '--quiet', '--no-warnings', '--load-info-json', info_path,
+           '-f', format_id, '-o', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # Wait for the first bytes so a failure can still be reported as an error
+    first_chunk = proc.stdout.read1(app.config['STREAM_CHUNK_SIZE'])
+    if not first_chunk:
+        returncode = proc.wait()
+        proc.stdout.close()
+        os.remove(info_path)
+        logger.error(f"Streaming {url} failed before any output (exit code {returncode})")
+        return jsonify({'success': False, 'message': 'Streaming failed'}), 502
+
+    tee_path = None
+    if app.config['STREAM_TEE'] and stream_key and request.args.get('tee') != '0':
+        tee_path = os.path.join(OUTDIR, f'.stream-{uuid.uuid4().hex}.part')
+
+    tee = open(tee_path, 'wb') if tee_path else None
+    state = {'complete': False, 'closed': False}
+
+    def generate():
+        try:
+            chunk = first_chunk
+            while chunk:
+                if tee:
+                    tee.write(chunk)
+                yield chunk
+                chunk = proc.stdout.read1(app.config['STREAM_CHUNK_SIZE'])
+            state['complete'] = proc.wait() == 0
+        finally:
+            cleanup()
+
+    # Runs from the generator once it is done, and from the response's close()
+    # for a body never iterated (a client gone before the first chunk), where
+    # the generator's finally never runs
+    def cleanup():
+        if state['closed']:
+            return
+        state['closed'] = True
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        os.remove(info_path)
+        if tee:
+            tee.close()
+            if state['complete']:
+                os.replace(tee_path, os.path.join(OUTDIR, filename))
+                cache_store(stream_key, filename, raw_selector(format_id))
+                remember_info(info)
+            else:
+                os.remove(tee_path)
+
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+        'X-Accel-Buffering': 'no',
+    }
+    if fmt.get('filesize'):
+        headers['Content-Length'] = str(fmt['filesize'])
+    response = Response(generate(), mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                        headers=headers)
+    response.call_on_close(cleanup)
+    return response
+
+# Tool versions and Redis reachability, for load balancers and operators
+@app.route('/api/health')
+def health():
+    # Never re-probed on request, that would let anyone fork the tools at will; see TOOL_PROBE_TTL
+    tools = tool_probe.get()
+    try:
+        redis_ok = bool(redis_client.ping())
+    except redis.RedisError:
+        redis_ok = False
+    healthy = redis_ok and all(info['available'] for info in tools.values())
+    return jsonify({'healthy': healthy, 'tools': tools, 'redis': redis_ok}), 200 if healthy else 503
+
+# Disk usage of the downloads directory, reservations of running jobs and eviction counters
+@app.route('/api/storage')
+def storage_status():
+    try:
+        return jsonify(storage.stats())
+    except redis.RedisError as e:
+        return jsonify({'success': False, 'message': f'Storage stats unavailable: {e}'}), 503
+
+# Prometheus text format: job counters and histograms from every process,
+# storage gauges read at scrape time
+@app.route('/metrics')
+def prometheus_metrics():
+    try:
+        stats = storage.stats()
+        body = metrics.render(gauges={
+            'ytdl_storage_used_bytes': ('Bytes of finished downloads on disk', stats['used_bytes']),
+            'ytdl_storage_reserved_bytes': ('Bytes reserved by running downloads', stats['reserved_bytes']),
+            'ytdl_storage_quota_bytes': ('Storage quota of the downloads directory', stats['quota_bytes']),
+            'ytdl_storage_disk_free_bytes': ('Free space on the downloads disk', stats['disk_free_bytes']),
+            'ytdl_admitted_jobs': ('Downloads admitted and not finished yet', admission.queued()),
+        })
+    except redis.RedisError as e:
+        return Response(f'# metrics unavailable: {e}\n', status=503, mimetype='text/plain')
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+# Hands the transfer to nginx, which does ranges and conditional requests itself
+def accel_redirect(filename):
+    response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + quote(filename)
+    ascii_name = filename.encode('ascii', 'replace').decode().replace('"', '')
+    response.headers['Content-Disposition'] = f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+    return response
 
 @app.route('/downloads/<filename>')
 def serve_download(filename):
-    try:
-        return send_from_directory(OUTDIR, filename, as_attachment=True)
-    except FileNotFoundError:
+    path = safe_join(OUTDIR, filename)
+    if path is None or not os.path.isfile(path):
         return jsonify({'success': False, 'message': 'File not found'}), 404
+    try:
+        download_cache.touch_file(filename)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record access to {filename}: {e}")
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel':
+        response = accel_redirect(filename)
+    else:
+        response = send_from_directory(OUTDIR, filename, as_attachment=True, conditional=True, etag=True,
+                                       max_age=app.config['DOWNLOAD_MAX_AGE'])
+    # The file stays on disk until the response is closed (sent, or the
+    # client went away). WSGI servers close a file response's iterable, not
+    # the response.
+    holder = uuid.uuid4().hex
+    pin_files(holder, [filename])
+
+    def unpin():
+        unpin_files(holder, [filename])
+    if response.direct_passthrough:
+        response.response = ClosingIterator(response.response, unpin)
+    else:
+        response.call_on_close(unpin)
+    return response
+
+# Starts a Celery worker with the settings of one job class
+def run_worker(job_class):
+    settings = app.config['JOB_QUEUES'][job_class]
+    celery.worker_main(['worker', '-Q', job_class, '--concurrency', str(settings['concurrency']),
+                        '--prefetch-multiplier', str(settings['prefetch']), '-n', f'{job_class}@%h'])
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == 'worker':
+        run_worker(sys.argv[2])
+    else:
+        app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,239 @@
+# ASGI entry point. The routes every client hits over and over (submitting,
+# polling, event streams and file transfers) run natively on the event loop
+# with redis.asyncio, so an idle poll or a slow download no longer pins a
+# thread. Everything else is the unchanged Flask app behind asgiref.
+#
+#   uvicorn asgi:application --workers 4
+#
+# JSON bodies and status codes are the same as the Flask routes.
+import asyncio
+import json
+import logging
+import re
+
+import redis.asyncio
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.wsgi import FileWrapper
+
+from admission import AdmissionRejected
+from app import (ASSET_PREFIX, TERMINAL_STATES, admission_rejection, app, asset_cache_control, check_ffmpeg,
+                 client_id, index_page, page_assets, serve_download, start_download, task_events_channel,
+                 task_status_payload, task_store, validate_download_request)
+from task_store import TaskStore
+from tracing import end_trace, start_trace
+
+logger = logging.getLogger(__name__)
+
+# Bytes read per thread hop when streaming a file
+app.config['ASGI_FILE_CHUNK_SIZE'] = 256 * 1024
+
+async_redis = redis.asyncio.Redis.from_url(app.config['CELERY_BROKER_URL'])
+async_task_store = TaskStore(async_redis, task_store.ttl, task_store.alias_prefix, task_store.result_prefix,
+                             prefix=task_store.prefix)
+flask_application = WsgiToAsgi(app)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+    ] + [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# Sends a Flask response, reading its body in a worker thread one chunk at a
+# time so file transfers only borrow a thread while the disk is being read
+async def send_flask_response(send, response, environ, disconnected):
+    # get_app_iter drops the body of HEAD, 304 and 204 responses
+    chunks = iter(response.get_app_iter(environ))
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': [
+        (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.to_wsgi_list()
+    ]})
+    try:
+        while not disconnected.is_set():
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        response.close()
+
+
+# Sets the event once the client goes away
+async def watch_disconnect(receive, disconnected):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+
+def header_list(scope):
+    return [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+
+
+async def api_download(scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not check_ffmpeg() or not isinstance(data, dict):
+        # Let Flask produce the exact error response
+        return await flask_application(scope, replay(body), send)
+    with app.app_context():
+        error = validate_download_request(data)
+        if error:
+            response, status = error
+            return await send_json(send, response.get_json(), status)
+    header = app.config['ADMISSION_CLIENT_HEADER'].lower()
+    client = client_id(dict(header_list(scope)).get(header) if header else None, (scope.get('client') or [None])[0])
+    # Enqueueing talks to the broker with the blocking client
+    try:
+        payload = await asyncio.to_thread(start_download, data, client)
+    except AdmissionRejected as e:
+        payload, headers = admission_rejection(e, client)
+        return await send_json(send, payload, 429, headers)
+    await send_json(send, payload)
+
+
+async def api_task_status(scope, receive, send, task_id):
+    await send_json(send, task_status_payload(*await async_task_store.lookup_async(task_id)))
+
+
+async def api_batch_task_status(scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        task_ids = json.loads(body or b'{}').get('task_ids')
+    except (ValueError, AttributeError):
+        task_ids = None
+    if not isinstance(task_ids, list) or not task_ids:
+        return await send_json(send, {'success': False, 'message': 'task_ids must be a non-empty list'}, 400)
+    if len(task_ids) > app.config['MAX_BATCH_STATUS']:
+        return await send_json(send, {'success': False, 'message': f"At most {app.config['MAX_BATCH_STATUS']} task ids per call"}, 400)
+    task_ids = list(dict.fromkeys(task_ids))
+    lookups = await async_task_store.lookup_many_async(task_ids)
+    await send_json(send, {'tasks': {task_id: task_status_payload(*lookup) for task_id, lookup in zip(task_ids, lookups)}})
+
+
+async def api_task_events(scope, receive, send, task_id):
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+    leader_id = (await async_task_store.lookup_async(task_id))[1]
+    pubsub = async_redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        # Subscribe before reading the current state so no update is lost in between
+        await pubsub.subscribe(task_events_channel(leader_id))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        payload = task_status_payload(*await async_task_store.lookup_async(task_id))
+        await send({'type': 'http.response.body', 'body': f'data: {json.dumps(payload)}\n\n'.encode(), 'more_body': True})
+        while payload['status'] not in TERMINAL_STATES and not disconnected.is_set():
+            message = await pubsub.get_message(timeout=app.config['EVENT_STREAM_KEEPALIVE'])
+            if message is None:
+                chunk = b': keep-alive\n\n'
+            else:
+                payload = json.loads(message['data'])
+                chunk = f'data: {json.dumps(payload)}\n\n'.encode()
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        await pubsub.aclose()
+
+
+async def downloads(scope, receive, send, filename):
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+    chunk_size = app.config['ASGI_FILE_CHUNK_SIZE']
+    # The Flask view does the path checks, offloading, ranges and conditional
+    # requests; only moving the bytes happens here
+    with app.test_request_context(scope['path'], method=scope['method'], headers=header_list(scope),
+                                  query_string=scope['query_string'],
+                                  environ_overrides={'wsgi.file_wrapper': lambda f, _: FileWrapper(f, chunk_size)}) as ctx:
+        response = app.make_response(await asyncio.to_thread(serve_download, filename))
+    try:
+        await send_flask_response(send, response, ctx.request.environ, disconnected)
+    finally:
+        watcher.cancel()
+
+
+# The landing page and its assets are prebuilt bytes, answered without
+# leaving the event loop
+async def send_asset(scope, send, asset, cache_control):
+    headers = dict((name.lower(), value) for name, value in header_list(scope))
+    status, response_headers, body = asset.respond(headers.get('accept-encoding'), headers.get('if-none-match'),
+                                                   cache_control)
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def index(scope, receive, send):
+    await send_asset(scope, send, index_page, 'no-cache')
+
+
+async def assets(scope, receive, send, name):
+    asset = page_assets.get(name)
+    if asset is None:
+        return await send_json(send, {'success': False, 'message': 'File not found'}, 404)
+    await send_asset(scope, send, asset, asset_cache_control())
+
+
+def replay(body):
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return receive
+
+
+ROUTES = [
+    ('POST', re.compile(r'/api/download'), api_download),
+    ('GET', re.compile(r'/api/task_status/(?P<task_id>[^/]+)'), api_task_status),
+    ('POST', re.compile(r'/api/task_status'), api_batch_task_status),
+    ('GET', re.compile(r'/api/task_events/(?P<task_id>[^/]+)'), api_task_events),
+    ('GET', re.compile(r'/downloads/(?P<filename>[^/]+)'), downloads),
+    ('GET', re.compile(r'/'), index),
+    ('GET', re.compile(re.escape(ASSET_PREFIX) + r'(?P<name>[^/]+)'), assets),
+]
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_redis.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] == 'http':
+        for method, pattern, handler in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match and scope['method'] == method:
+                token = start_trace(dict(header_list(scope)).get('x-request-id'))
+                try:
+                    # ASGI paths arrive percent-decoded already
+                    return await handler(scope, receive, send, **match.groupdict())
+                finally:
+                    end_trace(token)
+    await flask_application(scope, receive, send)
@@ -0,0 +1,182 @@
+import io
+import json
+import logging
+import os
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+
+# Bookkeeping for playlist/channel batches, kept in Redis so the web process
+# and every worker see the same state.
+#
+#   batch:<id>          hash   meta (url, type, quality, speed, concurrency, client, state) and counters
+#   batch:<id>:items    hash   item index -> JSON (url, title, task_id, status, download_url/message)
+#   batch:<id>:pending  list   item indexes not started yet
+#   batch:<id>:running  set    item indexes currently downloading
+#   batch-waiters:<task id>    set of "<batch id>:<index>" attached to a task
+#                              another request started first
+class BatchStore:
+    def __init__(self, redis_client, ttl):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    def _key(self, batch_id, suffix=''):
+        return f'batch:{batch_id}{suffix}'
+
+    def _keys(self, batch_id):
+        return [self._key(batch_id), self._key(batch_id, ':items'),
+                self._key(batch_id, ':pending'), self._key(batch_id, ':running')]
+
+    def create(self, batch_id, meta):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(batch_id), mapping=dict(meta, state='EXPANDING', total=0, done=0, failed=0))
+        pipe.expire(self._key(batch_id), self.ttl)
+        pipe.execute()
+
+    def meta(self, batch_id):
+        raw = self.redis.hgetall(self._key(batch_id))
+        return {k.decode(): v.decode() for k, v in raw.items()}
+
+    def set_entries(self, batch_id, entries):
+        pipe = self.redis.pipeline()
+        if entries:
+            pipe.hset(self._key(batch_id, ':items'), mapping={
+                i: json.dumps({'url': e['url'], 'title': e.get('title'), 'status': 'PENDING'})
+                for i, e in enumerate(entries)
+            })
+            pipe.rpush(self._key(batch_id, ':pending'), *range(len(entries)))
+        pipe.hset(self._key(batch_id), mapping={'total': len(entries), 'state': 'RUNNING' if entries else 'SUCCESS'})
+        for key in self._keys(batch_id):
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def fail(self, batch_id, message):
+        self.redis.hset(self._key(batch_id), mapping={'state': 'FAILURE', 'message': message})
+
+    # Moves up to concurrency - running items from pending to running and
+    # returns them as (index, item). Serialised per batch so two callers never
+    # overshoot the limit.
+    def take(self, batch_id, concurrency):
+        with self.redis.lock(self._key(batch_id, ':lock'), timeout=30, blocking_timeout=30):
+            free = concurrency - self.redis.scard(self._key(batch_id, ':running'))
+            if free <= 0:
+                return []
+            indexes = self.redis.lpop(self._key(batch_id, ':pending'), free) or []
+            if not indexes:
+                return []
+            pipe = self.redis.pipeline()
+            pipe.sadd(self._key(batch_id, ':running'), *indexes)
+            pipe.hmget(self._key(batch_id, ':items'), indexes)
+            raw_items = pipe.execute()[-1]
+        return [(int(i), json.loads(raw)) for i, raw in zip(indexes, raw_items)]
+
+    # Puts items take() returned back at the head of the queue, in order
+    def defer(self, batch_id, taken):
+        indexes = [index for index, _ in taken]
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(batch_id, ':items'), mapping={index: json.dumps(item) for index, item in taken})
+        pipe.srem(self._key(batch_id, ':running'), *indexes)
+        pipe.lpush(self._key(batch_id, ':pending'), *reversed(indexes))
+        pipe.execute()
+
+    def update_item(self, batch_id, index, item):
+        self.redis.hset(self._key(batch_id, ':items'), index, json.dumps(item))
+
+    def add_waiter(self, task_id, batch_id, index):
+        pipe = self.redis.pipeline()
+        pipe.sadd(f'batch-waiters:{task_id}', f'{batch_id}:{index}')
+        pipe.expire(f'batch-waiters:{task_id}', self.ttl)
+        pipe.execute()
+
+    def pop_waiters(self, task_id):
+        pipe = self.redis.pipeline()
+        pipe.smembers(f'batch-waiters:{task_id}')
+        pipe.delete(f'batch-waiters:{task_id}')
+        members = pipe.execute()[0]
+        waiters = []
+        for member in members:
+            batch_id, _, index = member.decode().rpartition(':')
+            waiters.append((batch_id, int(index)))
+        return waiters
+
+    # Records a finished item, returns True if it was the batch's last one
+    def finish_item(self, batch_id, index, result):
+        raw = self.redis.hget(self._key(batch_id, ':items'), index)
+        if raw is None:
+            return False
+        item = json.loads(raw)
+        item['status'] = 'SUCCESS' if result.get('success') else 'FAILURE'
+        if result.get('success'):
+            item['download_url'] = result['download_url']
+            item['filename'] = result.get('filename')
+        else:
+            item['message'] = result.get('message')
+        if not self.redis.srem(self._key(batch_id, ':running'), index):
+            return False  # already recorded
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(batch_id, ':items'), index, json.dumps(item))
+        pipe.hincrby(self._key(batch_id), 'done' if result.get('success') else 'failed', 1)
+        pipe.hmget(self._key(batch_id), ['done', 'failed', 'total'])
+        done, failed, total = pipe.execute()[-1]
+        finished = int(done) + int(failed) >= int(total)
+        if finished:
+            self.redis.hset(self._key(batch_id), 'state', 'SUCCESS')
+        return finished
+
+    def status(self, batch_id):
+        meta = self.meta(batch_id)
+        if not meta:
+            return None
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self._key(batch_id, ':items'))
+        pipe.scard(self._key(batch_id, ':running'))
+        raw_items, running = pipe.execute()
+        items = sorted(((int(i), json.loads(raw)) for i, raw in raw_items.items()), key=lambda pair: pair[0])
+        total, done, failed = int(meta['total']), int(meta['done']), int(meta['failed'])
+        return {
+            'status': meta['state'],
+            'message': meta.get('message'),
+            'total': total,
+            'done': done,
+            'failed': failed,
+            'running': running,
+            'pending': total - done - failed - running,
+            'items': [item for _, item in items],
+        }
+
+
+# Collects what ZipFile writes so it can be handed to the client in pieces
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# Yields a zip archive of (arcname, path) pairs as it is being built, without
+# staging it on disk. Members are stored, not deflated: media is already compressed.
+def stream_zip(files, chunk_size=1024 * 1024):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for arcname, path in files:
+            size = os.path.getsize(path)
+            with open(path, 'rb') as src, archive.open(arcname, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,82 @@
+# Per-job overhead of the in-process yt-dlp engine against the CLI subprocess path.
+#
+#   python bench/bench_engine.py --jobs 20 --size-kib 512
+#
+# A local HTTP server serves a synthetic file, so only yt-dlp start-up,
+# extraction and the transfer itself are measured, with no network noise.
+import argparse
+import functools
+import http.server
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ytdlp_engine
+from ytdlp_runner import STREAM_ARGS, run_ytdlp
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(run, jobs, job_args):
+    durations = []
+    for i in range(jobs):
+        start = time.perf_counter()
+        run(job_args(i))
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def report(name, durations):
+    durations = sorted(durations)
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+    print(f'{name:<12} mean {statistics.mean(durations) * 1000:8.1f} ms   '
+          f'p50 {statistics.median(durations) * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=20)
+    parser.add_argument('--size-kib', type=int, default=512)
+    parser.add_argument('--ytdlp-bin', default='yt-dlp')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as srcdir, tempfile.TemporaryDirectory() as outdir:
+        with open(os.path.join(srcdir, 'sample.mp4'), 'wb') as f:
+            f.write(os.urandom(options.size_kib * 1024))
+        server = serve(srcdir)
+        url = f'http://127.0.0.1:{server.server_address[1]}/sample.mp4'
+
+        def job_args(tag):
+            return lambda i: ['--no-part', '--no-continue', '-o', os.path.join(outdir, f'{tag}-{i}.%(ext)s'), url]
+
+        subprocess_times = timed(lambda args: run_ytdlp([options.ytdlp_bin] + STREAM_ARGS + args),
+                                 options.jobs, job_args('cli'))
+        engine = ytdlp_engine.YtdlpEngine()
+        start = time.perf_counter()
+        engine.warm()
+        warm_up = time.perf_counter() - start
+        engine_times = timed(engine.download, options.jobs, job_args('engine'))
+        server.shutdown()
+
+    print(f'{options.jobs} jobs, {options.size_kib} KiB each (engine warm-up {warm_up * 1000:.0f} ms, paid once per worker)')
+    report('subprocess', subprocess_times)
+    report('in-process', engine_times)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# End-to-end throughput of the download pipeline (web tier, Redis, Celery
+# workers, yt-dlp runner, cache) without touching YouTube. yt-dlp is replaced
+# by bench/fake_ytdlp.py and the CDN by bench/fake_cdn.py, started here.
+#
+#   python bench/bench_pipeline.py --spawn --concurrency 1,4,16 --jobs 40 --media-mib 16
+#   python bench/bench_pipeline.py --spawn --web-cmd "{python} -m uvicorn asgi:application --workers 4 --port {port}"
+#
+# --spawn starts the web server and a worker with the fake tools wired in
+# (Redis must be running). Without it the harness drives --base and only
+# samples --worker-pids, which must then run with the environment printed at
+# start-up. Clients submit /api/download with unique video ids, so neither
+# the download cache nor single-flight can short-circuit a job, and poll
+# /api/task_status until the job finishes. Reported per level: submit, poll
+# and end-to-end job latency (p50/p99), jobs/sec, output bytes/sec, and the
+# CPU time and peak RSS of the worker and web process trees.
+import argparse
+import http.client
+import json
+import os
+import shlex
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_cdn
+from fake_ytdlp import fake_id
+
+TERMINAL_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+QUEUES = 'audio,small,large,batch,postprocess,celery'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else float('nan')
+
+
+# CPU seconds and RSS of a process and everything below it, read from /proc.
+# Reaped children show up in their parent's cutime/cstime, live ones on their
+# own, so nothing is counted twice.
+def process_tree(root):
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rpartition(')')[2].split()[1])
+            except OSError:
+                pass
+    tree, frontier = [root], [root]
+    while frontier:
+        frontier = [pid for pid, ppid in parents.items() if ppid in frontier]
+        tree += frontier
+    return tree
+
+
+def tree_usage(root):
+    cpu, rss = 0.0, 0
+    for pid in process_tree(root):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rpartition(')')[2].split()
+            cpu += sum(int(v) for v in fields[11:15]) / CLOCK_TICKS
+            with open(f'/proc/{pid}/status') as f:
+                rss += next((int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:')), 0)
+        except (OSError, ValueError):
+            pass
+    return cpu, rss
+
+
+# Tracks CPU seconds used and peak RSS of process trees during a level
+class ResourceSampler:
+    def __init__(self, roots, interval=0.5):
+        self.roots = roots
+        self.interval = interval
+        self.available = os.path.isdir('/proc')
+
+    def __enter__(self):
+        self.stop = threading.Event()
+        self.start_cpu = {name: self._usage(pids)[0] for name, pids in self.roots.items()}
+        self.peak_rss = dict.fromkeys(self.roots, 0)
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.cpu = {name: self._usage(pids)[0] - self.start_cpu[name] for name, pids in self.roots.items()}
+
+    def _usage(self, pids):
+        if not self.available:
+            return 0.0, 0
+        usages = [tree_usage(pid) for pid in pids]
+        return sum(u[0] for u in usages), sum(u[1] for u in usages)
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            for name, pids in self.roots.items():
+                self.peak_rss[name] = max(self.peak_rss[name], self._usage(pids)[1])
+
+
+class Client:
+    def __init__(self, base):
+        url = urlsplit(base)
+        self.host, self.port = url.hostname, url.port or 80
+        self.conn = None
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                return response.status, response.getheader('Content-Length'), data
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+
+
+class Level:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submit, self.poll, self.job = [], [], []
+        self.ok = self.failed = self.bytes = 0
+        self.errors = {}
+
+    def fail(self, reason):
+        with self.lock:
+            self.failed += 1
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+
+def run_job(client, options, level, run_id, n):
+    download_type, quality = options.mix[n % len(options.mix)]
+    url = f'https://www.youtube.com/watch?v={fake_id(run_id, str(n))}'
+    started = time.perf_counter()
+    status, _, body = client.request('POST', '/api/download', {'url': url, 'type': download_type, 'quality': quality})
+    submitted = time.perf_counter()
+    level.submit.append(submitted - started)
+    reply = json.loads(body) if status == 200 else {}
+    if not reply.get('success'):
+        return level.fail(reply.get('message') or f'submit HTTP {status}')
+
+    payload = reply if reply.get('cached') else {'status': 'PENDING'}
+    polls = []
+    deadline = started + options.job_timeout
+    while payload.get('status') not in TERMINAL_STATES and not reply.get('cached'):
+        if time.perf_counter() > deadline:
+            return level.fail('timed out')
+        time.sleep(options.poll_interval)
+        poll_started = time.perf_counter()
+        status, _, body = client.request('GET', f"/api/task_status/{reply['task_id']}")
+        polls.append(time.perf_counter() - poll_started)
+        if status != 200:
+            return level.fail(f'status HTTP {status}')
+        payload = json.loads(body)
+    finished = time.perf_counter()
+    level.poll.extend(polls)
+    if not payload.get('success'):
+        return level.fail((payload.get('message') or 'failed')[:80])
+    # Size of the output as served, not counted as latency
+    _, length, _ = client.request('HEAD', quote(payload['download_url']))
+    with level.lock:
+        level.ok += 1
+        level.bytes += int(length or 0)
+        level.job.append(finished - started)
+
+
+def run_level(options, concurrency, run_id, sampler_roots):
+    level = Level()
+    counter = iter(range(options.jobs))
+    counter_lock = threading.Lock()
+
+    def client_loop():
+        client = Client(options.base)
+        while True:
+            with counter_lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            try:
+                run_job(client, options, level, run_id, n)
+            except (http.client.HTTPException, OSError, ValueError) as e:
+                level.fail(type(e).__name__)
+
+    with ResourceSampler(sampler_roots) as sampler:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    return level, elapsed, sampler
+
+
+def ms(seconds):
+    return f'{seconds * 1000:7.1f}'
+
+
+def report(concurrency, level, elapsed, sampler):
+    print(f'-- {concurrency} concurrent clients: {level.ok} ok, {level.failed} failed in {elapsed:.1f}s')
+    print(f'   {level.ok / elapsed:8.2f} jobs/s   {level.bytes / elapsed / 1024 ** 2:8.1f} MiB/s')
+    for name, values in (('submit', level.submit), ('poll', level.poll), ('job', level.job)):
+        if values:
+            print(f'   {name:<7} p50 {ms(statistics.median(values))} ms   p99 {ms(percentile(values, 0.99))} ms   n={len(values)}')
+    for name in sampler.roots:
+        if sampler.available:
+            print(f'   {name:<7} cpu {sampler.cpu[name]:7.2f} s ({sampler.cpu[name] / elapsed * 100:5.0f}% of a core)   '
+                  f'peak rss {sampler.peak_rss[name] / 1024 ** 2:7.1f} MiB')
+    if level.errors:
+        print(f'   errors: {level.errors}')
+
+
+def wait_ready(base, timeout=30):
+    client = Client(base)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if client.request('GET', f'/api/task_status/{uuid.uuid4()}')[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'{base} did not come up within {timeout}s')
+
+
+def spawn(command, env, port):
+    args = [part.format(python=sys.executable, port=port) for part in shlex.split(command)]
+    return subprocess.Popen(args, env=env, cwd=os.path.dirname(BENCH_DIR), start_new_session=True)
+
+
+def stop(process):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+            process.wait(timeout=30)
+            return
+        except ProcessLookupError:
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        mix.append(('audio', None) if item == 'audio' else ('video', item))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base', default='http://127.0.0.1:5055')
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--jobs', type=int, default=40, help='jobs per concurrency level')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('720,audio,360,best'),
+                        help='comma separated qualities and/or "audio", cycled through')
+    parser.add_argument('--media-mib', type=float, default=8, help='size of the 1080p stream')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--job-timeout', type=float, default=300)
+    parser.add_argument('--cdn-rate', type=int, help='bytes/sec per CDN connection')
+    parser.add_argument('--cdn-latency', type=float, default=0)
+    parser.add_argument('--cdn-fail-rate', type=float, default=0)
+    parser.add_argument('--spawn', action='store_true', help='start the web server and a worker')
+    parser.add_argument('--web-cmd', default='{python} -m gunicorn -w 4 --threads 8 -b 127.0.0.1:{port} app:app')
+    parser.add_argument('--worker-cmd', default=f'{{python}} -m celery -A app:celery worker -Q {QUEUES} --concurrency 4 -n bench@%h')
+    parser.add_argument('--worker-pids', default='', help='worker pids to sample when not spawning')
+    parser.add_argument('--web-pids', default='', help='web server pids to sample when not spawning')
+    options = parser.parse_args()
+    # Spawned processes are cleaned up on kill/timeout too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
+
+    cdn = fake_cdn.serve(latency=options.cdn_latency, rate=options.cdn_rate, fail_rate=options.cdn_fail_rate)
+    fake_bin = os.path.join(BENCH_DIR, 'fake_ytdlp.py')
+    env = dict(os.environ,
+               FAKE_CDN_URL=f'http://127.0.0.1:{cdn.server_address[1]}',
+               FAKE_MEDIA_BYTES=str(int(options.media_mib * 1024 * 1024)),
+               DOWNLOAD_ENGINE='subprocess', YTDLP_BIN=fake_bin, FFMPEG_BIN=fake_bin,
+               # Every client comes from 127.0.0.1, admission control would cap the load
+               ADMISSION_RATE='0', ADMISSION_MAX_PER_CLIENT='0', ADMISSION_MAX_QUEUED='0')
+    print('Fake tool environment: ' + ' '.join(f'{k}={env[k]}' for k in
+          ('FAKE_CDN_URL', 'FAKE_MEDIA_BYTES', 'DOWNLOAD_ENGINE', 'YTDLP_BIN', 'FFMPEG_BIN',
+           'ADMISSION_RATE', 'ADMISSION_MAX_PER_CLIENT', 'ADMISSION_MAX_QUEUED')))
+
+    processes = []
+    roots = {'worker': [int(p) for p in options.worker_pids.split(',') if p],
+             'web': [int(p) for p in options.web_pids.split(',') if p]}
+    try:
+        if options.spawn:
+            port = urlsplit(options.base).port or 80
+            web = spawn(options.web_cmd, env, port)
+            worker = spawn(options.worker_cmd, env, port)
+            processes += [web, worker]
+            roots = {'worker': [worker.pid], 'web': [web.pid]}
+            wait_ready(options.base)
+        roots = {name: pids for name, pids in roots.items() if pids}
+
+        run_id = uuid.uuid4().hex
+        # One job first so worker start-up is not billed to the first level
+        run_level(argparse.Namespace(**dict(vars(options), jobs=1)), 1, run_id + '-warmup', {})
+        for concurrency in (int(n) for n in options.concurrency.split(',')):
+            report(concurrency, *run_level(options, concurrency, f'{run_id}-{concurrency}', roots))
+    finally:
+        for process in processes:
+            stop(process)
+        cdn.shutdown()
+
+
+if __name__ == '__main__':
+    main()
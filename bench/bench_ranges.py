@@ -0,0 +1,79 @@
+# Single stream vs. parallel byte ranges for one progressive file, against
+# bench/fake_cdn.py with a per-connection rate cap (what a throttled CDN
+# looks like to yt-dlp's one TCP stream).
+#
+#   python bench/bench_ranges.py --size-mib 64 --rate 5000000 --connections 1,4,8
+#   python bench/bench_ranges.py --fail-rate 0.1 --retries 3
+#
+# Every download is checked against the bytes the CDN serves.
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fake_cdn
+from range_download import RangeDownloader
+from ytdlp_runner import YtdlpError
+
+
+def expected_digest(size):
+    digest = hashlib.sha1()
+    for chunk in fake_cdn.media_bytes(0, size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mib', type=float, default=64)
+    parser.add_argument('--connections', default='1,2,4,8')
+    parser.add_argument('--chunk-mib', type=float, default=8)
+    parser.add_argument('--retries', type=int, default=3, help='retries per chunk')
+    parser.add_argument('--rate', type=int, default=5000000, help='bytes/sec per CDN connection')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--fail-rate', type=float, default=0)
+    options = parser.parse_args()
+
+    size = int(options.size_mib * 1024 * 1024)
+    expected = expected_digest(size)
+    chunk_size = int(options.chunk_mib * 1024 * 1024)
+    print(f'{options.size_mib} MiB, {options.rate / 1e6:g} MB/s per connection, '
+          f'{options.latency * 1000:g} ms latency, {options.fail_rate:.0%} 503s')
+    print(f'{"connections":>11} {"seconds":>8} {"MiB/s":>7} {"requests":>8}  result')
+
+    for connections in [int(c) for c in options.connections.split(',')]:
+        cdn = fake_cdn.serve(latency=options.latency, rate=options.rate, fail_rate=options.fail_rate)
+        requests = []
+        handler = cdn.RequestHandlerClass
+        handler.do_GET = lambda self, body=True, get=handler.do_GET: requests.append(1) or get(self, body)
+        url = f'http://127.0.0.1:{cdn.server_address[1]}/media/bench.mp4?size={size}'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.mp4')
+            started = time.monotonic()
+            try:
+                RangeDownloader(connections, chunk_size, options.retries).download(url, path, size=size)
+                elapsed = time.monotonic() - started
+                result = 'ok' if file_digest(path) == expected else 'CORRUPT'
+            except YtdlpError as e:
+                elapsed = time.monotonic() - started
+                result = f'failed: {e}'
+        cdn.shutdown()
+        print(f'{connections:>11} {elapsed:>8.2f} {size / 1024 / 1024 / elapsed:>7.1f} {len(requests):>8}  {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Concurrent-connection capacity of the web tier, Flask (WSGI) against asgi.py.
+#
+#   gunicorn -w 4 --threads 8 app:app -b 127.0.0.1:5000
+#   uvicorn asgi:application --workers 4 --port 8000
+#   python bench/bench_web.py --base http://127.0.0.1:5000 --connections 50,200,800 --hold 100 --hold-file big.mp4
+#   python bench/bench_web.py --base http://127.0.0.1:8000 --connections 50,200,800 --hold 100 --hold-file big.mp4
+#
+# At each level, N clients poll /api/task_status/<id> over keep-alive for
+# --duration seconds while --hold clients keep slow /downloads transfers
+# open, the way browsers on a poor connection do. Capacity shows up as how
+# requests/sec, p99 latency and failures hold up as N grows.
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from urllib.parse import quote, urlsplit
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()  # body ends with the connection
+        headers['connection'] = 'close'
+    keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    return int(status), keep_alive
+
+
+def request_bytes(host, path):
+    return f'GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n'.encode()
+
+
+async def poller(host, port, path, deadline, latencies, failures):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request_bytes(host, path))
+            status, keep_alive = await read_response(reader)
+            if status != 200:
+                failures.append(status)
+            else:
+                latencies.append(time.perf_counter() - start)
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            failures.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.1)
+    if writer is not None:
+        writer.close()
+
+
+# Reads a download at a trickle until the deadline
+async def slow_reader(host, port, path, deadline, rate):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(request_bytes(host, path))
+        while time.perf_counter() < deadline:
+            if not await reader.read(rate // 10):
+                break
+            await asyncio.sleep(0.1)
+        writer.close()
+    except OSError:
+        pass
+
+
+async def run_level(options, connections):
+    url = urlsplit(options.base)
+    host, port = url.hostname, url.port or 80
+    deadline = time.perf_counter() + options.duration
+    latencies, failures = [], []
+    # Unknown ids are valid polls, they report PENDING through the same lookup
+    pollers = [poller(host, port, f'/api/task_status/{uuid.uuid4()}', deadline, latencies, failures)
+               for _ in range(connections)]
+    holders = [slow_reader(host, port, f'/downloads/{quote(options.hold_file)}', deadline, options.hold_rate)
+               for _ in range(options.hold if options.hold_file else 0)]
+    await asyncio.gather(*pollers, *holders)
+    return latencies, failures
+
+
+def report(connections, latencies, failures, duration):
+    if latencies:
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f'{connections:>6} conns  {len(latencies) / duration:9.1f} req/s   '
+              f'p50 {statistics.median(latencies) * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms   '
+              f'failed {len(failures)}')
+    else:
+        print(f'{connections:>6} conns  no successful requests, failed {len(failures)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base', default='http://127.0.0.1:5000')
+    parser.add_argument('--connections', default='10,50,200')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--hold', type=int, default=0, help='slow downloads kept open during each level')
+    parser.add_argument('--hold-file', help='file name under downloads/ for the slow transfers')
+    parser.add_argument('--hold-rate', type=int, default=64 * 1024, help='bytes/sec per slow download')
+    options = parser.parse_args()
+
+    print(f'{options.base}: {options.duration:.0f}s per level, {options.hold if options.hold_file else 0} slow downloads open')
+    for connections in (int(n) for n in options.connections.split(',')):
+        latencies, failures = asyncio.run(run_level(options, connections))
+        report(connections, latencies, failures, options.duration)
+
+
+if __name__ == '__main__':
+    main()
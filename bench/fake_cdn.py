@@ -0,0 +1,121 @@
+# Stand-in for the video CDN: serves synthetic media of any size, with HTTP
+# Range support, so downloads can be benchmarked without touching YouTube.
+#
+#   python bench/fake_cdn.py --port 8765 --rate 20000000 --fail-rate 0.05
+#
+#   GET /media/<name>?size=<bytes>
+#
+# Bodies are generated on the fly from a repeating block, nothing is stored.
+# --latency delays the first byte, --rate caps each connection in bytes/sec
+# and --fail-rate answers that share of requests with a 503, which yt-dlp
+# (and so download_task) treats as transient.
+import argparse
+import http.server
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+BLOCK = bytes(range(256)) * 256  # 64 KiB
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def media_bytes(start, end):
+    offset = start % len(BLOCK)
+    while start < end:
+        chunk = BLOCK[offset:offset + end - start]
+        yield chunk
+        start += len(chunk)
+        offset = 0
+
+
+class CDNHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+    rate = None
+    fail_rate = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        url = urlsplit(self.path)
+        try:
+            size = int(parse_qs(url.query)['size'][0])
+        except (KeyError, ValueError):
+            size = None
+        if not url.path.startswith('/media/') or size is None:
+            return self.send_error(404)
+        if self.fail_rate and random.random() < self.fail_rate:
+            return self.send_error(503)
+
+        start, end, status = 0, size, 200
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            else:  # suffix range, the last N bytes
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start >= end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            status = 206
+
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.end_headers()
+        if not body:
+            return
+        started = time.monotonic()
+        sent = 0
+        try:
+            for chunk in media_bytes(start, end):
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.rate:
+                    ahead = sent / self.rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(host='127.0.0.1', port=0, latency=0, rate=None, fail_rate=0):
+    handler = type('Handler', (CDNHandler,), {'latency': latency, 'rate': rate, 'fail_rate': fail_rate})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='seconds before the first byte')
+    parser.add_argument('--rate', type=int, help='bytes/sec per connection')
+    parser.add_argument('--fail-rate', type=float, default=0, help='share of requests answered with a 503')
+    options = parser.parse_args()
+    server = serve(options.host, options.port, options.latency, options.rate, options.fail_rate)
+    print(f'Fake CDN on http://{options.host}:{server.server_address[1]}/media/')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Stand-in for the yt-dlp CLI, backed by bench/fake_cdn.py. It implements the
+# part of the command line the app uses (see ytdlp_runner.py): metadata dumps,
+# -f/-o downloads from --load-info-json with ranged fragments, resuming from
+# .part files, --concurrent-fragments, --limit-rate, progress and after_move
+# templates, and '-o -' streaming. Merging concatenates the streams instead of
+# running ffmpeg, and it stands in for ffmpeg itself too (FFMPEG_BIN): it
+# answers '-version' and "muxes" '-i' inputs into the last argument the same way.
+#
+#   FAKE_CDN_URL=http://127.0.0.1:8765 FAKE_MEDIA_BYTES=8388608 \
+#   DOWNLOAD_ENGINE=subprocess YTDLP_BIN=bench/fake_ytdlp.py FFMPEG_BIN=bench/fake_ytdlp.py ...
+#
+# FAKE_MEDIA_BYTES is the size of the 1080p stream, lower qualities and audio
+# are fractions of it.
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+CDN_URL = os.environ.get('FAKE_CDN_URL', 'http://127.0.0.1:8765').rstrip('/')
+MEDIA_BYTES = int(os.environ.get('FAKE_MEDIA_BYTES', 8 * 1024 * 1024))
+DURATION = int(os.environ.get('FAKE_DURATION', 60))
+PLAYLIST_SIZE = int(os.environ.get('FAKE_PLAYLIST_SIZE', 10))
+FRAGMENT_BYTES = 1024 * 1024
+
+VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})')
+PLAYLIST_ID_RE = re.compile(r'[?&]list=([A-Za-z0-9_-]+)')
+FIELD_RE = re.compile(r'%\(([\w.]+)\)s')
+
+# format id, ext, height, vcodec, acodec, share of FAKE_MEDIA_BYTES; worst to best like yt-dlp
+FORMATS = [
+    ('140', 'm4a', None, 'none', 'mp4a.40.2', 1 / 8),
+    ('18', 'mp4', 360, 'avc1.42001E', 'mp4a.40.2', 1 / 4),
+    ('134', 'mp4', 360, 'avc1.4d401e', 'none', 1 / 4),
+    ('136', 'mp4', 720, 'avc1.4d401f', 'none', 1 / 2),
+    ('137', 'mp4', 1080, 'avc1.640028', 'none', 1),
+]
+
+# Value-taking options that are accepted and ignored
+IGNORED_WITH_VALUE = {'--progress-template', '--print', '--retries', '--fragment-retries'}
+
+
+def fake_id(*parts):
+    digest = hashlib.sha1('/'.join(parts).encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:11]
+
+
+def video_info(url):
+    match = VIDEO_ID_RE.search(url)
+    video_id = match.group(1) if match else fake_id(url)
+    formats = []
+    for format_id, ext, height, vcodec, acodec, share in FORMATS:
+        size = int(MEDIA_BYTES * share)
+        formats.append({
+            'format_id': format_id, 'ext': ext, 'height': height, 'vcodec': vcodec, 'acodec': acodec,
+            'filesize': size, 'tbr': size * 8 / 1000 / DURATION, 'protocol': 'https',
+            'url': f'{CDN_URL}/media/{video_id}-{format_id}.{ext}?size={size}',
+        })
+    return {
+        'id': video_id, 'title': f'bench {video_id}', 'extractor_key': 'Youtube', 'duration': DURATION,
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}', 'formats': formats,
+    }
+
+
+def playlist_info(url):
+    match = PLAYLIST_ID_RE.search(url)
+    playlist_id = match.group(1) if match else fake_id(url)
+    entries = []
+    for i in range(PLAYLIST_SIZE):
+        video_id = fake_id(playlist_id, str(i))
+        entries.append({'_type': 'url', 'id': video_id, 'title': f'bench {video_id}',
+                        'url': f'https://www.youtube.com/watch?v={video_id}'})
+    return {'_type': 'playlist', 'id': playlist_id, 'title': f'bench playlist {playlist_id}', 'entries': entries}
+
+
+def parse_args(argv):
+    options = {'templates': [], 'prints': [], 'flags': set(), 'urls': [], 'concurrent_fragments': 1}
+    args = iter(argv)
+    for arg in args:
+        if arg == '--progress-template':
+            options['templates'].append(next(args))
+        elif arg == '--print':
+            options['prints'].append(next(args))
+        elif arg in ('-f', '--format'):
+            options['format'] = next(args)
+        elif arg in ('-o', '--output'):
+            options['output'] = next(args)
+        elif arg == '--load-info-json':
+            options['info_json'] = next(args)
+        elif arg in ('-N', '--concurrent-fragments'):
+            options['concurrent_fragments'] = max(1, int(next(args)))
+        elif arg in ('-r', '--limit-rate'):
+            options['limit_rate'] = parse_rate(next(args))
+        elif arg == '--merge-output-format':
+            options['merge_format'] = next(args)
+        elif arg in IGNORED_WITH_VALUE:
+            next(args)
+        elif arg.startswith('-'):
+            options['flags'].add(arg)
+        else:
+            options['urls'].append(arg)
+    return options
+
+
+def parse_rate(value):
+    match = re.fullmatch(r'([\d.]+)([KMG]?)i?B?', value, re.IGNORECASE)
+    if not match:
+        return None
+    scale = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[match.group(2).upper()]
+    return float(match.group(1)) * scale
+
+
+def render(template, fields):
+    return FIELD_RE.sub(lambda m: 'NA' if fields.get(m.group(1)) is None else str(fields[m.group(1)]), template)
+
+
+def emit(options, kind, fields):
+    for template in options['templates'] + options['prints']:
+        when, _, text = template.partition(':')
+        if when == kind:
+            print(render(text, fields), flush=True)
+
+
+class TransferError(Exception):
+    pass
+
+
+def fetch(url, start, end):
+    request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end - 1}'})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        raise TransferError(f'HTTP Error {e.code}: {e.reason}')
+    except (urllib.error.URLError, OSError) as e:
+        raise TransferError(str(e))
+
+
+# Shared --limit-rate budget across fragment threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            self.sent += size
+            ahead = self.sent / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# Downloads one format into part_path, resuming after whatever it already
+# holds. Fragments run concurrently and land at their offsets; on failure the
+# file is cut back to the contiguous prefix so the next attempt resumes cleanly.
+def download_format(options, fmt, part_path, progress):
+    size = fmt['filesize']
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    progress['downloaded'] += offset
+    fragments = [(start, min(start + FRAGMENT_BYTES, size)) for start in range(offset, size, FRAGMENT_BYTES)]
+    limiter = progress['limiter']
+    done = set()
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        def run(fragment):
+            data = fetch(fmt['url'], *fragment)
+            os.pwrite(fd, data, fragment[0])
+            limiter.consume(len(data))
+            return fragment, len(data)
+
+        with concurrent.futures.ThreadPoolExecutor(options['concurrent_fragments']) as pool:
+            futures = [pool.submit(run, f) for f in fragments]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    fragment, length = future.result()
+                except TransferError:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                done.add(fragment)
+                progress['downloaded'] += length
+                elapsed = max(time.monotonic() - progress['started'], 1e-6)
+                speed = (progress['downloaded'] - progress['resumed']) / elapsed
+                remaining = progress['total'] - progress['downloaded']
+                emit(options, 'download', {
+                    'progress.downloaded_bytes': progress['downloaded'], 'progress.total_bytes': progress['total'],
+                    'progress.speed': round(speed, 1), 'progress.eta': int(remaining / speed) if speed else None,
+                })
+    except TransferError:
+        contiguous = offset
+        for start, end in fragments:
+            if (start, end) not in done:
+                break
+            contiguous = end
+        os.truncate(part_path, contiguous)
+        raise
+    finally:
+        os.close(fd)
+
+
+def postprocess(options, name):
+    emit(options, 'postprocess', {'progress.status': 'started', 'progress.postprocessor': name})
+    emit(options, 'postprocess', {'progress.status': 'finished', 'progress.postprocessor': name})
+
+
+def stream_to_stdout(fmt):
+    out = sys.stdout.buffer
+    for start in range(0, fmt['filesize'], FRAGMENT_BYTES):
+        out.write(fetch(fmt['url'], start, min(start + FRAGMENT_BYTES, fmt['filesize'])))
+    out.flush()
+
+
+def download(options):
+    if 'info_json' in options:
+        with open(options['info_json']) as f:
+            info = json.load(f)
+    else:
+        info = video_info(options['urls'][0])
+    by_id = {f['format_id']: f for f in info['formats']}
+    try:
+        selected = [by_id[format_id] for format_id in options.get('format', '18').split('+')]
+    except KeyError:
+        print('ERROR: [youtube] Requested format is not available', flush=True)
+        return 1
+
+    if options.get('output') == '-':
+        try:
+            stream_to_stdout(selected[0])
+        except TransferError as e:
+            print(f'ERROR: unable to download video data: {e}', file=sys.stderr, flush=True)
+            return 1
+        return 0
+
+    merged = len(selected) > 1
+    ext = options.get('merge_format', 'mp4') if merged else selected[0]['ext']
+    final = render(options.get('output', '%(title)s [%(id)s].%(ext)s'),
+                   {'title': info['title'], 'id': info['id'], 'ext': ext,
+                    'format_id': '+'.join(f['format_id'] for f in selected)})
+    if os.path.exists(final):
+        print(f'[download] {final} has already been downloaded', flush=True)
+        emit(options, 'after_move', {'filepath': os.path.abspath(final)})
+        return 0
+    parts = [f"{final}.f{f['format_id']}.{f['ext']}.part" if merged else f'{final}.part' for f in selected]
+    total = sum(f['filesize'] for f in selected)
+    resumed = sum(os.path.getsize(p) for p in parts if os.path.exists(p))
+    progress = {'downloaded': 0, 'resumed': resumed, 'total': total, 'started': time.monotonic(),
+                'limiter': RateLimiter(options.get('limit_rate'))}
+    try:
+        for fmt, part in zip(selected, parts):
+            download_format(options, fmt, part, progress)
+    except TransferError as e:
+        print(f'ERROR: unable to download video data: {e}', flush=True)
+        return 1
+
+    if merged:
+        emit(options, 'postprocess', {'progress.status': 'started', 'progress.postprocessor': 'Merger'})
+        with open(final + '.temp', 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as src:
+                    while chunk := src.read(FRAGMENT_BYTES):
+                        out.write(chunk)
+                os.remove(part)
+        os.replace(final + '.temp', final)
+        emit(options, 'postprocess', {'progress.status': 'finished', 'progress.postprocessor': 'Merger'})
+    else:
+        os.replace(parts[0], final)
+    if '--embed-thumbnail' in options['flags']:
+        postprocess(options, 'EmbedThumbnail')
+    if '--add-metadata' in options['flags'] or '--embed-metadata' in options['flags']:
+        postprocess(options, 'FFmpegMetadata')
+    emit(options, 'after_move', {'filepath': os.path.abspath(final)})
+    return 0
+
+
+# ffmpeg stand-in for postprocess.py: copies every input into the output
+def fake_ffmpeg(argv):
+    inputs = [argv[i + 1] for i, arg in enumerate(argv) if arg == '-i']
+    with open(argv[-1], 'wb') as out:
+        for path in inputs:
+            with open(path, 'rb') as src:
+                while chunk := src.read(FRAGMENT_BYTES):
+                    out.write(chunk)
+    return 0
+
+
+def main(argv):
+    if '--version' in argv:
+        print('2099.01.01-fake')
+        return 0
+    if '-version' in argv:  # standing in for ffmpeg
+        print('ffmpeg version fake (bench/fake_ytdlp.py)')
+        return 0
+    if '-i' in argv:
+        return fake_ffmpeg(argv)
+    options = parse_args(argv)
+    if '--dump-single-json' in options['flags'] or '-J' in options['flags']:
+        url = options['urls'][0]
+        playlist = '--flat-playlist' in options['flags'] and PLAYLIST_ID_RE.search(url)
+        print(json.dumps(playlist_info(url) if playlist else video_info(url)))
+        return 0
+    if not options['urls'] and 'info_json' not in options:
+        print('ERROR: You must provide at least one URL.', flush=True)
+        return 2
+    return download(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
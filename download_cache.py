@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import re
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Matches the 11 character video id in the usual YouTube URL shapes
+VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})')
+
+
+# What an info dict keeps of a format once its URL is of no use: enough to
+# select formats and map them to streams of files on disk (see formats.py)
+FORMAT_FIELDS = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'width', 'fps', 'tbr', 'abr', 'vbr',
+                 'filesize', 'filesize_approx')
+# Per-request or bulky fields it drops altogether
+DROPPED_FIELDS = ('formats', 'requested_formats', 'url', 'http_headers', 'fragments', 'manifest_url',
+                  'subtitles', 'automatic_captions', 'heatmap')
+
+
+def extract_video_id(url):
+    match = VIDEO_ID_RE.search(url or '')
+    return match.group(1) if match else None
+
+
+# Persistent index of finished downloads, shared by the web process and every
+# Celery worker through Redis.
+#
+#   <prefix>:entries     hash    cache key -> JSON entry (filename, size, selector)
+#   <prefix>:files       hash    filename -> cache key
+#   <prefix>:lru         zset    cache key -> last access (lookup or serve) time
+#   <prefix>:video:<id>  set     cache keys of the video's entries
+#   <prefix>:info:<id>   string  zlib compressed JSON info dict without URLs,
+#                                dropped with the video's last entry
+#   <prefix>:bytes       string  total size of all indexed files
+#   <prefix>:pins        zset    "<holder>|<filename>" -> time the pin lapses,
+#                                files a job or a transfer is still using
+#
+# Reads are lock free. Anything that changes the byte count takes the
+# <prefix>:lock Redis lock so concurrent workers cannot double count or evict
+# the same file twice.
+class DownloadCache:
+    def __init__(self, redis_client, outdir, max_bytes, prefix='ytcache', info_ttl=7 * 24 * 60 * 60):
+        self.redis = redis_client
+        self.outdir = outdir
+        self.max_bytes = max_bytes
+        self.entries_key = f'{prefix}:entries'
+        self.files_key = f'{prefix}:files'
+        self.lru_key = f'{prefix}:lru'
+        self.bytes_key = f'{prefix}:bytes'
+        self.lock_key = f'{prefix}:lock'
+        self.video_prefix = f'{prefix}:video:'
+        self.info_prefix = f'{prefix}:info:'
+        self.pins_key = f'{prefix}:pins'
+        self.info_ttl = info_ttl
+
+    @staticmethod
+    def make_key(video_id, download_type, quality, format_selector):
+        # Audio downloads ignore the quality field, so keep it out of the key
+        if download_type == 'audio':
+            quality = ''
+        return f'{video_id}|{download_type}|{quality or ""}|{format_selector}'
+
+    # Key for a file no lookup can hit (unknown video id), indexed only so
+    # its bytes are counted and it can be evicted
+    @staticmethod
+    def file_key(filename):
+        return f'file|{filename}'
+
+    # Set of the video's cache keys, None for keys of unknown videos
+    def _video_key(self, key):
+        video_id, _, rest = key.partition('|')
+        return None if video_id == 'file' or not rest else self.video_prefix + video_id
+
+    def _lock(self):
+        return self.redis.lock(self.lock_key, timeout=60, blocking_timeout=30)
+
+    def get(self, key):
+        raw = self.redis.hget(self.entries_key, key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if not os.path.exists(os.path.join(self.outdir, entry['filename'])):
+            # The file was removed behind our back, forget about it
+            logger.warning(f"Cache entry {key} points at missing file {entry['filename']}")
+            with self._lock():
+                self._remove(key)
+            return None
+        self.redis.zadd(self.lru_key, {key: time.time()})
+        return entry
+
+    def put(self, key, filename, format_selector=None):
+        path = os.path.join(self.outdir, filename)
+        size = os.path.getsize(path)
+        entry = {'filename': filename, 'size': size, 'selector': format_selector, 'created': time.time()}
+        with self._lock():
+            # A new selector for the same output overwrote the file, the old
+            # entry must go without taking the file with it
+            previous = self.redis.hget(self.files_key, filename)
+            if previous is not None and previous.decode() != key:
+                self._remove(previous.decode())
+            old = self.redis.hget(self.entries_key, key)
+            pipe = self.redis.pipeline()
+            if old is not None:
+                pipe.decrby(self.bytes_key, json.loads(old)['size'])
+            pipe.hset(self.entries_key, key, json.dumps(entry))
+            pipe.hset(self.files_key, filename, key)
+            if self._video_key(key):
+                pipe.sadd(self._video_key(key), key)
+            pipe.zadd(self.lru_key, {key: time.time()})
+            pipe.incrby(self.bytes_key, size)
+            pipe.execute()
+            self._evict_to(self.max_bytes, keep=key)
+        return entry
+
+    # Entries of every finished download of a video whose file is still on
+    # disk, each with its cache key added
+    def entries_for(self, video_id):
+        keys = sorted(key.decode() for key in self.redis.smembers(self.video_prefix + video_id))
+        entries = []
+        for key, raw in zip(keys, self.redis.hmget(self.entries_key, keys) if keys else []):
+            if raw is None:
+                continue
+            entry = dict(json.loads(raw), key=key)
+            if os.path.exists(os.path.join(self.outdir, entry['filename'])):
+                entries.append(entry)
+        return entries
+
+    # Keeps what is known about a video with its files, so outputs built from
+    # them don't need a fresh extraction
+    def put_info(self, video_id, info):
+        kept = {k: v for k, v in info.items() if k not in DROPPED_FIELDS}
+        kept['formats'] = [{k: f[k] for k in FORMAT_FIELDS if k in f} for f in info.get('formats') or []]
+        raw = zlib.compress(json.dumps(kept, separators=(',', ':')).encode())
+        self.redis.set(self.info_prefix + video_id, raw, ex=self.info_ttl)
+
+    def info_for(self, video_id):
+        raw = self.redis.get(self.info_prefix + video_id)
+        return json.loads(zlib.decompress(raw)) if raw is not None else None
+
+    # Marks a file as just served, so LRU eviction goes by real use
+    def touch_file(self, filename):
+        key = self.redis.hget(self.files_key, filename)
+        if key is not None:
+            self.redis.zadd(self.lru_key, {key.decode(): time.time()}, xx=True)
+
+    # Keeps files from being evicted until the holder unpins them, or ttl
+    # seconds pass should it die first
+    def pin(self, holder, filenames, ttl):
+        if filenames:
+            self.redis.zadd(self.pins_key, {f'{holder}|{name}': time.time() + ttl for name in filenames})
+
+    def unpin(self, holder, filenames):
+        if filenames:
+            self.redis.zrem(self.pins_key, *[f'{holder}|{name}' for name in filenames])
+
+    # Filenames with a live pin, lapsed pins are dropped on the way
+    def pinned_files(self):
+        self.redis.zremrangebyscore(self.pins_key, '-inf', time.time())
+        members = self.redis.zrange(self.pins_key, 0, -1)
+        return {(m.decode() if isinstance(m, bytes) else m).partition('|')[2] for m in members}
+
+    def used_bytes(self):
+        return int(self.redis.get(self.bytes_key) or 0)
+
+    # Deletes files not used since idle_before, then least recently used ones
+    # until at most target_bytes are left. Pinned files are never deleted.
+    # Returns (files, bytes) evicted.
+    def evict(self, target_bytes, idle_before=None):
+        with self._lock():
+            files = freed = 0
+            if idle_before is not None:
+                pinned = self.pinned_files()
+                for key in self.redis.zrangebyscore(self.lru_key, '-inf', idle_before):
+                    key = key.decode() if isinstance(key, bytes) else key
+                    if self._filename(key) in pinned:
+                        continue
+                    logger.debug(f"Expiring cached download {key}")
+                    size = self._remove(key, delete_file=True)
+                    files, freed = files + 1, freed + size
+            evicted = self._evict_to(target_bytes)
+            return files + evicted[0], freed + evicted[1]
+
+    def stats(self):
+        pipe = self.redis.pipeline()
+        pipe.get(self.bytes_key)
+        pipe.hlen(self.entries_key)
+        total, count = pipe.execute()
+        return {'bytes': int(total or 0), 'entries': count, 'max_bytes': self.max_bytes}
+
+    # Must be called with the lock held, returns the bytes it uncounted
+    def _remove(self, key, delete_file=False):
+        raw = self.redis.hget(self.entries_key, key)
+        if raw is None:
+            self.redis.zrem(self.lru_key, key)
+            if self._video_key(key):
+                self.redis.srem(self._video_key(key), key)
+            return 0
+        entry = json.loads(raw)
+        if delete_file:
+            try:
+                os.remove(os.path.join(self.outdir, entry['filename']))
+            except FileNotFoundError:
+                pass
+        owner = self.redis.hget(self.files_key, entry['filename'])
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.entries_key, key)
+        if owner is not None and owner.decode() == key:
+            pipe.hdel(self.files_key, entry['filename'])
+        pipe.zrem(self.lru_key, key)
+        pipe.decrby(self.bytes_key, entry['size'])
+        video_key = self._video_key(key)
+        if video_key:
+            pipe.srem(video_key, key)
+            pipe.scard(video_key)
+        remaining = pipe.execute()[-1]
+        if video_key and not remaining:
+            self.redis.delete(self.info_prefix + video_key[len(self.video_prefix):])
+        return entry['size']
+
+    def _filename(self, key):
+        raw = self.redis.hget(self.entries_key, key)
+        return json.loads(raw)['filename'] if raw is not None else None
+
+    # Must be called with the lock held, returns (files, bytes) evicted.
+    # Walks the LRU oldest first, stepping over keep and pinned files.
+    def _evict_to(self, target_bytes, keep=None):
+        files = freed = skipped = 0
+        pinned = None
+        while self.used_bytes() > target_bytes:
+            oldest = self.redis.zrange(self.lru_key, skipped, skipped)
+            if not oldest:
+                break
+            key = oldest[0].decode() if isinstance(oldest[0], bytes) else oldest[0]
+            if pinned is None:
+                pinned = self.pinned_files()
+            if key == keep or self._filename(key) in pinned:
+                skipped += 1
+                continue
+            logger.debug(f"Evicting cached download {key}")
+            freed += self._remove(key, delete_file=True)
+            files += 1
+        return files, freed
@@ -0,0 +1,152 @@
+# Format resolution against an already extracted info dict.
+#
+# The chains below mirror the yt-dlp selectors download_task used to run
+# one after the other, primary first and fallback second, but are evaluated
+# in a single pass over info['formats'] so a failed selection never costs a
+# second extraction or transfer. yt-dlp sorts info['formats'] worst to best,
+# so "best" is the last match.
+
+
+class FormatUnavailable(Exception):
+    pass
+
+
+# Selector recorded for a file holding one format exactly as it was served
+# (a /api/stream tee): a source for post-processing, never a finished output
+RAW_PREFIX = 'stream:'
+
+
+def raw_selector(format_id):
+    return RAW_PREFIX + format_id
+
+
+# info's formats by format id. A single-format info dict (no 'formats' list)
+# is its own only format.
+def formats_by_id(info):
+    return {f.get('format_id'): f for f in info.get('formats') or [info]}
+
+
+def _has_video(f):
+    return f.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(f):
+    return f.get('acodec') not in (None, 'none')
+
+
+def _avc1(f):
+    return (f.get('vcodec') or '').startswith('avc1')
+
+
+def _mp4(f):
+    return f.get('ext') == 'mp4'
+
+
+def _m4a(f):
+    return f.get('ext') == 'm4a'
+
+
+def _height_at_most(cap):
+    # Like yt-dlp's [height<=N], formats without a height never match
+    return lambda f: cap is None or (f.get('height') is not None and f['height'] <= cap)
+
+
+def _best(formats, *checks):
+    matches = [f for f in formats if all(check(f) for check in checks)]
+    return matches[-1] if matches else None
+
+
+def _video_only(f):
+    return _has_video(f) and not _has_audio(f)
+
+
+def _audio_only(f):
+    return _has_audio(f) and not _has_video(f)
+
+
+def _muxed(f):
+    return _has_video(f) and _has_audio(f)
+
+
+# Returns (format spec for -f, whether the fallback chain was needed)
+def select_formats(info, download_type, quality):
+    formats = info.get('formats') or [info]
+
+    if download_type == 'audio':
+        audio = _best(formats, _audio_only, _m4a)
+        if not audio:
+            raise FormatUnavailable('No M4A audio format available')
+        return audio['format_id'], False
+
+    cap = None if quality == 'best' else int(quality)
+    within_cap = _height_at_most(cap)
+    best_audio = _best(formats, _audio_only, _m4a)
+
+    # Primary chain: H.264 mp4 video (capped at 1080p for 'best') + m4a audio,
+    # then pre-muxed mp4, then any pre-muxed H.264
+    video = _best(formats, _video_only, _avc1, _mp4, _height_at_most(cap or 1080))
+    if video and best_audio:
+        return f"{video['format_id']}+{best_audio['format_id']}", False
+    single = _best(formats, _muxed, _mp4, within_cap) or _best(formats, _muxed, _avc1, within_cap)
+    if single:
+        return single['format_id'], False
+
+    # Fallback chain: any H.264 mp4 stream with video (muxed or not, and
+    # uncapped for 'best') + m4a audio. Its pre-muxed H.264 alternative is
+    # already covered by the primary chain.
+    video = _best(formats, _has_video, _avc1, _mp4, within_cap)
+    if video and best_audio:
+        return f"{video['format_id']}+{best_audio['format_id']}", True
+
+    raise FormatUnavailable(f'No H.264 format available at {quality}p or below' if cap else 'No H.264 format available')
+
+
+# Format that can be piped to a client as-is: a single file, no merge. Audio
+# is the usual m4a, video has to be pre-muxed.
+def select_stream_format(info, download_type, quality):
+    formats = info.get('formats') or [info]
+    if download_type == 'audio':
+        return select_formats(info, download_type, quality)[0]
+    within_cap = _height_at_most(None if quality == 'best' else int(quality))
+    single = _best(formats, _muxed, _mp4, within_cap) or _best(formats, _muxed, _avc1, within_cap)
+    if not single:
+        raise FormatUnavailable('No pre-muxed format available for streaming')
+    return single['format_id']
+
+
+# Rough size in bytes of a format spec from select_formats, None when the
+# metadata has neither sizes nor bitrates for one of its parts
+def estimate_size(info, format_spec):
+    formats = formats_by_id(info)
+    total = 0
+    for format_id in format_spec.split('+'):
+        f = formats.get(format_id, {})
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and info.get('duration'):
+            size = f['tbr'] * 1000 / 8 * info['duration']
+        if not size:
+            return None
+        total += size
+    return int(total)
+
+
+# Which formats of format_spec are already on disk, going by download cache
+# entries (filename, selector) of the same video. Returns {format id:
+# (filename, stream)} where stream is the ffmpeg stream specifier of the
+# format inside that file, None for the whole file. The files hold one video
+# and one audio stream of their own (merges are muxed video first, audio
+# files may add a cover picture after the audio), so a format is the first
+# stream of its kind.
+def local_streams(info, format_spec, entries):
+    formats = formats_by_id(info)
+    found = {}
+    for format_id in format_spec.split('+'):
+        f = formats.get(format_id, {})
+        stream = 'v:0' if _video_only(f) else 'a:0' if _audio_only(f) else None
+        for entry in entries:
+            parts = (entry.get('selector') or '').removeprefix(RAW_PREFIX).split('+')
+            # A muxed format can only be reused as the whole file
+            if format_id in parts and (stream or parts == [format_id]):
+                found[format_id] = (entry['filename'], stream)
+                break
+    return found
@@ -0,0 +1,89 @@
+import json
+import logging
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Extraction failed recently, the cached message is reused until it expires
+class CachedExtractionError(Exception):
+    pass
+
+
+# Shared cache of yt-dlp info dicts, so probing formats and downloading the
+# same video only extract once.
+#
+#   <prefix>:entry:<key>   zlib compressed JSON info dict, expires after ttl
+#   <prefix>:error:<key>   message of a failed extraction, expires after negative_ttl
+#   <prefix>:lru           zset key -> last access, bounds the number of entries
+#
+# Concurrent misses for the same key wait on <prefix>:lock:<key> so only one
+# of them actually extracts.
+class InfoCache:
+    def __init__(self, redis_client, ttl, negative_ttl, max_entries, prefix='ytinfo'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.lru_key = f'{prefix}:lru'
+
+    def _entry_key(self, key):
+        return f'{self.prefix}:entry:{key}'
+
+    def _error_key(self, key):
+        return f'{self.prefix}:error:{key}'
+
+    def get(self, key):
+        pipe = self.redis.pipeline()
+        pipe.get(self._entry_key(key))
+        pipe.get(self._error_key(key))
+        raw, error = pipe.execute()
+        if error is not None:
+            raise CachedExtractionError(error.decode())
+        if raw is None:
+            return None
+        self.redis.zadd(self.lru_key, {key: time.time()})
+        return json.loads(zlib.decompress(raw))
+
+    def put(self, key, info):
+        raw = zlib.compress(json.dumps(info, separators=(',', ':')).encode())
+        pipe = self.redis.pipeline()
+        pipe.set(self._entry_key(key), raw, ex=self.ttl)
+        pipe.zadd(self.lru_key, {key: time.time()})
+        pipe.zcard(self.lru_key)
+        count = pipe.execute()[-1]
+        if count > self.max_entries:
+            for victim, _ in self.redis.zpopmin(self.lru_key, count - self.max_entries):
+                victim = victim.decode() if isinstance(victim, bytes) else victim
+                self.redis.delete(self._entry_key(victim))
+
+    # Forgets an entry and any cached failure, e.g. once its format URLs expired
+    def invalidate(self, key):
+        self.redis.delete(self._entry_key(key), self._error_key(key))
+
+    def put_error(self, key, message):
+        self.redis.set(self._error_key(key), message, ex=self.negative_ttl)
+
+    # Returns the cached info dict, or calls extract() once across all
+    # processes and caches the result. failures is the exception type that
+    # gets negatively cached, unless permanent(error) says another attempt
+    # may well succeed (a rate limit, a 503), then it is only re-raised.
+    def get_or_extract(self, key, extract, failures=(), permanent=None):
+        info = self.get(key)
+        if info is not None:
+            return info
+        with self.redis.lock(f'{self.prefix}:lock:{key}', timeout=120, blocking_timeout=120):
+            # Someone else may have extracted it while we were waiting
+            info = self.get(key)
+            if info is not None:
+                return info
+            try:
+                info = extract()
+            except failures as e:
+                if permanent is None or permanent(e):
+                    self.put_error(key, str(e))
+                raise
+            self.put(key, info)
+            return info
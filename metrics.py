@@ -0,0 +1,141 @@
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+# Fixed bucket bounds, shared by every process so their counts add up
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = tuple(2 ** n for n in range(16, 36, 2))  # 64 KiB .. 16 GiB
+RATE_BUCKETS = tuple(2 ** n for n in range(14, 32, 2))  # 16 KiB/s .. 1 GiB/s
+
+HISTOGRAMS = {
+    'ytdl_queue_latency_seconds': ('Time a download waited in the queue before a worker started it', SECONDS_BUCKETS),
+    'ytdl_phase_duration_seconds': ('Time spent per job phase (extract, download, merge, embed, postprocess)', SECONDS_BUCKETS),
+    'ytdl_transfer_bytes_per_second': ('Output bytes over download phase time, per job', RATE_BUCKETS),
+    'ytdl_output_bytes': ('Size of finished downloads', BYTES_BUCKETS),
+}
+COUNTERS = {
+    'ytdl_jobs_total': 'Finished download jobs by type and outcome',
+    'ytdl_failures_total': 'Failed download attempts by failure class',
+    'ytdl_retries_total': 'Download retries by reason',
+    'ytdl_cache_requests_total': 'Download and info cache lookups by cache and result',
+    'ytdl_format_fallbacks_total': 'Downloads that needed the fallback format chain',
+    'ytdl_local_derivations_total': 'Outputs built from files already on disk (link, remux or partial download)',
+    'ytdl_admission_rejections_total': 'Requests turned away by admission control by reason (rate, client, queue)',
+}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+
+def _braces(labels):
+    return f'{{{labels}}}' if labels else ''
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# Counters and histograms kept in Redis so every web process and worker adds
+# to the same series, rendered in the Prometheus text format.
+#
+#   <prefix>:counter:<name>   hash  label string -> value
+#   <prefix>:hist:<name>      hash  "<labels>|<bucket index>", "<labels>|sum", "<labels>|count"
+#
+# Histogram observations bump a single bucket, the cumulative counts are
+# computed when rendering. Recording never raises, a metrics outage must not
+# fail a download.
+class Metrics:
+    def __init__(self, redis_client, prefix='metrics'):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def _write(self, commands):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for command, args in commands:
+                getattr(pipe, command)(*args)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record metrics: {e}")
+
+    def inc(self, name, amount=1, **labels):
+        self._write([('hincrbyfloat', (f'{self.prefix}:counter:{name}', _labels(labels), amount))])
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        key, series = f'{self.prefix}:hist:{name}', _labels(labels)
+        self._write([
+            ('hincrby', (key, f'{series}|{index}', 1)),
+            ('hincrbyfloat', (key, f'{series}|sum', value)),
+            ('hincrby', (key, f'{series}|count', 1)),
+        ])
+
+    # gauges: {name: (help, value)} computed by the caller at scrape time
+    def render(self, gauges=None):
+        pipe = self.redis.pipeline(transaction=False)
+        for name in COUNTERS:
+            pipe.hgetall(f'{self.prefix}:counter:{name}')
+        for name in HISTOGRAMS:
+            pipe.hgetall(f'{self.prefix}:hist:{name}')
+        replies = pipe.execute()
+        lines = []
+
+        for name, raw in zip(COUNTERS, replies[:len(COUNTERS)]):
+            lines += [f'# HELP {name} {COUNTERS[name]}', f'# TYPE {name} counter']
+            for series, value in sorted(raw.items()):
+                lines.append(f'{name}{_braces(series.decode())} {_number(value)}')
+
+        for name, raw in zip(HISTOGRAMS, replies[len(COUNTERS):]):
+            help_text, buckets = HISTOGRAMS[name]
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            series_data = {}
+            for field, value in raw.items():
+                series, _, part = field.decode().rpartition('|')
+                series_data.setdefault(series, {})[part] = float(value)
+            for series, parts in sorted(series_data.items()):
+                cumulative = 0
+                for i, bound in enumerate(buckets + (math.inf,)):
+                    cumulative += parts.get(str(i), 0)
+                    le = '+Inf' if bound == math.inf else _number(bound)
+                    bucket_labels = ','.join(filter(None, [series, f'le="{le}"']))
+                    lines.append(f'{name}_bucket{{{bucket_labels}}} {_number(cumulative)}')
+                lines.append(f'{name}_sum{_braces(series)} {_number(parts.get("sum", 0))}')
+                lines.append(f'{name}_count{_braces(series)} {_number(parts.get("count", 0))}')
+
+        for name, (help_text, value) in (gauges or {}).items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {_number(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+# Records how long a job spends in each phase. Wraps a progress callback:
+# every phase change reported by yt-dlp closes the previous phase.
+class PhaseTimer:
+    def __init__(self, callback=None, phase='download'):
+        self.callback = callback
+        self.phase = phase
+        self.started = time.monotonic()
+        self.durations = {}
+
+    def __call__(self, progress):
+        if progress['phase'] != self.phase:
+            self._close(progress['phase'])
+        if self.callback:
+            self.callback(progress)
+
+    def _close(self, next_phase=None):
+        now = time.monotonic()
+        self.durations[self.phase] = self.durations.get(self.phase, 0) + now - self.started
+        self.phase, self.started = next_phase, now
+
+    # Closes the running phase and returns {phase: seconds}
+    def finish(self):
+        if self.phase is not None:
+            self._close()
+        return self.durations
@@ -0,0 +1,102 @@
+import logging
+import os
+import subprocess
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# Lines of ffmpeg's log kept for the error message
+TAIL_LINES = 20
+
+# Thumbnail formats an mp4/m4a container takes as they are, anything else
+# (webp mostly) is re-encoded, which only touches the picture
+COPYABLE_THUMBNAILS = ('.jpg', '.jpeg', '.png')
+
+
+# ffmpeg failed, output holds the tail of its log
+class FFmpegError(Exception):
+    def __init__(self, output, returncode=1):
+        super().__init__(output)
+        self.output = output
+        self.returncode = returncode
+
+
+# Tags written to the output, the fields yt-dlp's --add-metadata uses most
+def metadata_for(info):
+    upload_date = info.get('upload_date') or ''
+    tags = {
+        'title': info.get('track') or info.get('title'),
+        'artist': info.get('artist') or info.get('creator') or info.get('uploader') or info.get('uploader_id'),
+        'album': info.get('album'),
+        'date': upload_date[:4] if len(upload_date) >= 4 else None,
+        'description': info.get('description'),
+        'comment': info.get('webpage_url'),
+    }
+    return {name: str(value) for name, value in tags.items() if value}
+
+
+# URL of the best thumbnail, preferring ones the container can take as they are.
+# yt-dlp sorts info['thumbnails'] worst to best.
+def thumbnail_url(info):
+    thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+    for thumbnail in reversed(thumbnails):
+        if os.path.splitext(thumbnail['url'].split('?')[0])[1].lower() in COPYABLE_THUMBNAILS:
+            return thumbnail['url']
+    return thumbnails[-1]['url'] if thumbnails else info.get('thumbnail')
+
+
+# Saves the thumbnail next to the streams, as path plus the URL's extension.
+# Returns the file or None: a missing thumbnail never fails a download.
+def fetch_thumbnail(url, path, timeout=15):
+    if not url:
+        return None
+    path += os.path.splitext(url.split('?')[0])[1].lower() or '.jpg'
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response, open(path, 'wb') as f:
+            f.write(response.read())
+    except OSError as e:
+        logger.warning(f"Could not fetch thumbnail {url}: {e}")
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    return path
+
+
+# One ffmpeg pass that muxes the separately downloaded streams, writes the
+# tags and attaches the thumbnail. Every stream is copied, only a thumbnail
+# the container can't hold as is gets encoded. video_streams is how many
+# video streams come before the thumbnail in the output. maps picks one
+# stream per input (e.g. 'a:0' to take only the audio of a finished video),
+# None takes the whole input.
+def build_command(ffmpeg_bin, streams, output, metadata=None, thumbnail=None, video_streams=0, maps=None):
+    cmd = [ffmpeg_bin, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y']
+    for path in streams:
+        cmd += ['-i', path]
+    if thumbnail:
+        cmd += ['-i', thumbnail]
+    maps = list(maps or [None] * len(streams)) + ([None] if thumbnail else [])
+    for index, stream in enumerate(maps):
+        cmd += ['-map', f'{index}:{stream}' if stream else str(index)]
+    cmd += ['-c', 'copy']
+    if thumbnail:
+        if os.path.splitext(thumbnail)[1] not in COPYABLE_THUMBNAILS:
+            cmd += [f'-c:v:{video_streams}', 'mjpeg']
+        cmd += [f'-disposition:v:{video_streams}', 'attached_pic']
+    for name, value in (metadata or {}).items():
+        cmd += ['-metadata', f'{name}={value}']
+    return cmd + [output]
+
+
+# Runs build_command's ffmpeg into a temporary file next to output and moves
+# it into place, so a half written file never carries the final name
+def run_postprocess(ffmpeg_bin, streams, output, metadata=None, thumbnail=None, video_streams=0, maps=None):
+    base, ext = os.path.splitext(output)
+    temp = f'{base}.temp{ext}'
+    result = subprocess.run(build_command(ffmpeg_bin, streams, temp, metadata, thumbnail, video_streams, maps),
+                            capture_output=True, text=True, errors='replace')
+    if result.returncode:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise FFmpegError('\n'.join(result.stderr.splitlines()[-TAIL_LINES:]), result.returncode)
+    os.replace(temp, output)
+    return output
@@ -0,0 +1,247 @@
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from ytdlp_runner import YtdlpError
+
+try:
+    from yt_dlp.utils import sanitize_filename
+except ImportError:  # the CLI is enough, names then only lose the characters no filesystem takes
+    sanitize_filename = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+READ_SIZE = 256 * 1024
+
+
+# The server ignores Range requests, the format has to go through yt-dlp
+class RangesUnsupported(Exception):
+    pass
+
+
+# One failed chunk request, message worded like yt-dlp's so is_transient and
+# is_throttled read it the same way
+class ChunkError(Exception):
+    pass
+
+
+# Formats served as one plain HTTP file. DASH/HLS manifests are fragmented
+# already and yt-dlp parallelises those itself.
+def rangeable(fmt):
+    return fmt.get('protocol') in ('http', 'https') and bool(fmt.get('url'))
+
+
+# A title as yt-dlp puts it in a filename
+def safe_title(title):
+    title = title or 'video'
+    return sanitize_filename(title) if sanitize_filename else re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', title)
+
+
+# Path yt-dlp would give fmt under an output template using the title, id,
+# format_id and ext fields, so either way of downloading lands on one name
+def output_path(template, info, fmt):
+    fields = {'title': safe_title(info.get('title')), 'id': info.get('id'), 'format_id': fmt.get('format_id'), 'ext': fmt.get('ext')}
+    return re.sub(r'%\((\w+)\)s', lambda m: str(fields.get(m.group(1)) or 'NA'), template)
+
+
+# Bytes an unfinished RangeDownloader run has fetched of path, from its chunk list
+def fetched_bytes(path):
+    try:
+        with open(f'{path}.rpart.chunks') as f:
+            lines = f.read().split('\n')
+        size, chunk_size = (int(n) for n in lines[0].split())
+    except (OSError, ValueError):
+        return 0
+    starts = {int(line) * chunk_size for line in lines[1:] if line.isdigit()}
+    return sum(min(chunk_size, size - start) for start in starts if start < size)
+
+
+def _open(url, headers, start, end, timeout):
+    request = urllib.request.Request(url, headers=dict(headers or {}, Range=f'bytes={start}-{end}'))
+    try:
+        return urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        raise ChunkError(f'HTTP Error {e.code}: {e.reason}')
+    except (urllib.error.URLError, OSError) as e:
+        raise ChunkError(str(e))
+
+
+# Total size of the file behind url, from a one byte range request
+def probe_size(url, headers=None, timeout=30):
+    with _open(url, headers, 0, 0, timeout) as response:
+        match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        if response.status != 206 or not match:
+            raise RangesUnsupported(f'{url} does not answer range requests')
+        return int(match.group(3))
+
+
+# Shared bytes/sec budget of all connections of one download
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.consumed = 0
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            self.consumed += size
+            ahead = self.consumed / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# Downloads a plain HTTP file over several connections at once. The file is
+# split into chunk_size byte ranges that `connections` threads take in turn
+# and pwrite() at their offset into a preallocated <path>.rpart. A failed
+# chunk is retried on its own, up to `retries` times with backoff.
+#
+# Finished chunk numbers are appended to <path>.rpart.chunks, so a later
+# attempt (a task retry) only fetches what is missing. The .rpart name keeps
+# yt-dlp from taking the preallocated file for a nearly finished .part.
+class RangeDownloader:
+    def __init__(self, connections, chunk_size=8 * 1024 * 1024, retries=3, backoff=1.0, rate_limit=None,
+                 timeout=30):
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+
+    def download(self, url, path, headers=None, size=None, on_progress=None):
+        try:
+            size = size or probe_size(url, headers, self.timeout)
+        except ChunkError as e:
+            raise YtdlpError(f'ERROR: unable to download video data: {e}')
+        part, state = f'{path}.rpart', f'{path}.rpart.chunks'
+        chunks = [(start, min(start + self.chunk_size, size) - 1) for start in range(0, size, self.chunk_size)]
+        done = self._load_state(state, size) if os.path.exists(part) else set()
+
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                done = set()
+                self._preallocate(fd, size)
+            with open(state, 'w' if not done else 'a') as log:
+                if not done:
+                    log.write(f'{size} {self.chunk_size}\n')
+                    log.flush()
+                self._fetch_all(url, headers, fd, chunks, done, log, size, on_progress)
+        except RangesUnsupported:
+            # Nothing here can be resumed, yt-dlp starts over
+            for leftover in (part, state):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+        finally:
+            os.close(fd)
+        os.replace(part, path)
+        os.remove(state)
+        return path
+
+    def _load_state(self, state, size):
+        try:
+            with open(state) as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return set()
+        # Chunks of another size or layout can't be trusted
+        if lines[0] != f'{size} {self.chunk_size}':
+            return set()
+        return {int(line) for line in lines[1:] if line.isdigit()}
+
+    @staticmethod
+    def _preallocate(fd, size):
+        os.ftruncate(fd, 0)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass  # e.g. filesystems without fallocate support
+        os.ftruncate(fd, size)
+
+    def _fetch_all(self, url, headers, fd, chunks, done, log, size, on_progress):
+        todo = queue.Queue()
+        for index in range(len(chunks)):
+            if index not in done:
+                todo.put(index)
+        limiter = RateLimiter(self.rate_limit)
+        lock = threading.Lock()
+        progress = {'downloaded': sum(chunks[i][1] - chunks[i][0] + 1 for i in done), 'error': None}
+        resumed = progress['downloaded']
+        started = time.monotonic()
+
+        # Progress callbacks are not thread safe, they run one at a time
+        def report(amount):
+            with lock:
+                progress['downloaded'] += amount
+                downloaded = progress['downloaded']
+                if on_progress:
+                    speed = (downloaded - resumed) / max(time.monotonic() - started, 1e-6)
+                    on_progress({'phase': 'download', 'downloaded_bytes': downloaded, 'total_bytes': size,
+                                 'speed': speed, 'eta': (size - downloaded) / speed if speed else None})
+
+        def worker():
+            while progress['error'] is None:
+                try:
+                    index = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._fetch_chunk(url, headers, fd, chunks[index], size, limiter, report)
+                except (ChunkError, RangesUnsupported) as e:
+                    progress['error'] = e
+                    return
+                with lock:
+                    log.write(f'{index}\n')
+                    log.flush()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(self.connections, len(chunks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if isinstance(progress['error'], RangesUnsupported):
+            raise progress['error']
+        if progress['error'] is not None:
+            raise YtdlpError(f'ERROR: unable to download video data: {progress["error"]}')
+
+    # One range with its own retries; a retry continues after the bytes
+    # already written
+    def _fetch_chunk(self, url, headers, fd, chunk, size, limiter, report):
+        start, end = chunk
+        offset = start
+        for attempt in range(self.retries + 1):
+            try:
+                with _open(url, headers, offset, end, self.timeout) as response:
+                    match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                    if response.status != 206 or not match or int(match.group(1)) != offset \
+                            or int(match.group(3)) != size:
+                        # Not a flaky chunk: the server ignores ranges (or serves another file)
+                        raise RangesUnsupported(f'Unexpected answer to range {offset}-{end}: HTTP {response.status} '
+                                                f'{response.headers.get("Content-Range")}')
+                    while offset <= end:
+                        data = response.read(min(READ_SIZE, end - offset + 1))
+                        if not data:
+                            raise ChunkError(f'IncompleteRead: range {start}-{end} ended at {offset}')
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        limiter.consume(len(data))
+                        report(len(data))
+                return
+            except (ChunkError, OSError) as e:
+                if attempt == self.retries:
+                    raise ChunkError(str(e))
+                delay = self.backoff * 2 ** attempt
+                logger.debug(f"Range {offset}-{end} failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
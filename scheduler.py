@@ -0,0 +1,189 @@
+import logging
+import time
+import uuid
+from urllib.parse import urlparse
+
+from formats import formats_by_id
+
+logger = logging.getLogger(__name__)
+
+# Gives back the fragments and job slot of a grant, unless that already happened
+GIVE_BACK = """
+local function give_back(grant_key)
+    local grant = redis.call('hmget', grant_key, 'host', 'worker', 'fragments')
+    if not grant[1] then
+        return 0
+    end
+    redis.call('del', grant_key)
+    for _, key in ipairs({grant[1], grant[2]}) do
+        if redis.call('exists', key) == 1 then
+            if redis.call('hincrby', key, 'active', -tonumber(grant[3])) < 0 then redis.call('hset', key, 'active', 0) end
+            if redis.call('hincrby', key, 'jobs', -1) < 0 then redis.call('hset', key, 'jobs', 0) end
+        end
+    end
+    return 1
+end
+"""
+
+# KEYS: host hash, worker hash, grant deadlines zset, grant hash
+# ARGV: speed share, worker budget, host budget, initial window, now, deadline,
+#       grant key prefix, grant id
+ACQUIRE_SCRIPT = GIVE_BACK + """
+-- Grants of workers that died without releasing them
+local lapsed = redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[5], 'LIMIT', 0, 100)
+for _, id in ipairs(lapsed) do
+    give_back(ARGV[7] .. id)
+    redis.call('zrem', KEYS[3], id)
+end
+local window = tonumber(redis.call('hget', KEYS[1], 'window')) or tonumber(ARGV[4])
+local share = tonumber(ARGV[1])
+local want = 1
+if share > 0 then
+    want = math.max(1, math.floor(window * share))
+end
+local host_free = tonumber(ARGV[3]) - (tonumber(redis.call('hget', KEYS[1], 'active')) or 0)
+local worker_free = tonumber(ARGV[2]) - (tonumber(redis.call('hget', KEYS[2], 'active')) or 0)
+local grant = math.max(1, math.min(want, host_free, worker_free))
+redis.call('hincrby', KEYS[1], 'active', grant)
+redis.call('hincrby', KEYS[2], 'active', grant)
+local host_jobs = redis.call('hincrby', KEYS[1], 'jobs', 1)
+local worker_jobs = redis.call('hincrby', KEYS[2], 'jobs', 1)
+redis.call('expire', KEYS[1], 86400)
+redis.call('expire', KEYS[2], 86400)
+redis.call('hset', KEYS[4], 'host', KEYS[1], 'worker', KEYS[2], 'fragments', grant)
+redis.call('expireat', KEYS[4], math.ceil(tonumber(ARGV[6])) + 86400)
+redis.call('zadd', KEYS[3], ARGV[6], ARGV[8])
+return {grant, host_jobs, worker_jobs, #lapsed}
+"""
+
+# KEYS: host hash, worker hash, grant deadlines zset, grant hash
+# ARGV: grant id, throttled (0/1), bytes/sec per fragment, min window, max window,
+#       initial window, EWMA weight
+RELEASE_SCRIPT = GIVE_BACK + """
+give_back(KEYS[4])
+redis.call('zrem', KEYS[3], ARGV[1])
+local window = tonumber(redis.call('hget', KEYS[1], 'window')) or tonumber(ARGV[6])
+local min_window, max_window = tonumber(ARGV[4]), tonumber(ARGV[5])
+local rate = tonumber(ARGV[3])
+local ewma = tonumber(redis.call('hget', KEYS[1], 'rate'))
+if ARGV[2] == '1' then
+    window = math.max(min_window, window / 2)
+elseif rate > 0 then
+    if ewma and rate < ewma / 2 then
+        -- More fragments stopped paying off, back off gently
+        window = math.max(min_window, window * 0.75)
+    else
+        window = math.min(max_window, window + 1)
+    end
+    local alpha = tonumber(ARGV[7])
+    ewma = ewma and (ewma * (1 - alpha) + rate * alpha) or rate
+    redis.call('hset', KEYS[1], 'rate', ewma)
+end
+redis.call('hset', KEYS[1], 'window', window)
+return tostring(window)
+"""
+
+# How much of the host's current window each speed option asks for, 0 means a
+# single connection
+SPEED_SHARES = {'normal': 0, 'fast': 0.5, 'max': 1.0}
+
+# yt-dlp errors that mean the upstream wants us to slow down
+THROTTLE_MARKERS = ('HTTP Error 429', 'HTTP Error 403', 'Too Many Requests')
+
+
+def upstream_host(info, format_spec):
+    formats = formats_by_id(info)
+    for format_id in format_spec.split('+'):
+        url = formats.get(format_id, {}).get('url')
+        if url:
+            return urlparse(url).hostname or info.get('extractor_key') or 'unknown'
+    return info.get('extractor_key') or 'unknown'
+
+
+def is_throttled(message):
+    return any(marker in (message or '') for marker in THROTTLE_MARKERS)
+
+
+class Grant:
+    def __init__(self, id, host, worker, fragments, rate_limit):
+        self.id = id
+        self.host = host
+        self.worker = worker
+        self.fragments = fragments
+        self.rate_limit = rate_limit
+        self.started = time.monotonic()
+
+    def ytdlp_args(self):
+        args = ['--concurrent-fragments', str(self.fragments)]
+        if self.rate_limit:
+            args += ['--limit-rate', str(self.rate_limit)]
+        return args
+
+
+# Owns the fragment/connection budget of every worker and upstream host.
+#
+#   sched:host:<host>      hash  active fragments, jobs, AIMD window, EWMA bytes/sec per fragment
+#   sched:worker:<name>    hash  active fragments, jobs
+#   sched:grant:<id>       hash  host and worker keys and fragments of a running grant
+#   sched:grant-deadlines  zset  grant id -> time the grant lapses
+#
+# Each job asks for a share of its host's window (see SPEED_SHARES) and gets
+# at most what is left of the host and worker budgets, but never less than one
+# fragment. When it finishes the window grows by one (additive increase), is
+# halved when the upstream throttled us (multiplicative decrease), and shrinks
+# gently when per-fragment throughput collapses. Bandwidth caps are split
+# evenly over the jobs sharing a host or worker.
+#
+# A grant a worker never releases (SIGKILL, OOM) is given back by the first
+# acquire after its deadline, grant_ttl seconds after it was handed out. A
+# grant released after that has nothing left to give back.
+class FragmentScheduler:
+    def __init__(self, redis_client, worker_budget, host_budget, initial_window, min_window=1, max_window=16,
+                 host_bandwidth=0, worker_bandwidth=0, ewma_weight=0.3, grant_ttl=7200):
+        self.redis = redis_client
+        self.worker_budget = worker_budget
+        self.host_budget = host_budget
+        self.initial_window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.host_bandwidth = host_bandwidth
+        self.worker_bandwidth = worker_bandwidth
+        self.ewma_weight = ewma_weight
+        self.grant_ttl = grant_ttl
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def _keys(self, host, worker, grant_id):
+        return [f'sched:host:{host}', f'sched:worker:{worker}', 'sched:grant-deadlines', f'sched:grant:{grant_id}']
+
+    def acquire(self, host, worker, speed):
+        share = SPEED_SHARES.get(speed, 0)
+        grant_id = uuid.uuid4().hex
+        now = time.time()
+        fragments, host_jobs, worker_jobs, lapsed = self._acquire(
+            keys=self._keys(host, worker, grant_id),
+            args=[share, self.worker_budget, self.host_budget, self.initial_window, now, now + self.grant_ttl,
+                  'sched:grant:', grant_id])
+        if lapsed:
+            logger.warning(f"Gave back {lapsed} lapsed fragment grants")
+        caps = []
+        if self.host_bandwidth:
+            caps.append(self.host_bandwidth // max(1, host_jobs))
+        if self.worker_bandwidth:
+            caps.append(self.worker_bandwidth // max(1, worker_jobs))
+        grant = Grant(grant_id, host, worker, int(fragments), min(caps) if caps else None)
+        logger.debug(f"Granted {grant.fragments} fragments on {host} (rate limit {grant.rate_limit})")
+        return grant
+
+    # downloaded_bytes counts only what was fetched under this grant, not what
+    # a resumed transfer already had. A grant that fetched nothing (the file
+    # was there already) says nothing about the host and leaves its window
+    # and rate alone unless it was throttled.
+    def release(self, grant, downloaded_bytes=0, throttled=False):
+        elapsed = max(time.monotonic() - grant.started, 0.001)
+        rate = downloaded_bytes / elapsed / grant.fragments if downloaded_bytes else 0
+        window = self._release(
+            keys=self._keys(grant.host, grant.worker, grant.id),
+            args=[grant.id, 1 if throttled else 0, rate, self.min_window, self.max_window,
+                  self.initial_window, self.ewma_weight])
+        logger.debug(f"Window for {grant.host} is now {float(window):.2f}")
@@ -0,0 +1,55 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Only delete the lease if it still belongs to the task releasing it
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Coalesces identical in-flight jobs onto one Celery task.
+#
+#   <prefix>:lease:<job key>   id of the task currently running the job
+#   <prefix>:alias:<task id>   id of the task a follower is attached to
+#
+# The first caller for a job key becomes the leader and enqueues the real
+# task. Later callers get their own task id, aliased to the leader, so
+# task_status can resolve every id to the one shared result.
+class SingleFlight:
+    def __init__(self, redis_client, ttl, prefix='inflight'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def _lease_key(self, key):
+        return f'{self.prefix}:lease:{key}'
+
+    def _alias_key(self, task_id):
+        return f'{self.prefix}:alias:{task_id}'
+
+    # Returns the id of the task that will run the job, task_id itself if the
+    # caller became the leader
+    def join(self, key, task_id):
+        lease_key = self._lease_key(key)
+        while True:
+            if self.redis.set(lease_key, task_id, nx=True, ex=self.ttl):
+                return task_id
+            leader = self.redis.get(lease_key)
+            if leader is not None:
+                leader = leader.decode()
+                self.redis.set(self._alias_key(task_id), leader, ex=self.ttl)
+                logger.debug(f"Task {task_id} attached to in-flight task {leader}")
+                return leader
+            # The leader finished between SET and GET, try to take over
+
+    def release(self, key, task_id):
+        self._release(keys=[self._lease_key(key)], args=[task_id])
+
+    def resolve(self, task_id):
+        leader = self.redis.get(self._alias_key(task_id))
+        return leader.decode() if leader is not None else task_id
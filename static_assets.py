@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import re
+
+try:
+    import brotli
+except ImportError:  # gzip alone still covers every browser
+    brotli = None
+
+STYLE_RE = re.compile(r'<style>(.*?)</style>', re.S)
+SCRIPT_RE = re.compile(r'<script>(.*?)</script>', re.S)
+QUALITY_RE = re.compile(r';\s*q=([0-9.]+)')
+
+# Preferred first; identity is always there
+ENCODINGS = (
+    ('br', 'br', lambda body: brotli.compress(body, quality=11) if brotli else None),
+    ('gzip', 'gz', lambda body: gzip.compress(body, 9, mtime=0)),
+)
+
+
+# Encodings of an Accept-Encoding header with their q values
+def accepted_encodings(header):
+    accepted = {}
+    for part in (header or '').split(','):
+        name = part.split(';')[0].strip().lower()
+        if not name:
+            continue
+        match = QUALITY_RE.search(part)
+        try:
+            accepted[name] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            accepted[name] = 0.0
+    return accepted
+
+
+# Entity tags of an If-None-Match header, weak ones compared as strong as
+# RFC 9110 asks for this header
+def none_match(header, etag):
+    tags = [tag.strip() for tag in (header or '').split(',')]
+    return any(tag == '*' or tag.removeprefix('W/') == etag for tag in tags)
+
+
+# One file built at startup, held in memory in every encoding that makes it
+# smaller. Each representation has its own strong ETag, derived from the
+# content, so it is stable across processes and restarts.
+class Asset:
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        digest = hashlib.sha256(body).hexdigest()
+        self.fingerprint = digest[:12]
+        self.variants = {'identity': (body, f'"{digest[:32]}"')}
+        for encoding, suffix, compress in ENCODINGS:
+            compressed = compress(body)
+            if compressed is not None and len(compressed) < len(body):
+                self.variants[encoding] = (compressed, f'"{digest[:32]}-{suffix}"')
+
+    def select(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, _, _ in ENCODINGS:
+            if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return 'identity'
+
+    # Status, headers and body answering a GET with these request headers
+    def respond(self, accept_encoding, if_none_match, cache_control):
+        encoding = self.select(accept_encoding)
+        body, etag = self.variants[encoding]
+        headers = [('ETag', etag), ('Cache-Control', cache_control), ('Vary', 'Accept-Encoding')]
+        if none_match(if_none_match, etag):
+            return 304, headers, b''
+        headers += [('Content-Type', self.mimetype), ('Content-Length', str(len(body)))]
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        return 200, headers, body
+
+
+# Splits a page with inline <style> and <script> blocks into the page and
+# fingerprinted app.<hash>.css/js files under prefix, which the page then
+# links to. Returns the page asset and {name: asset} of the rest.
+def build_assets(html, prefix):
+    assets = {}
+
+    def extract(ext, mimetype, tag):
+        def replace(match):
+            asset = Asset(match.group(1).strip().encode() + b'\n', mimetype)
+            name = f'app.{asset.fingerprint}.{ext}'
+            assets[name] = asset
+            return tag.format(url=prefix + name)
+        return replace
+
+    html = STYLE_RE.sub(extract('css', 'text/css; charset=utf-8', '<link rel="stylesheet" href="{url}">'), html)
+    html = SCRIPT_RE.sub(extract('js', 'text/javascript; charset=utf-8', '<script src="{url}"></script>'), html)
+    return Asset(html.strip().encode() + b'\n', 'text/html; charset=utf-8'), assets
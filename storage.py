@@ -0,0 +1,160 @@
+import logging
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# KEYS: reservations hash, reservation expiry zset, reserved total, used bytes
+# ARGV: job id, bytes, quota, expiry timestamp
+RESERVE_SCRIPT = """
+local previous = tonumber(redis.call('hget', KEYS[1], ARGV[1])) or 0
+local reserved = (tonumber(redis.call('get', KEYS[3])) or 0) - previous
+local used = tonumber(redis.call('get', KEYS[4])) or 0
+local size = tonumber(ARGV[2])
+if used + reserved + size > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], size)
+redis.call('zadd', KEYS[2], ARGV[4], ARGV[1])
+redis.call('incrby', KEYS[3], size - previous)
+return 1
+"""
+
+# KEYS: reservations hash, reservation expiry zset, reserved total
+# ARGV: job ids
+RELEASE_SCRIPT = """
+local released = 0
+for _, job in ipairs(ARGV) do
+    local size = tonumber(redis.call('hget', KEYS[1], job))
+    if size then
+        redis.call('hdel', KEYS[1], job)
+        redis.call('decrby', KEYS[3], size)
+        released = released + size
+    end
+    redis.call('zrem', KEYS[2], job)
+end
+return released
+"""
+
+
+# Not enough room for a job's output right now. permanent means it would not
+# fit even in an empty downloads directory.
+class StorageFull(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+# Disk budget of the downloads directory. Finished files are counted by the
+# DownloadCache index (bytes are added and subtracted as files come and go,
+# the directory is never rescanned); running jobs reserve their estimated
+# output size up front.
+#
+#   <prefix>:reservations        hash    job id -> reserved bytes
+#   <prefix>:reservation-expiry  zset    job id -> time the reservation lapses (crashed workers)
+#   <prefix>:reserved            string  total reserved bytes
+#   <prefix>:stats               hash    evicted_files, evicted_bytes, refused counters
+#   <prefix>:sweep               string  set while the periodic sweep is not due
+#
+# sweep() expires files not served for max_idle seconds and evicts least
+# recently used ones down to low_watermark of the quota, minus what running
+# jobs have reserved.
+class StorageManager:
+    def __init__(self, redis_client, download_cache, quota_bytes, reservation_ttl, low_watermark=0.8,
+                 max_idle=None, min_free_bytes=0, sweep_interval=300, prefix='storage'):
+        self.redis = redis_client
+        self.cache = download_cache
+        self.quota_bytes = quota_bytes
+        self.reservation_ttl = reservation_ttl
+        self.low_watermark = low_watermark
+        self.max_idle = max_idle
+        self.min_free_bytes = min_free_bytes
+        self.sweep_interval = sweep_interval
+        self.reservations_key = f'{prefix}:reservations'
+        self.expiry_key = f'{prefix}:reservation-expiry'
+        self.reserved_key = f'{prefix}:reserved'
+        self.stats_key = f'{prefix}:stats'
+        self.sweep_key = f'{prefix}:sweep'
+        self._reserve = redis_client.register_script(RESERVE_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def _keys(self):
+        return [self.reservations_key, self.expiry_key, self.reserved_key]
+
+    def reserve(self, job_id, size):
+        if size > self.quota_bytes:
+            self.redis.hincrby(self.stats_key, 'refused', 1)
+            raise StorageFull(f'Output of about {size} bytes is larger than the storage quota', permanent=True)
+        if shutil.disk_usage(self.cache.outdir).free - size < self.min_free_bytes:
+            self.redis.hincrby(self.stats_key, 'refused', 1)
+            raise StorageFull('Not enough free disk space')
+        if self._try_reserve(job_id, size):
+            return
+        # Evict right away rather than make the job wait for the next sweep
+        self.sweep(room_for=size)
+        if not self._try_reserve(job_id, size):
+            self.redis.hincrby(self.stats_key, 'refused', 1)
+            raise StorageFull('Storage quota is exhausted')
+
+    def _try_reserve(self, job_id, size):
+        return self._reserve(keys=self._keys() + [self.cache.bytes_key],
+                             args=[job_id, size, self.quota_bytes, time.time() + self.reservation_ttl])
+
+    def release(self, job_id):
+        self._release(keys=self._keys(), args=[job_id])
+
+    def reserved_bytes(self):
+        return int(self.redis.get(self.reserved_key) or 0)
+
+    # True while usage sits above the low watermark
+    def over_watermark(self):
+        return self.cache.used_bytes() + self.reserved_bytes() > self.quota_bytes * self.low_watermark
+
+    # room_for makes sure that many more bytes would fit afterwards
+    def sweep(self, room_for=0):
+        stale = self.redis.zrangebyscore(self.expiry_key, '-inf', time.time())
+        if stale:
+            logger.warning(f"Dropping {len(stale)} lapsed storage reservations")
+            self._release(keys=self._keys(), args=stale)
+        idle_before = time.time() - self.max_idle if self.max_idle else None
+        target = min(int(self.quota_bytes * self.low_watermark), self.quota_bytes - room_for)
+        target = max(0, target - self.reserved_bytes())
+        files, freed = self.cache.evict(target, idle_before=idle_before)
+        if files:
+            logger.info(f"Storage sweep evicted {files} files, {freed} bytes")
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.stats_key, 'evicted_files', files)
+            pipe.hincrby(self.stats_key, 'evicted_bytes', freed)
+            pipe.execute()
+        return files, freed
+
+    # Sweeps when usage is above the low watermark, or once per sweep_interval
+    # across all processes so idle files still expire
+    def maybe_sweep(self):
+        due = self.redis.set(self.sweep_key, 1, nx=True, ex=self.sweep_interval)
+        if due or self.over_watermark():
+            return self.sweep()
+        return 0, 0
+
+    def stats(self):
+        pipe = self.redis.pipeline()
+        pipe.get(self.cache.bytes_key)
+        pipe.hlen(self.cache.entries_key)
+        pipe.get(self.reserved_key)
+        pipe.hlen(self.reservations_key)
+        pipe.hgetall(self.stats_key)
+        used, files, reserved, jobs, counters = pipe.execute()
+        disk = shutil.disk_usage(self.cache.outdir)
+        counters = {k.decode(): int(v) for k, v in counters.items()}
+        return {
+            'used_bytes': int(used or 0),
+            'files': files,
+            'reserved_bytes': int(reserved or 0),
+            'reserving_jobs': jobs,
+            'quota_bytes': self.quota_bytes,
+            'disk_free_bytes': disk.free,
+            'disk_total_bytes': disk.total,
+            'evicted_files': counters.get('evicted_files', 0),
+            'evicted_bytes': counters.get('evicted_bytes', 0),
+            'refused': counters.get('refused', 0),
+        }
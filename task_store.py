@@ -0,0 +1,67 @@
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Record, leader id and the leader's Celery result in one call. Key names are
+# built from ARGV, which assumes a single Redis instance (not a cluster).
+# ARGV: task id, record prefix, single-flight alias prefix, Celery result key prefix
+LOOKUP_SCRIPT = """
+local record = redis.call('get', ARGV[2] .. ARGV[1])
+local leader = redis.call('get', ARGV[3] .. ARGV[1]) or ARGV[1]
+local result = redis.call('get', ARGV[4] .. leader)
+return {record, leader, result}
+"""
+
+
+# Task metadata shared by every web process, replacing the old per-process
+# TASKS dict.
+#
+#   <prefix>:<task id>   compact JSON record, expires after ttl
+#
+# lookup() resolves a follower to its single-flight leader and reads the
+# leader's Celery result in the same round trip.
+class TaskStore:
+    def __init__(self, redis_client, ttl, alias_prefix, result_prefix, prefix='task'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.alias_prefix = alias_prefix
+        self.result_prefix = result_prefix
+        self.prefix = prefix
+        self._lookup = redis_client.register_script(LOOKUP_SCRIPT)
+
+    def _key(self, task_id):
+        return f'{self.prefix}:{task_id}'
+
+    def create(self, task_id, **record):
+        record['created'] = int(time.time())
+        self.redis.set(self._key(task_id), json.dumps(record, separators=(',', ':')), ex=self.ttl)
+
+    def _args(self, task_id):
+        return [task_id, f'{self.prefix}:', self.alias_prefix, self.result_prefix]
+
+    def _decode(self, reply):
+        record, leader, result = reply
+        return (json.loads(record) if record else {}), leader.decode(), result
+
+    # Returns (record, leader task id, raw Celery result or None)
+    def lookup(self, task_id):
+        return self._decode(self._lookup(args=self._args(task_id)))
+
+    # Same as lookup() for several tasks, still one round trip
+    def lookup_many(self, task_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            self._lookup(args=self._args(task_id), client=pipe)
+        return [self._decode(reply) for reply in pipe.execute()]
+
+    # Async variants, for a TaskStore built on a redis.asyncio client
+    async def lookup_async(self, task_id):
+        return self._decode(await self._lookup(args=self._args(task_id)))
+
+    async def lookup_many_async(self, task_ids):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                await self._lookup(args=self._args(task_id), client=pipe)
+            return [self._decode(reply) for reply in await pipe.execute()]
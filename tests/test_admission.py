@@ -0,0 +1,88 @@
+import time
+import types
+
+import fakeredis
+import pytest
+
+import admission
+from admission import AdmissionRejected, MemoryAdmission, RedisAdmission
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Starts at the real time: Redis expires keys by its own clock
+    now = [time.time()]
+    monkeypatch.setattr(admission, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def make_admission(request):
+    def make(rate=0, burst=1, max_per_client=0, max_queued=0, job_ttl=60, retry_after=30):
+        if request.param == 'memory':
+            return MemoryAdmission(rate, burst, max_per_client, max_queued, job_ttl, retry_after)
+        return RedisAdmission(fakeredis.FakeRedis(), rate, burst, max_per_client, max_queued, job_ttl, retry_after)
+    return make
+
+
+def test_token_bucket_allows_burst_then_refills(make_admission, clock):
+    limits = make_admission(rate=2, burst=3)
+    for _ in range(3):
+        limits.take_token('a')
+    with pytest.raises(AdmissionRejected) as rejected:
+        limits.take_token('a')
+    assert rejected.value.reason == 'rate'
+    assert rejected.value.retry_after >= 1
+    limits.take_token('b')  # buckets are per client
+    clock[0] += 0.5
+    limits.take_token('a')
+
+
+def test_rate_zero_disables_bucket(make_admission, clock):
+    limits = make_admission(rate=0, burst=1)
+    for _ in range(100):
+        limits.take_token('a')
+
+
+def test_per_client_limit_and_fair_share_count(make_admission, clock):
+    limits = make_admission(max_per_client=2)
+    assert limits.admit('a', 't1') == 0
+    assert limits.admit('a', 't2') == 1
+    with pytest.raises(AdmissionRejected) as rejected:
+        limits.admit('a', 't3')
+    assert rejected.value.reason == 'client'
+    assert rejected.value.retry_after == 30
+    assert limits.admit('b', 't4') == 0
+    limits.release('t1')
+    assert limits.admit('a', 't3') == 1
+
+
+def test_queue_limit(make_admission, clock):
+    limits = make_admission(max_queued=2)
+    limits.admit('a', 't1')
+    limits.admit('b', 't2')
+    with pytest.raises(AdmissionRejected) as rejected:
+        limits.admit('c', 't3')
+    assert rejected.value.reason == 'queue'
+    assert limits.queued() == 2
+    limits.release('t2')
+    limits.admit('c', 't3')
+
+
+def test_jobs_of_dead_workers_lapse(make_admission, clock):
+    limits = make_admission(max_per_client=1, max_queued=1, job_ttl=60)
+    limits.admit('a', 't1')
+    with pytest.raises(AdmissionRejected):
+        limits.admit('a', 't2')
+    clock[0] += 61
+    assert limits.queued() == 0
+    assert limits.admit('a', 't2') == 0
+
+
+def test_release_of_unknown_job_is_harmless(make_admission, clock):
+    limits = make_admission(max_per_client=1)
+    limits.release('never-admitted')
+    limits.admit('a', 't1')
+    limits.release('t1')
+    limits.release('t1')
+    assert limits.admit('a', 't2') == 0
@@ -0,0 +1,135 @@
+import os
+
+import fakeredis
+import pytest
+
+from download_cache import DownloadCache
+from formats import local_streams, raw_selector
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(fakeredis.FakeRedis(), str(tmp_path), max_bytes=10 ** 9)
+
+
+def write(cache, filename, size=10):
+    with open(os.path.join(cache.outdir, filename), 'wb') as f:
+        f.write(b'x' * size)
+    return filename
+
+
+def keys(entries):
+    return sorted(entry['key'] for entry in entries)
+
+
+def test_entries_for_lists_only_the_videos_own_entries(cache):
+    video = DownloadCache.make_key('abcdefghijk', 'video', '720', 'legacy')
+    audio = DownloadCache.make_key('abcdefghijk', 'audio', '', 'legacy')
+    other = DownloadCache.make_key('zzzzzzzzzzz', 'audio', '', 'legacy')
+    cache.put(video, write(cache, 'a-720p.mp4'), '136+140')
+    cache.put(audio, write(cache, 'a-audio.m4a'), '140')
+    cache.put(other, write(cache, 'z-audio.m4a'), '140')
+    cache.put(DownloadCache.file_key('loose.mp4'), write(cache, 'loose.mp4'))
+    assert keys(cache.entries_for('abcdefghijk')) == [audio, video]
+    assert keys(cache.entries_for('zzzzzzzzzzz')) == [other]
+    assert cache.redis.keys('ytcache:video:*') != []
+    assert not cache.redis.exists('ytcache:video:file')
+
+
+def test_removed_entries_leave_the_video_set(cache, tmp_path):
+    key = DownloadCache.make_key('abcdefghijk', 'audio', '', 'legacy')
+    cache.put(key, write(cache, 'a-audio.m4a'), '140')
+    (tmp_path / 'a-audio.m4a').unlink()
+    assert cache.get(key) is None
+    assert cache.entries_for('abcdefghijk') == []
+    assert not cache.redis.exists('ytcache:video:abcdefghijk')
+
+
+def test_file_taken_over_by_another_key_moves_sets(cache):
+    first = DownloadCache.make_key('abcdefghijk', 'audio', '', 'one')
+    second = DownloadCache.make_key('zzzzzzzzzzz', 'audio', '', 'two')
+    cache.put(first, write(cache, 'shared.m4a'), '140')
+    cache.put(second, 'shared.m4a', '140')
+    assert cache.entries_for('abcdefghijk') == []
+    assert keys(cache.entries_for('zzzzzzzzzzz')) == [second]
+
+
+def test_raw_streams_are_sources_but_never_outputs(cache):
+    info = {'formats': [{'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2'},
+                        {'format_id': '136', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': 720}]}
+    key = DownloadCache.make_key('abcdefghijk', 'audio', '', raw_selector('140'))
+    cache.put(key, write(cache, 'a-audio-stream.m4a'), raw_selector('140'))
+    entries = cache.entries_for('abcdefghijk')
+    assert not any(entry['selector'] == '140' for entry in entries)
+    assert local_streams(info, '136+140', entries) == {'140': ('a-audio-stream.m4a', 'a:0')}
+
+
+def test_kept_info_has_no_urls_and_goes_with_the_last_entry(cache):
+    info = {'id': 'abcdefghijk', 'title': 'T', 'url': 'https://cdn/x', 'http_headers': {'A': 'b'},
+            'thumbnails': [{'url': 'https://i/x.jpg'}],
+            'formats': [{'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a', 'vcodec': 'none',
+                         'url': 'https://cdn/140', 'fragments': [{'url': 'f1'}], 'filesize': 5}]}
+    cache.put_info('abcdefghijk', info)
+    kept = cache.info_for('abcdefghijk')
+    assert kept['title'] == 'T' and kept['thumbnails'] == info['thumbnails']
+    assert 'url' not in kept and 'http_headers' not in kept
+    assert kept['formats'] == [{'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'filesize': 5}]
+
+    first = DownloadCache.make_key('abcdefghijk', 'audio', '', 'one')
+    second = DownloadCache.make_key('abcdefghijk', 'video', '720', 'two')
+    cache.put(first, write(cache, 'a.m4a'), '140')
+    cache.put(second, write(cache, 'b.mp4'), '136+140')
+    cache.evict(10)
+    assert cache.info_for('abcdefghijk') is not None
+    cache.evict(0)
+    assert cache.info_for('abcdefghijk') is None
+
+
+def test_get_counts_bytes_and_misses_unknown_keys(cache):
+    key = DownloadCache.make_key('abcdefghijk', 'video', '720', 'legacy')
+    cache.put(key, write(cache, 'a.mp4', size=25), '22')
+    assert cache.get(key)['filename'] == 'a.mp4'
+    assert cache.get(DownloadCache.make_key('abcdefghijk', 'video', '360', 'legacy')) is None
+    assert cache.used_bytes() == 25
+    assert cache.stats() == {'bytes': 25, 'entries': 1, 'max_bytes': 10 ** 9}
+
+
+def test_audio_keys_ignore_quality():
+    assert DownloadCache.make_key('abcdefghijk', 'audio', '720', 's') == DownloadCache.make_key('abcdefghijk', 'audio', None, 's')
+
+
+def test_least_recently_used_goes_first(tmp_path):
+    cache = DownloadCache(fakeredis.FakeRedis(), str(tmp_path), max_bytes=30)
+    first, second = DownloadCache.file_key('first'), DownloadCache.file_key('second')
+    cache.put(first, write(cache, 'first'))
+    cache.put(second, write(cache, 'second'))
+    cache.redis.zadd(cache.lru_key, {second: 1})
+    cache.get(first)  # used since, second is now the oldest
+    cache.put(DownloadCache.file_key('third'), write(cache, 'third', size=15))
+    assert sorted(os.listdir(tmp_path)) == ['first', 'third']
+    assert cache.get(second) is None
+    assert cache.used_bytes() == 25
+
+
+def test_a_new_entry_is_never_its_own_victim(tmp_path):
+    cache = DownloadCache(fakeredis.FakeRedis(), str(tmp_path), max_bytes=5)
+    key = DownloadCache.file_key('big')
+    cache.put(key, write(cache, 'big', size=50))
+    assert cache.get(key)['size'] == 50
+
+
+def test_replacing_an_entry_recounts_its_bytes(cache):
+    key = DownloadCache.file_key('a')
+    cache.put(key, write(cache, 'a', size=10))
+    cache.put(key, write(cache, 'a', size=40))
+    assert cache.used_bytes() == 40
+
+
+def test_serving_a_file_refreshes_its_entry(cache):
+    key = DownloadCache.file_key('a')
+    cache.put(key, write(cache, 'a'))
+    cache.redis.zadd(cache.lru_key, {key: 1})
+    cache.touch_file('a')
+    assert cache.redis.zscore(cache.lru_key, key) > 1
+    cache.touch_file('not-indexed')
+    assert cache.redis.zcard(cache.lru_key) == 1
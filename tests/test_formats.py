@@ -0,0 +1,88 @@
+import pytest
+
+from formats import FormatUnavailable, estimate_size, formats_by_id, select_formats, select_stream_format
+
+
+def audio(format_id, ext='m4a'):
+    return {'format_id': format_id, 'ext': ext, 'vcodec': 'none', 'acodec': 'mp4a.40.2',
+            'url': f'https://cdn.example/{format_id}', 'protocol': 'https'}
+
+
+def video(format_id, height, ext='mp4', vcodec='avc1.640028', acodec='none'):
+    return {'format_id': format_id, 'ext': ext, 'vcodec': vcodec, 'acodec': acodec, 'height': height,
+            'url': f'https://cdn.example/{format_id}', 'protocol': 'https'}
+
+
+# The yt-dlp selectors download_task ran before select_formats replaced them,
+# (primary, fallback) for a quality
+def legacy_selectors(quality):
+    if quality == 'best':
+        return ('bestvideo[vcodec^=avc1][height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best[vcodec^=avc1]',
+                'bv*[vcodec^=avc1][ext=mp4]+ba[ext=m4a]/b[vcodec^=avc1]')
+    return (f'bestvideo[vcodec^=avc1][height<={quality}][ext=mp4]+bestaudio[ext=m4a]/'
+            f'best[ext=mp4][height<={quality}]/best[vcodec^=avc1][height<={quality}]',
+            f'bv*[vcodec^=avc1][height<={quality}][ext=mp4]+ba[ext=m4a]/b[vcodec^=avc1][height<={quality}]')
+
+
+def ytdlp_select(formats, selector):
+    yt_dlp = pytest.importorskip('yt_dlp')
+    chosen = yt_dlp.YoutubeDL({'quiet': True}).build_format_selector(selector)({
+        'formats': formats,
+        'has_merged_format': any(f['vcodec'] != 'none' and f['acodec'] != 'none' for f in formats),
+        'incomplete_formats': False,
+    })
+    return next((f['format_id'] for f in chosen), None)
+
+
+# Sorted worst to best, like yt-dlp hands them over
+FORMAT_LISTS = {
+    'separate streams': [audio('139'), audio('251', ext='webm'), audio('140'), video('160', 144),
+                         video('134', 360), video('244', 480, ext='webm', vcodec='vp9'), video('136', 720),
+                         video('137', 1080), video('264', 1440), video('18', 360, acodec='mp4a.40.2')],
+    'pre-muxed only': [video('18', 360, acodec='mp4a.40.2'), video('22', 720, acodec='mp4a.40.2'),
+                       video('43', 480, ext='webm', vcodec='vp8', acodec='vorbis')],
+    'avc1 above 1080 only': [audio('140'), video('266', 2160), video('302', 720, ext='webm', vcodec='vp9')],
+    'no m4a audio': [audio('251', ext='webm'), video('136', 720), video('18', 360, acodec='mp4a.40.2')],
+}
+
+
+@pytest.mark.parametrize('quality', ['best', '1080', '720', '480', '360', '144'])
+@pytest.mark.parametrize('name', sorted(FORMAT_LISTS))
+def test_select_formats_matches_legacy_selectors(name, quality):
+    formats = FORMAT_LISTS[name]
+    primary, fallback = legacy_selectors(quality)
+    expected = ytdlp_select(formats, primary)
+    used_fallback = expected is None
+    if used_fallback:
+        expected = ytdlp_select(formats, fallback)
+    if expected is None:
+        with pytest.raises(FormatUnavailable):
+            select_formats({'formats': formats}, 'video', quality)
+    else:
+        assert select_formats({'formats': formats}, 'video', quality) == (expected, used_fallback)
+
+
+@pytest.mark.parametrize('name', sorted(FORMAT_LISTS))
+def test_select_audio_matches_legacy_selector(name):
+    formats = FORMAT_LISTS[name]
+    expected = ytdlp_select(formats, 'bestaudio[ext=m4a]')
+    if expected is None:
+        with pytest.raises(FormatUnavailable):
+            select_formats({'formats': formats}, 'audio', '')
+    else:
+        assert select_formats({'formats': formats}, 'audio', '') == (expected, False)
+
+
+def test_stream_format_is_a_single_premuxed_file():
+    info = {'formats': FORMAT_LISTS['pre-muxed only']}
+    assert select_stream_format(info, 'video', '720') == '22'
+    assert select_stream_format({'formats': FORMAT_LISTS['separate streams']}, 'audio', '') == '140'
+    with pytest.raises(FormatUnavailable):
+        select_stream_format({'formats': FORMAT_LISTS['avc1 above 1080 only']}, 'video', '720')
+
+
+def test_estimate_size_adds_parts_or_gives_up():
+    info = {'duration': 10, 'formats': [dict(video('137', 1080), filesize=1000), dict(audio('140'), tbr=128)]}
+    assert estimate_size(info, '137+140') == 1000 + 128 * 1000 // 8 * 10
+    assert estimate_size(info, '137+251') is None
+    assert formats_by_id({'format_id': '18'}) == {'18': {'format_id': '18'}}
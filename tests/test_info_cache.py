@@ -0,0 +1,85 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from info_cache import CachedExtractionError, InfoCache
+from ytdlp_runner import YtdlpError, is_transient
+
+
+@pytest.fixture
+def cache():
+    return InfoCache(fakeredis.FakeRedis(), ttl=60, negative_ttl=60, max_entries=3)
+
+
+def extract_from(info=None, error=None):
+    calls = []
+
+    def extract():
+        calls.append(1)
+        if error:
+            raise error
+        return info
+    extract.calls = calls
+    return extract
+
+
+def get(cache, key, extract):
+    return cache.get_or_extract(key, extract, failures=YtdlpError, permanent=lambda e: not is_transient(e.output))
+
+
+def test_extracts_once_then_serves_from_cache(cache):
+    extract = extract_from({'id': 'abc', 'formats': [{'format_id': '18'}]})
+    assert get(cache, 'abc', extract) == {'id': 'abc', 'formats': [{'format_id': '18'}]}
+    assert get(cache, 'abc', extract)['id'] == 'abc'
+    assert len(extract.calls) == 1
+
+
+def test_concurrent_misses_extract_once(cache):
+    extract = extract_from({'id': 'abc'})
+
+    def slow():
+        time.sleep(0.2)
+        return extract()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get(cache, 'abc', slow))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{'id': 'abc'}] * 4
+    assert len(extract.calls) == 1
+
+
+def test_entries_are_bounded_least_recently_used_first(cache):
+    for key in ('a', 'b', 'c'):
+        get(cache, key, extract_from({'id': key}))
+    cache.get('a')
+    get(cache, 'd', extract_from({'id': 'd'}))
+    assert cache.get('b') is None
+    assert [cache.get(key)['id'] for key in ('a', 'c', 'd')] == ['a', 'c', 'd']
+
+
+def test_permanent_errors_are_cached(cache):
+    extract = extract_from(error=YtdlpError('ERROR: [youtube] abc: Private video'))
+    with pytest.raises(YtdlpError):
+        get(cache, 'abc', extract)
+    with pytest.raises(CachedExtractionError, match='Private video'):
+        get(cache, 'abc', extract)
+    assert len(extract.calls) == 1
+
+
+@pytest.mark.parametrize('message', ['ERROR: HTTP Error 429: Too Many Requests',
+                                     'ERROR: HTTP Error 503: Service Unavailable'])
+def test_transient_errors_are_not_cached(cache, message):
+    with pytest.raises(YtdlpError):
+        get(cache, 'abc', extract_from(error=YtdlpError(message)))
+    assert get(cache, 'abc', extract_from({'id': 'abc'})) == {'id': 'abc'}
+
+
+def test_invalidate_forgets_entry_and_error(cache):
+    get(cache, 'abc', extract_from({'id': 'abc'}))
+    cache.put_error('abc', 'Video unavailable')
+    cache.invalidate('abc')
+    assert cache.get('abc') is None
@@ -0,0 +1,148 @@
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+from range_download import RangeDownloader, RangesUnsupported, fetched_bytes, output_path
+from ytdlp_runner import YtdlpError, is_transient
+
+BODY = os.urandom(10 * 1024 + 7)
+CHUNK = 1024
+
+
+# Serves BODY, answering Range requests unless ranges is off. Starts listed
+# in fail get a 503 and every range asked for is recorded.
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    ranges = True
+    fail = set()
+    requested = []
+
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if not self.ranges or not match:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+            return
+        start, end = int(match.group(1)), min(int(match.group(2)), len(BODY) - 1)
+        self.requested.append(start)
+        if start in self.fail:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(BODY)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(BODY[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    handler = type('Handler', (RangeHandler,), {'fail': set(), 'requested': []})
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/media.mp4'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def downloader(**kwargs):
+    return RangeDownloader(4, chunk_size=CHUNK, **dict({'retries': 0, 'backoff': 0}, **kwargs))
+
+
+def test_downloads_every_chunk_in_parallel(server, tmp_path):
+    path = str(tmp_path / 'media.mp4')
+    progress = []
+    assert downloader().download(server.url, path, on_progress=progress.append) == path
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert sorted(set(server.RequestHandlerClass.requested)) == list(range(0, len(BODY), CHUNK))
+    assert progress[-1]['downloaded_bytes'] == len(BODY)
+    assert not os.path.exists(f'{path}.rpart') and not os.path.exists(f'{path}.rpart.chunks')
+
+
+def test_a_retry_resumes_from_the_chunk_list(server, tmp_path):
+    path = str(tmp_path / 'media.mp4')
+    server.RequestHandlerClass.fail = {3 * CHUNK, 7 * CHUNK}
+    with pytest.raises(YtdlpError) as error:
+        downloader().download(server.url, path)
+    assert is_transient(error.value.output)
+    with open(f'{path}.rpart.chunks') as f:
+        done = {int(line) * CHUNK for line in f.read().split()[2:]}
+    assert fetched_bytes(path) == sum(min(CHUNK, len(BODY) - start) for start in done)
+
+    server.RequestHandlerClass.fail = set()
+    server.RequestHandlerClass.requested.clear()
+    downloader().download(server.url, path, size=len(BODY))
+    missing = set(range(0, len(BODY), CHUNK)) - done
+    assert {3 * CHUNK, 7 * CHUNK} <= missing
+    assert sorted(server.RequestHandlerClass.requested) == sorted(missing)
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert fetched_bytes(path) == 0
+
+
+def test_chunks_of_another_layout_are_fetched_again(server, tmp_path):
+    path = str(tmp_path / 'media.mp4')
+    server.RequestHandlerClass.fail = {0}
+    with pytest.raises(YtdlpError):
+        downloader().download(server.url, path)
+    server.RequestHandlerClass.fail = set()
+    server.RequestHandlerClass.requested.clear()
+    RangeDownloader(4, chunk_size=2 * CHUNK, retries=0).download(server.url, path, size=len(BODY))
+    assert sorted(server.RequestHandlerClass.requested) == list(range(0, len(BODY), 2 * CHUNK))
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+
+
+def test_servers_without_ranges_are_left_to_ytdlp(server, tmp_path):
+    path = str(tmp_path / 'media.mp4')
+    server.RequestHandlerClass.ranges = False
+    with pytest.raises(RangesUnsupported):
+        downloader().download(server.url, path)
+    # With the size known up front the first chunk finds out, and nothing is left behind
+    with pytest.raises(RangesUnsupported):
+        downloader().download(server.url, path, size=len(BODY))
+    assert os.listdir(tmp_path) == []
+
+
+def test_output_path_matches_the_ytdlp_template():
+    info = {'title': 'a/b: c', 'id': 'abcdefghijk'}
+    path = output_path('/d/%(title)s-%(id)s-%(format_id)s.%(ext)s', info, {'format_id': '18', 'ext': 'mp4'})
+    assert path.startswith('/d/') and path.endswith('-abcdefghijk-18.mp4')
+    assert '/' not in path[len('/d/'):]
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    redis = pytest.importorskip('redis')
+    pytest.importorskip('celery')
+    # app talks to Redis from import time on
+    server = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis.Redis, 'from_url', lambda *args, **kwargs: server)
+    import app
+    monkeypatch.setitem(app.app.config, 'RANGE_MIN_BYTES', 0)
+    monkeypatch.setitem(app.app.config, 'RANGE_CHUNK_SIZE', CHUNK)
+    return app
+
+
+def test_app_falls_back_to_ytdlp_without_ranges(app_module, server, tmp_path):
+    info = {'id': 'abcdefghijk', 'title': 'media', 'formats': [
+        {'format_id': '18', 'ext': 'mp4', 'url': server.url, 'protocol': 'http', 'filesize': len(BODY)}]}
+    template = str(tmp_path / '%(title)s-%(id)s.%(ext)s')
+    grant = app_module.scheduler.acquire('127.0.0.1', 'test', 'max')
+    assert app_module.range_download(grant, '18', template, None, info) == str(tmp_path / 'media-abcdefghijk.mp4')
+    os.remove(tmp_path / 'media-abcdefghijk.mp4')
+    server.RequestHandlerClass.ranges = False
+    assert app_module.range_download(grant, '18', template, None, info) is None
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,89 @@
+import fakeredis
+import pytest
+
+from scheduler import FragmentScheduler, is_throttled, upstream_host
+
+
+@pytest.fixture
+def scheduler():
+    return FragmentScheduler(fakeredis.FakeRedis(), worker_budget=8, host_budget=6, initial_window=4, max_window=6)
+
+
+def window(scheduler, host='cdn'):
+    return float(scheduler.redis.hget(f'sched:host:{host}', 'window'))
+
+
+def active(scheduler, key):
+    return int(scheduler.redis.hget(key, 'active') or 0)
+
+
+def test_speed_asks_for_a_share_of_the_window(scheduler):
+    assert scheduler.acquire('cdn', 'w1', 'normal').fragments == 1
+    assert scheduler.acquire('cdn', 'w1', 'fast').fragments == 2
+    assert scheduler.acquire('cdn', 'w1', 'max').fragments == 3  # what is left of the host budget
+
+
+def test_grants_never_drop_below_one_fragment(scheduler):
+    grants = [scheduler.acquire('cdn', 'w1', 'max') for _ in range(3)]
+    assert [grant.fragments for grant in grants] == [4, 2, 1]
+    assert active(scheduler, 'sched:host:cdn') == 7
+
+
+def test_release_gives_back_fragments_once(scheduler):
+    grant = scheduler.acquire('cdn', 'w1', 'max')
+    scheduler.release(grant, 1000)
+    scheduler.release(grant, 1000)
+    assert active(scheduler, 'sched:host:cdn') == active(scheduler, 'sched:worker:w1') == 0
+
+
+def test_window_grows_additively_and_halves_when_throttled(scheduler):
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), 1000)
+    assert window(scheduler) == 5
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), 1000)
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), 1000)
+    assert window(scheduler) == 6  # max_window
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), throttled=True)
+    assert window(scheduler) == 3
+
+
+def test_collapsing_throughput_shrinks_the_window(scheduler):
+    grant = scheduler.acquire('cdn', 'w1', 'max')
+    grant.started -= 1
+    scheduler.release(grant, 10 ** 6)
+    grant = scheduler.acquire('cdn', 'w1', 'max')
+    grant.started -= 1
+    scheduler.release(grant, 10 ** 3)
+    assert window(scheduler) == 5 * 0.75
+
+
+def test_grant_that_fetched_nothing_leaves_the_window_alone(scheduler):
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), 1000)
+    rate = scheduler.redis.hget('sched:host:cdn', 'rate')
+    scheduler.release(scheduler.acquire('cdn', 'w1', 'max'), 0)
+    assert window(scheduler) == 5
+    assert scheduler.redis.hget('sched:host:cdn', 'rate') == rate
+
+
+def test_lapsed_grants_are_given_back(scheduler):
+    scheduler.grant_ttl = -1
+    scheduler.acquire('cdn', 'w1', 'max')
+    scheduler.grant_ttl = 60
+    assert scheduler.acquire('cdn', 'w1', 'max').fragments == 4
+    assert active(scheduler, 'sched:host:cdn') == 4
+
+
+def test_bandwidth_is_split_over_jobs():
+    scheduler = FragmentScheduler(fakeredis.FakeRedis(), 8, 8, 4, host_bandwidth=1000, worker_bandwidth=3000)
+    assert scheduler.acquire('cdn', 'w1', 'normal').rate_limit == 1000
+    assert scheduler.acquire('cdn', 'w1', 'normal').rate_limit == 500
+    assert scheduler.acquire('cdn', 'w2', 'normal').ytdlp_args() == ['--concurrent-fragments', '1',
+                                                                     '--limit-rate', '333']
+
+
+def test_upstream_host_and_throttling():
+    info = {'extractor_key': 'Youtube', 'formats': [{'format_id': '137'},
+                                                    {'format_id': '140', 'url': 'https://cdn.example/140'}]}
+    assert upstream_host(info, '137+140') == 'cdn.example'
+    assert upstream_host(info, '22') == 'Youtube'
+    assert is_throttled('ERROR: HTTP Error 429: Too Many Requests')
+    assert not is_throttled('ERROR: HTTP Error 404: Not Found')
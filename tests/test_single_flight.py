@@ -0,0 +1,49 @@
+import threading
+
+import fakeredis
+import pytest
+
+from single_flight import SingleFlight
+
+
+@pytest.fixture
+def flight():
+    return SingleFlight(fakeredis.FakeRedis(), ttl=60)
+
+
+def test_first_caller_leads_and_the_rest_follow(flight):
+    assert flight.join('job', 'a') == 'a'
+    assert flight.join('job', 'b') == 'a'
+    assert flight.join('other', 'c') == 'c'
+    assert flight.resolve('b') == 'a'
+    assert flight.resolve('a') == 'a'
+    assert flight.resolve('c') == 'c'
+
+
+def test_concurrent_callers_get_one_leader(flight):
+    leaders = []
+    threads = [threading.Thread(target=lambda i=i: leaders.append(flight.join('job', f't{i}'))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(leaders)) == 1
+
+
+def test_release_frees_the_job_for_a_new_leader(flight):
+    flight.join('job', 'a')
+    flight.release('job', 'a')
+    assert flight.join('job', 'b') == 'b'
+
+
+def test_only_the_leader_can_release(flight):
+    flight.join('job', 'a')
+    flight.release('job', 'b')
+    assert flight.join('job', 'c') == 'a'
+
+
+def test_leases_expire(flight):
+    flight.join('job', 'a')
+    assert 0 < flight.redis.ttl('inflight:lease:job') <= 60
+    flight.join('job', 'b')
+    assert 0 < flight.redis.ttl('inflight:alias:b') <= 60
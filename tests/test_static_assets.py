@@ -0,0 +1,53 @@
+import gzip
+
+from static_assets import Asset, build_assets, none_match
+
+
+CSS = b'body { color: #333; }\n' * 50
+
+
+def test_etag_is_stable_and_differs_per_encoding():
+    asset = Asset(CSS, 'text/css')
+    _, identity_headers, body = asset.respond('', None, 'no-cache')
+    _, gzip_headers, compressed = asset.respond('gzip, deflate', None, 'no-cache')
+    assert body == CSS
+    assert gzip.decompress(compressed) == CSS
+    assert dict(identity_headers)['ETag'] == Asset(CSS, 'text/css').variants['identity'][1]
+    assert dict(gzip_headers)['ETag'] != dict(identity_headers)['ETag']
+    assert dict(gzip_headers)['Content-Encoding'] == 'gzip'
+    assert dict(gzip_headers)['Vary'] == 'Accept-Encoding'
+
+
+def test_not_modified_for_matching_etag():
+    asset = Asset(CSS, 'text/css')
+    etag = asset.variants['gzip'][1]
+    for header in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+        status, headers, body = asset.respond('gzip', header, 'max-age=60')
+        assert (status, body) == (304, b'')
+        assert dict(headers)['ETag'] == etag
+        assert dict(headers)['Cache-Control'] == 'max-age=60'
+        assert 'Content-Length' not in dict(headers)
+    # The gzip tag doesn't validate the identity representation
+    assert asset.respond('identity', etag, 'no-cache')[0] == 200
+    assert not none_match('"other"', etag)
+    assert not none_match(None, etag)
+
+
+def test_refused_encodings_fall_back_to_identity():
+    asset = Asset(CSS, 'text/css')
+    assert asset.select('gzip;q=0') == 'identity'
+    assert asset.select('*;q=0') == 'identity'
+    assert asset.select('*') in ('br', 'gzip')
+    # Compression that doesn't make the body smaller isn't kept
+    assert set(Asset(b'x', 'text/plain').variants) == {'identity'}
+
+
+def test_build_assets_moves_inline_blocks_to_fingerprinted_files():
+    page, assets = build_assets('<html><style>p { margin: 0 }</style><script>go()</script></html>', '/assets/')
+    names = sorted(assets)
+    assert [name.rsplit('.', 1)[1] for name in names] == ['css', 'js']
+    html = page.variants['identity'][0].decode()
+    for name in names:
+        assert f'/assets/{name}' in html
+    assert '<style>' not in html and 'go()' not in html
+    assert assets[names[1]].variants['identity'][0] == b'go()\n'
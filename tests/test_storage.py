@@ -0,0 +1,95 @@
+import os
+import time
+
+import fakeredis
+import pytest
+
+from download_cache import DownloadCache
+from storage import StorageFull, StorageManager
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(fakeredis.FakeRedis(), str(tmp_path), max_bytes=10 ** 9)
+
+
+@pytest.fixture
+def storage(cache):
+    return StorageManager(cache.redis, cache, quota_bytes=100, reservation_ttl=60, low_watermark=0.5)
+
+
+def add(cache, filename, size=10, used=None):
+    with open(os.path.join(cache.outdir, filename), 'wb') as f:
+        f.write(b'x' * size)
+    key = DownloadCache.file_key(filename)
+    cache.put(key, filename)
+    if used is not None:
+        cache.redis.zadd(cache.lru_key, {key: used})
+    return filename
+
+
+def on_disk(cache):
+    return sorted(name for name in os.listdir(cache.outdir))
+
+
+def test_reservations_count_against_the_quota(storage):
+    storage.reserve('a', 60)
+    with pytest.raises(StorageFull):
+        storage.reserve('b', 60)
+    storage.release('a')
+    storage.reserve('b', 60)
+    assert storage.reserved_bytes() == 60
+
+
+def test_larger_than_quota_is_permanent(storage):
+    with pytest.raises(StorageFull) as error:
+        storage.reserve('a', 101)
+    assert error.value.permanent
+
+
+def test_reserve_evicts_least_recently_used_files(cache, storage):
+    for i, name in enumerate(['old', 'mid', 'new']):
+        add(cache, name, size=30, used=time.time() - 100 + i)
+    storage.reserve('a', 40)
+    assert on_disk(cache) == ['new']
+
+
+def test_sweep_expires_idle_files_and_keeps_to_watermark(cache, storage):
+    storage.max_idle = 50
+    add(cache, 'idle', used=time.time() - 100)
+    add(cache, 'recent')
+    storage.sweep()
+    assert on_disk(cache) == ['recent']
+    for name in ['a', 'b', 'c', 'd', 'e']:
+        add(cache, name)
+    storage.sweep()
+    assert cache.used_bytes() <= 50
+
+
+def test_pinned_files_survive_sweep_and_eviction(cache, storage):
+    storage.max_idle = 50
+    add(cache, 'idle', used=time.time() - 100)
+    add(cache, 'served', size=40, used=time.time() - 10)
+    add(cache, 'other', size=40)
+    cache.pin('job', ['idle'], ttl=60)
+    cache.pin('response', ['served'], ttl=60)
+    storage.sweep()
+    assert on_disk(cache) == ['idle', 'served']
+    cache.unpin('job', ['idle'])
+    cache.unpin('response', ['served'])
+    storage.sweep()
+    assert on_disk(cache) == ['served']
+
+
+def test_lapsed_pins_stop_protecting(cache):
+    add(cache, 'a', used=time.time() - 10)
+    cache.pin('dead-job', ['a'], ttl=-1)
+    assert cache.pinned_files() == set()
+    assert cache.evict(0) == (1, 10)
+
+
+def test_pins_are_per_holder(cache):
+    cache.pin('one', ['a'], ttl=60)
+    cache.pin('two', ['a'], ttl=60)
+    cache.unpin('one', ['a'])
+    assert cache.pinned_files() == {'a'}
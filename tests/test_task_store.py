@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+import fakeredis
+import pytest
+
+from single_flight import SingleFlight
+from task_store import TaskStore
+
+RESULT_PREFIX = 'celery-task-meta-'
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def store(server):
+    return TaskStore(fakeredis.FakeRedis(server=server), ttl=60, alias_prefix='inflight:alias:',
+                     result_prefix=RESULT_PREFIX)
+
+
+def finish(store, task_id, result):
+    store.redis.set(RESULT_PREFIX + task_id, json.dumps({'status': 'SUCCESS', 'result': result}))
+
+
+def test_records_expire_with_the_ttl(store):
+    store.create('a', message='Starting download...', url='https://youtu.be/x')
+    record, leader, result = store.lookup('a')
+    assert record['message'] == 'Starting download...' and record['url'] == 'https://youtu.be/x'
+    assert (leader, result) == ('a', None)
+    assert 0 < store.redis.ttl('task:a') <= 60
+
+
+def test_unknown_tasks_have_no_record(store):
+    assert store.lookup('nope') == ({}, 'nope', None)
+
+
+def test_followers_see_the_leaders_result(store):
+    flight = SingleFlight(store.redis, ttl=60)
+    flight.join('job', 'leader')
+    flight.join('job', 'follower')
+    store.create('follower', message='Starting download...')
+    finish(store, 'leader', {'success': True})
+    record, leader, result = store.lookup('follower')
+    assert record['message'] == 'Starting download...'
+    assert leader == 'leader'
+    assert json.loads(result)['result'] == {'success': True}
+
+
+def test_lookup_many_matches_lookup(store):
+    store.create('a', message='one')
+    finish(store, 'b', {'success': False})
+    assert store.lookup_many(['a', 'b', 'c']) == [store.lookup('a'), store.lookup('b'), store.lookup('c')]
+
+
+def test_async_lookups_match_sync_ones(store, server):
+    store.create('a', message='one')
+    finish(store, 'b', {'success': True})
+    async_store = TaskStore(fakeredis.FakeAsyncRedis(server=server), ttl=60, alias_prefix='inflight:alias:',
+                            result_prefix=RESULT_PREFIX)
+
+    async def lookups():
+        return await async_store.lookup_async('a'), await async_store.lookup_many_async(['a', 'b'])
+    single, many = asyncio.run(lookups())
+    assert single == store.lookup('a')
+    assert many == store.lookup_many(['a', 'b'])
@@ -0,0 +1,84 @@
+# The in-process engine and the yt-dlp CLI must fail the same way: both
+# raise YtdlpError carrying yt-dlp's message, so retries (is_transient) and
+# the scheduler's back-off (is_throttled) see the same thing on either path.
+import http.server
+import shutil
+import threading
+
+import pytest
+
+from scheduler import is_throttled
+from ytdlp_runner import STREAM_ARGS, YtdlpError, extract_info_cli, is_transient, run_ytdlp_with_info
+
+yt_dlp = pytest.importorskip('yt_dlp')
+from ytdlp_engine import YtdlpEngine  # noqa: E402
+
+YTDLP_BIN = shutil.which('yt-dlp')
+needs_cli = pytest.mark.skipif(YTDLP_BIN is None, reason='yt-dlp CLI is not installed')
+
+
+# Answers /<status>/... with that status and an empty body
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(int(self.path.strip('/').split('/')[0]))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return YtdlpEngine()
+
+
+def info_for(url):
+    return {'id': 'media', 'title': 'media', 'extractor': 'generic', 'extractor_key': 'Generic',
+            'webpage_url': url, 'formats': [{'format_id': '0', 'url': url, 'ext': 'mp4', 'protocol': 'http'}]}
+
+
+def classify(error):
+    return is_transient(error.output), is_throttled(error.output)
+
+
+STATUSES = [(503, (True, False)), (429, (True, True)), (403, (True, True)), (404, (False, False))]
+
+
+@needs_cli
+@pytest.mark.parametrize('status, expected', STATUSES)
+def test_extraction_errors_classify_alike(server, engine, status, expected):
+    url = f'{server}/{status}/watch'
+    with pytest.raises(YtdlpError) as from_engine:
+        engine.extract_info(url)
+    with pytest.raises(YtdlpError) as from_cli:
+        extract_info_cli(YTDLP_BIN, url)
+    assert f'HTTP Error {status}' in from_engine.value.output
+    assert classify(from_engine.value) == classify(from_cli.value) == expected
+
+
+@needs_cli
+@pytest.mark.parametrize('status, expected', STATUSES)
+def test_download_errors_classify_alike(server, engine, tmp_path, status, expected):
+    info = info_for(f'{server}/{status}/media.mp4')
+    args = ['-f', '0', '-o', str(tmp_path / '%(id)s.%(ext)s'), '--retries', '0']
+    with pytest.raises(YtdlpError) as from_engine:
+        engine.download(args, info=info)
+    with pytest.raises(YtdlpError) as from_cli:
+        run_ytdlp_with_info([YTDLP_BIN] + STREAM_ARGS + args, info)
+    assert f'HTTP Error {status}' in from_engine.value.output
+    assert classify(from_engine.value) == classify(from_cli.value) == expected
+
+
+def test_playlist_errors_raise(server, engine):
+    with pytest.raises(YtdlpError) as error:
+        engine.extract_playlist(f'{server}/503/playlist')
+    assert is_transient(error.value.output)
@@ -0,0 +1,79 @@
+import sys
+
+import pytest
+
+from ytdlp_runner import ProgressThrottle, YtdlpError, describe_progress, is_transient, parse_line, run_ytdlp
+
+
+def test_parse_progress_line():
+    kind, progress = parse_line('[progress] 1024 NA 4096.5 512.0 3')
+    assert kind == 'progress'
+    assert progress == {'phase': 'download', 'downloaded_bytes': 1024.0, 'total_bytes': 4096.5,
+                        'speed': 512.0, 'eta': 3.0}
+
+
+def test_parse_short_progress_line():
+    kind, progress = parse_line('[progress] 10 NA NA')
+    assert kind == 'progress'
+    assert progress['total_bytes'] is None and progress['speed'] is None and progress['eta'] is None
+
+
+def test_parse_postprocess_and_filepath_lines():
+    assert parse_line('[postprocess] started FFmpegMerger')[1]['phase'] == 'merge'
+    assert parse_line('[postprocess] finished FFmpegEmbedThumbnail')[1]['phase'] == 'embed'
+    assert parse_line('[postprocess] started MoveFiles')[1]['phase'] == 'postprocess'
+    assert parse_line('[filepath] /downloads/a b-xyz-720p.mp4') == ('filepath', '/downloads/a b-xyz-720p.mp4')
+    assert parse_line('[youtube] xyz: Downloading webpage') == (None, None)
+
+
+def test_throttle_drops_updates_within_interval_but_not_phase_changes():
+    sent = []
+    throttle = ProgressThrottle(sent.append, interval=60)
+    throttle({'phase': 'download', 'downloaded_bytes': 1})
+    throttle({'phase': 'download', 'downloaded_bytes': 2})
+    throttle({'phase': 'merge'})
+    assert [p.get('downloaded_bytes') for p in sent] == [1, None]
+
+
+def test_describe_progress():
+    progress = {'phase': 'download', 'downloaded_bytes': 512, 'total_bytes': 2048, 'speed': 2048 * 1024, 'eta': 4}
+    assert describe_progress('Downloading audio...', progress) == 'Downloading audio... 25% 2.0 MiB/s ETA 4s'
+    assert describe_progress('Downloading audio...', {'phase': 'merge'}) == 'Merging audio and video...'
+
+
+# A stand-in for yt-dlp printing the tagged lines STREAM_ARGS asks for
+def fake_ytdlp(*lines, exit_code=0):
+    script = ''.join(f'print({line!r})\n' for line in lines) + f'raise SystemExit({exit_code})'
+    return [sys.executable, '-c', script]
+
+
+def test_run_ytdlp_reports_progress_and_final_path():
+    progress = []
+    cmd = fake_ytdlp('[youtube] xyz: Downloading webpage', '[progress] 5 10 NA 1 1', '[filepath] /tmp/out.m4a')
+    assert run_ytdlp(cmd, progress.append) == '/tmp/out.m4a'
+    assert [p['downloaded_bytes'] for p in progress] == [5.0]
+
+
+def test_run_ytdlp_failure_keeps_the_log_tail():
+    cmd = fake_ytdlp('[progress] 5 10 NA 1 1', 'ERROR: HTTP Error 503: Service Unavailable', exit_code=1)
+    with pytest.raises(YtdlpError) as error:
+        run_ytdlp(cmd)
+    assert error.value.output == 'ERROR: HTTP Error 503: Service Unavailable'
+    assert error.value.returncode == 1
+
+
+@pytest.mark.parametrize('message, transient', [
+    ('ERROR: unable to download video data: HTTP Error 503: Service Unavailable', True),
+    ('ERROR: HTTP Error 429: Too Many Requests', True),
+    ('ERROR: [Errno 104] Connection reset by peer', True),
+    ('ERROR: The read operation timed out', True),
+    ('ERROR: [youtube] xyz: Private video. Sign in if you\'ve been granted access', False),
+    ('ERROR: HTTP Error 404: Not Found', False),
+    ('ERROR: Video unavailable; fragment 3 timed out', False),
+    ('ERROR: [Errno 28] No space left on device', False),
+    ('ERROR: something nobody has seen before', False),
+    ('', False),
+    (None, False),
+])
+def test_is_transient(message, transient):
+    assert is_transient(message) is transient
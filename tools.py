@@ -0,0 +1,52 @@
+import logging
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _probe_one(binary, version_args):
+    path = shutil.which(binary)
+    if not path:
+        return {'available': False, 'path': None, 'version': None}
+    try:
+        output = subprocess.check_output([path] + version_args, stderr=subprocess.STDOUT, timeout=10)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        logger.error(f"{binary} is installed but failed to run: {e}")
+        return {'available': False, 'path': path, 'version': None}
+    first_line = output.decode(errors='replace').strip().splitlines()
+    return {'available': True, 'path': path, 'version': first_line[0] if first_line else None}
+
+
+# Discovers external tools once and caches the answer, instead of forking a
+# version check on every request. ttl=None caches for the life of the process.
+class ToolProbe:
+    def __init__(self, tools, ttl=None):
+        # tools: name -> (binary, version args)
+        self.tools = tools
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = 0.0
+
+    def _stale(self):
+        if self._result is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self._checked_at > self.ttl
+
+    def get(self):
+        with self._lock:
+            if self._stale():
+                self._result = {name: _probe_one(binary, args) for name, (binary, args) in self.tools.items()}
+                self._checked_at = time.monotonic()
+                for name, info in self._result.items():
+                    if info['available']:
+                        logger.debug(f"Found {name}: {info['version']}")
+                    else:
+                        logger.error(f"{name} is not installed or not in PATH")
+            return self._result
+
+    def available(self, name):
+        return self.get()[name]['available']
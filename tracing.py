@@ -0,0 +1,42 @@
+import contextvars
+import logging
+import re
+import uuid
+
+# Trace id of the request or task being handled, '-' outside of one
+current_trace = contextvars.ContextVar('trace_id', default='-')
+
+# Incoming ids are reused only if they look like ids, never echoed blindly into logs
+TRACE_ID_RE = re.compile(r'^[A-Za-z0-9._-]{8,64}$')
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+# Starts a trace, continuing incoming_id (e.g. an X-Request-ID header or a
+# task header) when it is usable. Returns the token for end_trace.
+def start_trace(incoming_id=None):
+    trace_id = incoming_id if incoming_id and TRACE_ID_RE.match(incoming_id) else new_trace_id()
+    return current_trace.set(trace_id)
+
+
+def end_trace(token):
+    current_trace.reset(token)
+
+
+def trace_id():
+    return current_trace.get()
+
+
+# Every log record carries trace_id, so formats can use %(trace_id)s no
+# matter which handler (Flask, Celery) ends up emitting it
+def install_log_record_factory():
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = current_trace.get()
+        return record
+
+    logging.setLogRecordFactory(record_factory)
@@ -0,0 +1,199 @@
+import collections
+import contextlib
+import logging
+import threading
+
+from ytdlp_runner import PHASES, TAIL_LINES, YtdlpError
+
+try:
+    import yt_dlp
+    from yt_dlp.postprocessor import get_postprocessor
+    from yt_dlp.utils import DownloadError, ExtractorError, POSTPROCESS_WHEN
+    AVAILABLE = True
+except ImportError:  # the subprocess path still works with just the CLI
+    AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Options a job is allowed to change on a warm instance. Anything else
+# (proxies, cookies, headers, ...) is baked into the instance's HTTP session,
+# so a job that sets it gets a throwaway instance instead.
+JOB_OPTIONS = {
+    'format', 'outtmpl', 'postprocessors', 'merge_output_format', 'writethumbnail',
+    'concurrent_fragment_downloads', 'continuedl', 'nopart', 'ratelimit', 'throttledratelimit',
+    'retries', 'fragment_retries', 'noplaylist', 'playlistend', 'playliststart', 'final_ext',
+}
+
+
+def _progress_from_hook(d):
+    return {
+        'phase': 'download',
+        'downloaded_bytes': d.get('downloaded_bytes'),
+        'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+        'speed': d.get('speed'),
+        'eta': d.get('eta'),
+    }
+
+
+def _progress_from_pp_hook(d):
+    return {
+        'phase': PHASES.get(d.get('postprocessor'), 'postprocess'),
+        'postprocessor': d.get('postprocessor'),
+        'status': d.get('status'),
+    }
+
+
+# Hands yt-dlp's messages to logging and keeps its last errors, so a failed
+# job reports what went wrong (HTTP 429, 503, ...) like the CLI's stderr does
+class _Log:
+    def __init__(self):
+        self.logger = logging.getLogger('yt_dlp')
+        self.errors = collections.deque(maxlen=TAIL_LINES)
+
+    def debug(self, message):
+        self.logger.debug(message)
+
+    def info(self, message):
+        self.logger.info(message)
+
+    def warning(self, message):
+        self.logger.warning(message)
+
+    def error(self, message):
+        self.errors.append(message)
+        self.logger.error(message)
+
+
+# yt-dlp's own exceptions leave the engine as YtdlpError, like a failed CLI run
+@contextlib.contextmanager
+def _raising():
+    try:
+        yield
+    except (DownloadError, ExtractorError) as e:
+        raise YtdlpError(str(e)) from e
+
+
+# Worker-resident yt-dlp. Each thread keeps one warm YoutubeDL (extractors
+# loaded, HTTP connections pooled) and reconfigures it per job, so a job costs
+# an option parse instead of an interpreter start. Jobs take the same CLI
+# arguments as the subprocess path, minus the binary and STREAM_ARGS.
+class YtdlpEngine:
+    def __init__(self, base_params=None):
+        if not AVAILABLE:
+            raise RuntimeError('yt_dlp is not installed')
+        self._defaults = yt_dlp.parse_options([]).ydl_opts
+        # The CLI defaults to ignoreerrors='only_download', which turns a failed
+        # extraction into a None result; the engine wants the error
+        self.base_params = dict(self._defaults, quiet=True, no_warnings=True, noprogress=True, ignoreerrors=False,
+                                **(base_params or {}))
+        self._local = threading.local()
+
+    def _instance(self):
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(dict(self.base_params, logger=_Log()))
+            self._local.ydl = ydl
+        return ydl
+
+    # Build the warm instance ahead of the first job
+    def warm(self):
+        self._instance()
+
+    def _job_params(self, args):
+        parsed = yt_dlp.parse_options(args)
+        params = {k: v for k, v in parsed.ydl_opts.items() if v != self._defaults.get(k)}
+        return params, parsed.urls
+
+    # Metadata only, JSON serializable so it can be cached or sent to a CLI
+    def extract_info(self, url):
+        return self._extract(url, noplaylist=True)
+
+    # Flat playlist/channel listing, entries carry a URL and title but no formats
+    def extract_playlist(self, url):
+        return self._extract(url, noplaylist=False, extract_flat='in_playlist')
+
+    # Extracts on the warm instance with options changed for this call only
+    def _extract(self, url, **options):
+        ydl = self._instance()
+        saved = ydl.params
+        try:
+            ydl.params = dict(saved, **options)
+            ydl.params['logger'].errors.clear()
+            with _raising():
+                info = ydl.extract_info(url, download=False)
+            if info is None:
+                raise YtdlpError(self._errors(ydl) or f'yt-dlp extracted nothing from {url}')
+            return ydl.sanitize_info(info)
+        finally:
+            ydl.params = saved
+
+    # Either args carry the URL, or info is an already extracted info dict and
+    # the download skips extraction
+    def download(self, args, on_progress=None, info=None):
+        params, urls = self._job_params(args)
+        if info is not None:
+            # Same path as yt-dlp --load-info-json
+            run = lambda ydl: ydl.process_ie_result(dict(info), download=True)
+        else:
+            run = lambda ydl: ydl.download(urls)
+        filepaths = []
+
+        def progress_hook(d):
+            if on_progress and d.get('status') == 'downloading':
+                on_progress(_progress_from_hook(d))
+
+        def postprocessor_hook(d):
+            if on_progress:
+                on_progress(_progress_from_pp_hook(d))
+
+        hooks = {
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
+            'post_hooks': [filepaths.append],
+        }
+        with _raising():
+            if set(params) <= JOB_OPTIONS:
+                self._run_warm(params, run, hooks)
+            else:
+                logger.debug(f"Options {sorted(set(params) - JOB_OPTIONS)} need a fresh yt-dlp instance")
+                with yt_dlp.YoutubeDL(dict(self.base_params, logger=_Log(), **params, **hooks)) as ydl:
+                    run(ydl)
+                    self._check(ydl)
+        return filepaths[-1] if filepaths else None
+
+    def _errors(self, ydl):
+        return '\n'.join(ydl.params['logger'].errors)
+
+    def _check(self, ydl):
+        if ydl._download_retcode:
+            raise YtdlpError(self._errors(ydl) or 'yt-dlp reported errors', ydl._download_retcode)
+
+    def _run_warm(self, params, run, hooks):
+        ydl = self._instance()
+        saved = (ydl.params, ydl.format_selector, ydl._pps,
+                 ydl._progress_hooks, ydl._postprocessor_hooks, ydl._post_hooks)
+        try:
+            ydl.params = dict(ydl.params, **params)
+            if 'outtmpl' in params:
+                ydl.params['outtmpl'] = dict(params['outtmpl'])
+                ydl._parse_outtmpl()
+            if 'format' in params:
+                ydl.format_selector = ydl.build_format_selector(params['format'])
+            ydl._pps = {when: [] for when in POSTPROCESS_WHEN}
+            for pp_def in ydl.params.get('postprocessors', []):
+                pp_def = dict(pp_def)
+                when = pp_def.pop('when', 'post_process')
+                ydl.add_post_processor(get_postprocessor(pp_def.pop('key'))(ydl, **pp_def), when=when)
+            ydl._progress_hooks = list(hooks['progress_hooks'])
+            ydl._post_hooks = list(hooks['post_hooks'])
+            ydl._postprocessor_hooks = []
+            for hook in hooks['postprocessor_hooks']:
+                ydl.add_postprocessor_hook(hook)
+            ydl._download_retcode = 0
+            ydl._num_downloads = 0
+            ydl.params['logger'].errors.clear()
+            run(ydl)
+            self._check(ydl)
+        finally:
+            (ydl.params, ydl.format_selector, ydl._pps,
+             ydl._progress_hooks, ydl._postprocessor_hooks, ydl._post_hooks) = saved
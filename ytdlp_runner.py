@@ -0,0 +1,200 @@
+import collections
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Every line yt-dlp writes is tagged so the runner can tell progress,
+# post-processing and the final path apart from ordinary log output
+PROGRESS_TEMPLATE = ('download:[progress] %(progress.downloaded_bytes)s %(progress.total_bytes)s '
+                     '%(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s')
+POSTPROCESS_TEMPLATE = 'postprocess:[postprocess] %(progress.status)s %(progress.postprocessor)s'
+FILEPATH_TEMPLATE = 'after_move:[filepath] %(filepath)s'
+
+STREAM_ARGS = [
+    '--newline', '--progress',
+    '--progress-template', PROGRESS_TEMPLATE,
+    '--progress-template', POSTPROCESS_TEMPLATE,
+    '--print', FILEPATH_TEMPLATE,
+]
+
+# yt-dlp post-processor name -> phase reported to the client
+PHASES = {
+    'Merger': 'merge',
+    'FFmpegMerger': 'merge',
+    'EmbedThumbnail': 'embed',
+    'FFmpegEmbedThumbnail': 'embed',
+    'FFmpegMetadata': 'embed',
+}
+
+# Lines kept around for the error message when yt-dlp fails
+TAIL_LINES = 50
+
+
+# yt-dlp failed, output holds the tail of its log
+class YtdlpError(Exception):
+    def __init__(self, output, returncode=1):
+        super().__init__(output)
+        self.output = output
+        self.returncode = returncode
+
+
+# Failures worth another attempt: the network or the CDN hiccuped, the video
+# itself is fine. HTTP 403 usually means the signed format URLs expired.
+TRANSIENT_MARKERS = (
+    'HTTP Error 5', 'HTTP Error 429', 'HTTP Error 403', 'Too Many Requests',
+    'Connection reset', 'Connection aborted', 'Connection refused', 'Remote end closed',
+    'timed out', 'Temporary failure in name resolution', 'IncompleteRead',
+    'fragment', 'Unable to download video data', 'Unable to download webpage',
+    'did not get any data blocks', 'Got error',
+)
+# Failures that will not go away by retrying, even if a transient marker shows up too
+PERMANENT_MARKERS = (
+    'Private video', 'Video unavailable', 'This video has been removed', 'This video is not available',
+    'members-only', 'Sign in to confirm your age', 'has been terminated', 'copyright',
+    'Unsupported URL', 'is not a valid URL', 'Requested format is not available', 'HTTP Error 404',
+    'HTTP Error 410', 'No space left on device',
+)
+
+
+def is_transient(message):
+    message = message or ''
+    if any(marker in message for marker in PERMANENT_MARKERS):
+        return False
+    return any(marker.lower() in message.lower() for marker in TRANSIENT_MARKERS)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None  # yt-dlp renders missing fields as NA
+
+
+def parse_line(line):
+    if line.startswith('[progress] '):
+        downloaded, total, estimate, speed, eta = (line.split() + [''] * 6)[1:6]
+        total = _number(total) or _number(estimate)
+        return 'progress', {
+            'phase': 'download',
+            'downloaded_bytes': _number(downloaded),
+            'total_bytes': total,
+            'speed': _number(speed),
+            'eta': _number(eta),
+        }
+    if line.startswith('[postprocess] '):
+        status, _, postprocessor = line[len('[postprocess] '):].partition(' ')
+        return 'progress', {
+            'phase': PHASES.get(postprocessor, 'postprocess'),
+            'postprocessor': postprocessor,
+            'status': status,
+        }
+    if line.startswith('[filepath] '):
+        return 'filepath', line[len('[filepath] '):]
+    return None, None
+
+
+# Runs yt-dlp (cmd must include STREAM_ARGS) and returns the final file path.
+# Output is consumed line by line, only the last few lines are kept.
+def run_ytdlp(cmd, on_progress=None):
+    tail = collections.deque(maxlen=TAIL_LINES)
+    filepath = None
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
+                            text=True, errors='replace')
+    try:
+        for line in proc.stdout:
+            line = line.rstrip('\n')
+            kind, value = parse_line(line)
+            if kind == 'progress':
+                if on_progress:
+                    on_progress(value)
+            elif kind == 'filepath':
+                filepath = value
+            elif line:
+                tail.append(line)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise YtdlpError('\n'.join(tail), returncode)
+    return filepath
+
+
+# Extracts metadata only, the returned info dict can be handed back to
+# run_ytdlp_with_info so the download does not extract again
+def extract_info_cli(ytdlp_bin, url):
+    result = subprocess.run([ytdlp_bin, '--dump-single-json', '--no-playlist', url],
+                            capture_output=True, text=True, errors='replace')
+    if result.returncode:
+        raise YtdlpError('\n'.join(result.stderr.splitlines()[-TAIL_LINES:]), result.returncode)
+    return json.loads(result.stdout)
+
+
+# Flat playlist/channel listing, entries carry a URL and title but no formats
+def extract_playlist_cli(ytdlp_bin, url):
+    result = subprocess.run([ytdlp_bin, '--dump-single-json', '--flat-playlist', '--yes-playlist', url],
+                            capture_output=True, text=True, errors='replace')
+    if result.returncode:
+        raise YtdlpError('\n'.join(result.stderr.splitlines()[-TAIL_LINES:]), result.returncode)
+    return json.loads(result.stdout)
+
+
+# Like run_ytdlp, but downloads from an already extracted info dict
+def run_ytdlp_with_info(cmd, info, on_progress=None):
+    fd, path = tempfile.mkstemp(suffix='.info.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f)
+        return run_ytdlp(cmd + ['--load-info-json', path], on_progress)
+    finally:
+        os.remove(path)
+
+
+# Forwards progress at most once per interval, phase changes always go through
+class ProgressThrottle:
+    def __init__(self, callback, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self._last_sent = 0.0
+        self._last_phase = None
+
+    def __call__(self, progress):
+        now = time.monotonic()
+        if progress['phase'] == self._last_phase and now - self._last_sent < self.interval:
+            return
+        self._last_sent = now
+        self._last_phase = progress['phase']
+        try:
+            self.callback(progress)
+        except Exception as e:
+            logger.warning(f"Progress update failed: {e}")
+
+
+def _human_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+
+# Short human readable summary of a progress dict
+def describe_progress(label, progress):
+    if progress['phase'] == 'merge':
+        return 'Merging audio and video...'
+    if progress['phase'] == 'embed':
+        return 'Embedding thumbnail and metadata...'
+    if progress['phase'] != 'download':
+        return 'Post-processing...'
+    parts = []
+    downloaded, total = progress.get('downloaded_bytes'), progress.get('total_bytes')
+    if downloaded is not None and total:
+        parts.append(f'{downloaded / total * 100:.0f}%')
+    if progress.get('speed'):
+        parts.append(f"{_human_bytes(progress['speed'])}/s")
+    if progress.get('eta') is not None:
+        parts.append(f"ETA {progress['eta']:.0f}s")
+    return f"{label} {' '.join(parts)}".strip()